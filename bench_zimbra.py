@@ -0,0 +1,255 @@
+'''Benchmarks for zimbratosthenes, on synthetic rule sets
+
+Rule sets of a few rules up to a hundred thousand are generated with all the
+tests and actions that we convert. Each benchmark runs in its own process,
+so that its peak memory can be measured. Results can be saved as a baseline
+and later runs compared to it:
+
+    python bench_zimbra.py --save baseline.json
+    python bench_zimbra.py --compare baseline.json'''
+from __future__ import print_function
+
+import argparse
+import io
+import json
+import multiprocessing
+import random
+import resource
+import sys
+import time
+
+import mock_zimbra
+import zimbra
+
+
+HEADERS = [u'subject', u'from', u'to,cc', u'X-Spam-Flag', u'List-Id']
+WORDS = [u'fizz', u'buzz', u'foo', u'bar', u'*none?', u'newsletter',
+         u'invoice', u'meeting', u'[list]', u'urgent']
+FOLDERS = [u'Junk', u'Lists/dev', u'Lists/users', u'Archive/2014', u'.pipe']
+SIZES = [u'10M', u'1G', u'512K', u'100B', u'1536K']
+# midnight, UTC
+DATES = [u'1388534400', u'1396310400', u'1420070400']
+
+
+def generate_test(rng, category):
+    '''Return a random Zimbra test of the given category'''
+    if category == u'headerTest':
+        test = {u'header': rng.choice(HEADERS),
+                u'stringComparison': rng.choice([u'is', u'contains',
+                                                 u'matches']),
+                u'value': rng.choice(WORDS)}
+    elif category == u'addressTest':
+        test = {u'header': rng.choice([u'from', u'to']),
+                u'part': rng.choice([u'all', u'localpart', u'domain']),
+                u'stringComparison': rng.choice([u'is', u'contains']),
+                u'value': rng.choice([u'example.com', u'alice'])}
+    elif category == u'sizeTest':
+        test = {u'numberComparison': rng.choice([u'over', u'under']),
+                u's': rng.choice(SIZES)}
+    elif category == u'dateTest':
+        test = {u'dateComparison': rng.choice([u'before', u'after']),
+                u'd': rng.choice(DATES)}
+    elif category == u'bodyTest':
+        test = {u'value': rng.choice(WORDS)}
+    else:
+        test = {u'header': rng.choice(HEADERS[3:])}
+    if rng.random() < 0.2:
+        test[u'negative'] = u'1'
+    return test
+
+
+def generate_action(rng, category):
+    '''Return a random Zimbra action of the given category'''
+    if category == u'actionFileInto':
+        return {u'folderPath': rng.choice(FOLDERS)}
+    if category == u'actionRedirect':
+        return {u'a': u'user' + unicode(rng.randint(0, 99)) +
+                u'@example.com'}
+    if category == u'actionFlag':
+        return {u'flagName': rng.choice([u'read', u'flagged'])}
+    if category == u'actionTag':
+        return {u'tagName': rng.choice([u'Old', u'Work', u'Todo'])}
+    return {}
+
+
+def generate_rules(count, seed=0):
+    '''Return a list of realistic random Zimbra rules'''
+    rng = random.Random(seed)
+    tests = [u'headerTest'] * 6 + [u'addressTest', u'sizeTest', u'dateTest',
+                                   u'bodyTest', u'headerExistsTest']
+    actions = [u'actionFileInto', u'actionRedirect', u'actionFlag',
+               u'actionTag', u'actionKeep', u'actionDiscard']
+    rules = []
+    for i in xrange(count):
+        filter_tests = {u'condition': rng.choice([u'allof', u'anyof'])}
+        for index in xrange(rng.randint(1, 5)):
+            category = rng.choice(tests)
+            test = generate_test(rng, category)
+            test[u'index'] = unicode(index)
+            zimbra.add_to_category(filter_tests, category, test)
+        filter_actions = {}
+        chosen = rng.sample(actions, rng.randint(1, 3))
+        if rng.random() < 0.5:
+            chosen.append(u'actionStop')
+        for (index, category) in enumerate(chosen):
+            action = generate_action(rng, category)
+            action[u'index'] = unicode(index)
+            filter_actions[category] = action
+        rules.append({
+            u'name': u'rule ' + unicode(i),
+            u'active': rng.choice([u'0', u'1', u'1']),
+            u'filterTests': filter_tests,
+            u'filterActions': filter_actions
+        })
+    return rules
+
+
+def generate_sieve(count, seed=0):
+    '''Return the Sieve source of a random rule set'''
+    return u''.join(zimbra.show_rules(generate_rules(count, seed)))
+
+
+def bench_zimbrify(count):
+    '''zimbrify() alone, on an already parsed file'''
+    p = zimbra.init_parser()
+    p.parse(generate_sieve(count))
+    yield
+    zimbra.zimbrify(p.result)
+
+
+def bench_parse(count):
+    '''sievelib parsing'''
+    sieve = generate_sieve(count)
+    yield
+    zimbra.init_parser().parse(sieve)
+
+
+def bench_fast_path(count):
+    '''conversion of a Sieve file through the fast path'''
+    sieve = generate_sieve(count).encode('utf-8')
+    yield
+    zimbra.convert_stream(io.BytesIO(sieve))
+
+
+def bench_display(count):
+    '''Sieve rendering'''
+    rules = generate_rules(count)
+    out = io.StringIO()
+    yield
+    zimbra.display_rules(rules, out)
+
+
+def bench_round_trip(count):
+    '''rendering then conversion back, without cache'''
+    rules = generate_rules(count)
+    yield
+    out = io.StringIO()
+    zimbra.display_rules(rules, out)
+    assert not zimbra.diff_rules(rules, zimbra.convert(out.getvalue(),
+                                                       cache=False))
+
+
+def bench_soap(count):
+    '''download then upload through a local mock server'''
+    mock = mock_zimbra.MockZimbra()
+    mock.filters[u'bench'] = generate_rules(count)
+    server = mock_zimbra.serve(mock)
+    # a failure must not leave the server running, the process would not exit
+    try:
+        (token, lifetime) = zimbra.authenticate(server.url, u'bench', u'')
+        comm = zimbra.get_connection(server.url)
+        yield
+        rules = zimbra.fetch_rules(comm, token)
+        assert zimbra.upload_rules(comm, token, rules, rules)
+    finally:
+        server.shutdown()
+
+
+BENCHMARKS = [
+    (u'zimbrify', bench_zimbrify),
+    (u'parse', bench_parse),
+    (u'fast_path', bench_fast_path),
+    (u'display_rules', bench_display),
+    (u'round_trip', bench_round_trip),
+    (u'soap', bench_soap),
+]
+
+
+def measure(bench, count, queue):
+    '''run one benchmark, after its setup, and report time and memory'''
+    try:
+        run = bench(count)
+        next(run)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        for _ in run:
+            pass
+        elapsed = time.time() - start
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        queue.put((elapsed, after - before))
+    except Exception as e:
+        queue.put((None, repr(e)))
+
+
+def run_benchmark(bench, count):
+    '''return (seconds, extra peak memory in kB) of a benchmark, measured in
+    a fresh process'''
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measure,
+                                      args=(bench, count, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    if result[0] is None:
+        raise RuntimeError(result[1])
+    return result
+
+
+def main():
+    '''Run benchmarks and compare them to a baseline'''
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(u'-n', u'--rules', type=int, nargs=u'+',
+                        default=[10, 100, 1000, 10000],
+                        help=u'sizes of the generated rule sets')
+    parser.add_argument(u'-b', u'--bench', nargs=u'+',
+                        choices=[name for (name, _) in BENCHMARKS],
+                        help=u'benchmarks to run, all by default')
+    parser.add_argument(u'--save', help=u'save results as a baseline')
+    parser.add_argument(u'--compare', help=u'compare with a baseline')
+    parser.add_argument(u'--threshold', type=float, default=1.2,
+                        help=u'slowdown ratio reported as a regression')
+    options = parser.parse_args()
+
+    baseline = {}
+    if options.compare:
+        with io.open(options.compare, encoding=u'utf-8') as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = 0
+    for (name, bench) in BENCHMARKS:
+        if options.bench and name not in options.bench:
+            continue
+        for count in options.rules:
+            key = name + u'/' + unicode(count)
+            (seconds, memory) = run_benchmark(bench, count)
+            results[key] = {u'seconds': seconds, u'memory_kb': memory}
+            line = u'{0:<24} {1:>10.4f}s {2:>10d}kB'.format(
+                key, seconds, memory)
+            if key in baseline:
+                ratio = seconds / max(baseline[key][u'seconds'], 1e-9)
+                line += u'  x{0:.2f}'.format(ratio)
+                if ratio > options.threshold:
+                    line += u' REGRESSION'
+                    regressions += 1
+            print(line)
+            sys.stdout.flush()
+
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    exit(main())
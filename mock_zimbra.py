@@ -0,0 +1,437 @@
+'''A local stand-in for the Zimbra SOAP API, for tests and load tests
+
+AuthRequest (with a password or a preauth value), DelegateAuthRequest, the
+requests getting, modifying or applying incoming and outgoing filters,
+GetFolderRequest, GetTagRequest, SearchRequest (only after: and before:
+terms are understood) and BatchRequest are answered from an
+in-memory state per account. Latency and faults can be injected, so
+that fleet synchronizations, retries and concurrency limits can be tried
+without a Zimbra server:
+
+    python mock_zimbra.py --port 7070 --latency 0.1 --fault-rate 0.05
+    zbt --url http://127.0.0.1:7070/service/soap/ fleet manifest'''
+from __future__ import print_function
+
+import argparse
+import hashlib
+import hmac
+import random
+import threading
+import time
+import uuid
+from datetime import datetime
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from xml.dom import minidom
+
+from pythonzimbra.tools.xmlserializer import dict_to_dom, dom_to_dict
+
+
+SOAP_NS = u'http://www.w3.org/2003/05/soap-envelope'
+
+
+def envelope(content):
+    '''Return the XML of a SOAP response, content maps the names of the
+    elements of its body to their dict'''
+    doc = minidom.Document()
+    root = doc.createElementNS(SOAP_NS, u'soap:Envelope')
+    root.setAttribute(u'xmlns:soap', SOAP_NS)
+    body = doc.createElement(u'soap:Body')
+    dict_to_dom(body, content)
+    root.appendChild(body)
+    doc.appendChild(root)
+    return doc.toxml('utf-8')
+
+
+def fault(code, message=None):
+    '''Return the (name, dict) of a SOAP fault, as Zimbra sends them'''
+    return (u'soap:Fault', {
+        u'soap:Code': {u'soap:Value': {u'_content': u'soap:Sender'}},
+        u'soap:Reason': {u'soap:Text': {u'_content': message or code}},
+        u'soap:Detail': {u'Error': {u'xmlns': u'urn:zimbra',
+                                    u'Code': {u'_content': code}}}
+    })
+
+
+def as_list(value):
+    '''Repeated elements are a list, single ones are not'''
+    if value is None:
+        return []
+    if not isinstance(value, list):
+        return [value]
+    return value
+
+
+def folder_tree(paths, links=()):
+    '''Return the GetFolderResponse folder of a list of folder paths
+
+    the paths of links are mountpoints of shared folders'''
+    root = {u'id': u'1', u'name': u'USER_ROOT', u'absFolderPath': u'/',
+            u'folder': []}
+    nodes = {u'': root}
+    for path in sorted(set(paths) | set(links)):
+        parent = u''
+        for name in path.split(u'/'):
+            current = parent + u'/' + name if parent else name
+            if current not in nodes:
+                nodes[current] = {u'id': unicode(len(nodes) + 1),
+                                  u'name': name,
+                                  u'absFolderPath': u'/' + current,
+                                  u'folder': []}
+                element = u'link' if current in links else u'folder'
+                nodes[parent].setdefault(element, []).append(nodes[current])
+            parent = current
+    return root
+
+
+def query_matcher(query, offset=0):
+    '''Return a function telling if a message timestamp matches the after:
+    and before: terms of a search query, other terms match any message
+
+    days are those of the timezone offset seconds east of UTC'''
+    bounds = []
+    for term in query.replace(u'(', u' ').replace(u')', u' ').split():
+        (name, _, value) = term.partition(u':')
+        if name in (u'after', u'before'):
+            bounds.append((name, datetime.strptime(value, '%m/%d/%Y').date()))
+
+    def match(timestamp):
+        day = datetime.utcfromtimestamp(timestamp + offset).date()
+        return all(day > bound if name == u'after' else day < bound
+                   for (name, bound) in bounds)
+    return match
+
+
+# folders of new accounts
+DEFAULT_FOLDERS = [u'Inbox', u'Junk', u'Sent', u'Drafts', u'Trash']
+
+
+class MockZimbra(object):
+    '''In-memory state of a mock Zimbra server
+
+    accounts maps logins to passwords, None accepting any password, and
+    is None to accept any account. Any account can also authenticate with
+    the preauth_key of the domain, and the admins with the admin SOAP API.
+    Each request is delayed by latency seconds and fails with probability
+    fault_rate, requests of a batch are each checked for faults. Faults can
+    also be queued for the next requests of a type with fail().'''
+    def __init__(self, accounts=None, latency=0.0, fault_rate=0.0,
+                 fault_code=u'service.FAILURE', lifetime=3600, seed=None,
+                 preauth_key=None, admins=()):
+        self.accounts = accounts
+        self.preauth_key = preauth_key
+        self.admins = set(admins)
+        self.latency = latency
+        self.fault_rate = fault_rate
+        self.fault_code = fault_code
+        self.lifetime = lifetime
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.filters = {}
+        self.outgoing = {}
+        self.folders = {}
+        # mountpoints of shared folders of each account
+        self.links = {}
+        self.tags = {}
+        # (id, timestamp) of the messages of each account
+        self.messages = {}
+        # ids of the messages filters were applied to
+        self.applied = {}
+        # messages filters can be applied to at once
+        self.apply_limit = 10000
+        # whether applied filters move messages out of any search, like
+        # fileinto out of the inbox
+        self.fileinto = False
+        # seconds east of UTC of the timezone of the accounts
+        self.timezone = 0
+        self.tokens = {}
+        self.faults = {}
+        self.requests = {}
+        self.active = 0
+        self.max_active = 0
+        # authenticated requests
+        self.handlers = {
+            u'GetFilterRulesRequest': self.get_filter_rules,
+            u'ModifyFilterRulesRequest': self.modify_filter_rules,
+            u'GetOutgoingFilterRulesRequest': self.get_filter_rules,
+            u'ModifyOutgoingFilterRulesRequest': self.modify_filter_rules,
+            u'GetFolderRequest': self.get_folder,
+            u'GetTagRequest': self.get_tag,
+            u'DelegateAuthRequest': self.delegate_auth,
+            u'SearchRequest': self.search,
+            u'ApplyFilterRulesRequest': self.apply_filter_rules,
+            u'ApplyOutgoingFilterRulesRequest': self.apply_filter_rules,
+        }
+
+    def fail(self, request_type, code, count=1):
+        '''make the next count requests of a type fail with a fault code'''
+        with self.lock:
+            self.faults.setdefault(request_type, []).extend([code] * count)
+
+    def expire_tokens(self):
+        '''forget every authentication token'''
+        with self.lock:
+            self.tokens.clear()
+
+    def handle(self, text):
+        '''Answer a SOAP envelope, return (HTTP status, XML response)'''
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+            doc = minidom.parseString(text)
+            tokens = doc.getElementsByTagName(u'authToken')
+            token = tokens.item(0).firstChild.data if tokens.length else None
+            body = doc.getElementsByTagNameNS(SOAP_NS, u'Body').item(0)
+            node = elements(body)[0]
+            if node.tagName != u'BatchRequest':
+                (name, content) = self.answer(node, token)
+                return (500 if name == u'soap:Fault' else 200,
+                        envelope({name: content}))
+            with self.lock:
+                self.requests[u'BatchRequest'] = \
+                    self.requests.get(u'BatchRequest', 0) + 1
+            responses = {}
+            for child in elements(node):
+                (name, content) = self.answer(child, token)
+                content[u'requestId'] = child.getAttribute(u'requestId')
+                responses.setdefault(name, []).append(content)
+            responses[u'xmlns'] = u'urn:zimbra'
+            return (200, envelope({u'BatchResponse': responses}))
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def answer(self, node, token):
+        '''Check authentication and faults, then call the handler of a
+        request, return the (name, dict) of its response'''
+        request_type = node.tagName
+        with self.lock:
+            self.requests[request_type] = \
+                self.requests.get(request_type, 0) + 1
+            queued = self.faults.get(request_type)
+            code = queued.pop(0) if queued else None
+            if code is None and self.random.random() < self.fault_rate:
+                code = self.fault_code
+        if code is not None:
+            return fault(code)
+        request = dom_to_dict(node)[request_type]
+        if request_type == u'AuthRequest':
+            return self.auth(request,
+                             node.namespaceURI == u'urn:zimbraAdmin')
+        if request_type not in self.handlers:
+            return fault(u'service.UNKNOWN_DOCUMENT', request_type)
+
+        if token is None:
+            return fault(u'service.AUTH_REQUIRED')
+        with self.lock:
+            (login, expires) = self.tokens.get(token, (None, 0))
+        if login is None or expires < time.time():
+            return fault(u'service.AUTH_EXPIRED')
+        (name, content) = self.handlers[request_type](login, request_type,
+                                                      request)
+        content[u'xmlns'] = u'urn:zimbraMail'
+        return (name, content)
+
+    def auth(self, request, admin=False):
+        '''Check the password or the preauth value of an account, and that
+        it is an admin for the admin API, then create a token'''
+        login = request[u'account'][u'_content']
+        preauth = request.get(u'preauth')
+        if preauth is not None:
+            ok = self.preauth_key is not None and \
+                abs(time.time() - int(preauth[u'timestamp']) / 1000.0) < 300 \
+                and preauth.get(u'_content') == hmac.new(
+                    self.preauth_key.encode('utf-8'), u'|'.join([
+                        login, request[u'account'][u'by'],
+                        preauth[u'expires'], preauth[u'timestamp']
+                    ]).encode('utf-8'), hashlib.sha1).hexdigest()
+        else:
+            password = request.get(u'password', {}).get(u'_content')
+            ok = self.accounts is None or (
+                login in self.accounts and
+                self.accounts[login] in (None, password))
+        if not ok or (admin and login not in self.admins):
+            return fault(u'account.AUTH_FAILED', u'authentication failed')
+        return (u'AuthResponse', dict(
+            self.new_token(login),
+            xmlns=u'urn:zimbraAdmin' if admin else u'urn:zimbraAccount'))
+
+    def new_token(self, login):
+        '''Create a token for an account, return its response content'''
+        token = uuid.uuid4().hex
+        with self.lock:
+            self.tokens[token] = (login, time.time() + self.lifetime)
+        return {u'authToken': {u'_content': token},
+                u'lifetime': {u'_content': self.lifetime * 1000}}
+
+    def delegate_auth(self, login, request_type, request):
+        '''Create a token for an account, on behalf of an admin'''
+        if login not in self.admins:
+            return fault(u'service.PERM_DENIED', u'permission denied')
+        return (u'DelegateAuthResponse',
+                self.new_token(request[u'account'][u'_content']))
+
+    def get_filter_rules(self, login, request_type, request):
+        '''Return the incoming or outgoing filters of an account'''
+        filters = self.outgoing if u'Outgoing' in request_type \
+            else self.filters
+        with self.lock:
+            rules = filters.get(login, [])
+        return (request_type[:-len(u'Request')] + u'Response',
+                {u'filterRules': {u'filterRule': rules}})
+
+    def modify_filter_rules(self, login, request_type, request):
+        '''Replace the incoming or outgoing filters of an account'''
+        filters = self.outgoing if u'Outgoing' in request_type \
+            else self.filters
+        rules = as_list(request.get(u'filterRules', {}).get(u'filterRule'))
+        with self.lock:
+            filters[login] = rules
+        return (request_type[:-len(u'Request')] + u'Response', {})
+
+    def search(self, login, request_type, request):
+        '''Return a page of the messages matching a query'''
+        match = query_matcher(request[u'query'][u'_content'], self.timezone)
+        with self.lock:
+            messages = [m for m in self.messages.get(login, []) if match(m[1])]
+        messages.sort(key=lambda m: m[1],
+                      reverse=request.get(u'sortBy') == u'dateDesc')
+        offset = int(request.get(u'offset', 0))
+        page = messages[offset:offset + int(request.get(u'limit', 10))]
+        return (u'SearchResponse', {u'm': [
+            {u'id': unicode(i), u'd': unicode(timestamp * 1000)}
+            for (i, timestamp) in page]})
+
+    def apply_filter_rules(self, login, request_type, request):
+        '''Apply rules to the messages of a query or a list of ids, only
+        recording these messages, and moving them with fileinto'''
+        filters = self.outgoing if u'Outgoing' in request_type \
+            else self.filters
+        names = set(r[u'name'] for r in as_list(
+            request[u'filterRules'].get(u'filterRule')))
+        with self.lock:
+            known = set(r[u'name'] for r in filters.get(login, []))
+            messages = self.messages.get(login, [])
+        if not names or not names <= known:
+            return fault(u'service.INVALID_REQUEST', u'unknown filter')
+        if u'm' in request:
+            ids = request[u'm'][u'ids'].split(u',')
+        else:
+            match = query_matcher(request[u'query'][u'_content'],
+                                  self.timezone)
+            ids = [unicode(i) for (i, timestamp) in messages
+                   if match(timestamp)]
+        if len(ids) > self.apply_limit:
+            return fault(u'service.INVALID_REQUEST', u'too many messages')
+        with self.lock:
+            self.applied.setdefault(login, []).extend(ids)
+            if self.fileinto:
+                moved = set(ids)
+                self.messages[login] = [m for m in messages
+                                        if unicode(m[0]) not in moved]
+        content = {u'm': {u'ids': u','.join(ids)}} if ids else {}
+        return (request_type[:-len(u'Request')] + u'Response', content)
+
+    def get_folder(self, login, request_type, request):
+        '''Return the folder tree of an account'''
+        with self.lock:
+            paths = self.folders.get(login, DEFAULT_FOLDERS)
+            links = self.links.get(login, [])
+        return (u'GetFolderResponse', {u'folder': folder_tree(paths, links)})
+
+    def get_tag(self, login, request_type, request):
+        '''Return the tags of an account'''
+        with self.lock:
+            names = self.tags.get(login, [])
+        return (u'GetTagResponse', {u'tag': [
+            {u'id': unicode(i + 64), u'name': name}
+            for (i, name) in enumerate(names)]})
+
+
+def elements(node):
+    '''the child elements of a node'''
+    return [n for n in node.childNodes if n.nodeType == n.ELEMENT_NODE]
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    '''HTTP front end of the MockZimbra of the server'''
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length', 0))
+        (status, body) = self.server.zimbra.handle(self.rfile.read(length))
+        self.send_response(status)
+        self.send_header('Content-Type',
+                         'application/soap+xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        '''requests are counted by MockZimbra, not logged'''
+
+
+class MockServer(ThreadingMixIn, HTTPServer):
+    '''HTTP server answering each request in its own thread'''
+    daemon_threads = True
+
+    def __init__(self, zimbra, host=u'127.0.0.1', port=0):
+        HTTPServer.__init__(self, (host, port), MockHandler)
+        self.zimbra = zimbra
+        self.url = u'http://{0}:{1}/service/soap/'.format(
+            *self.server_address)
+
+
+def serve(zimbra, host=u'127.0.0.1', port=0):
+    '''Start a server in a background thread and return it
+
+    its url attribute is the URL of the SOAP API, call shutdown() to stop'''
+    server = MockServer(zimbra, host, port)
+    thread = threading.Thread(target=server.serve_forever,
+                              kwargs={'poll_interval': 0.05})
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    '''Run a mock Zimbra server until interrupted'''
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(u'accounts', nargs=u'*', metavar=u'login[:password]',
+                        help=u'accepted accounts, any account by default')
+    parser.add_argument(u'--host', default=u'127.0.0.1')
+    parser.add_argument(u'-p', u'--port', type=int, default=7070)
+    parser.add_argument(u'--latency', type=float, default=0.0,
+                        help=u'seconds added to each request')
+    parser.add_argument(u'--fault-rate', type=float, default=0.0,
+                        help=u'probability of a fault for each request')
+    parser.add_argument(u'--fault-code', default=u'service.FAILURE',
+                        help=u'code of the injected faults')
+    parser.add_argument(u'--lifetime', type=int, default=3600,
+                        help=u'lifetime of the tokens in seconds')
+    parser.add_argument(u'--preauth-key',
+                        help=u'preauth key of the domain of the accounts')
+    parser.add_argument(u'--admin', action=u'append', default=[],
+                        help=u'account allowed to use the admin API')
+    options = parser.parse_args()
+
+    accounts = None
+    if options.accounts:
+        accounts = dict((a.partition(u':')[0], a.partition(u':')[2] or None)
+                        for a in options.accounts)
+    zimbra = MockZimbra(accounts, options.latency, options.fault_rate,
+                        options.fault_code, options.lifetime,
+                        preauth_key=options.preauth_key, admins=options.admin)
+    server = MockServer(zimbra, options.host, options.port)
+    print(u'serving ' + server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(u', '.join(u'{0}: {1}'.format(*r)
+                     for r in sorted(zimbra.requests.items())))
+
+
+if __name__ == '__main__':
+    main()
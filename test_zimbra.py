@@ -1,12 +1,21 @@
-'''No unit tests for zimbratosthenes, only one big integration test
+'''Tests of zimbratosthenes
 
 Basically, a big ugly compound filter was built on Zimbra, then obtained
 through a request. We check that if translated to sieve and back we do not
-lose anything'''
+lose anything, with sievelib and with the fast path. The other tests cover
+the caches, the offline commands and, against the mock server of
+mock_zimbra, the commands talking to Zimbra. Their caches are kept in
+tmpdir.'''
 
-from io import StringIO
+from io import BytesIO, StringIO
+import json
+import os
+import subprocess
 import sys
 
+import pytest
+
+import mock_zimbra
 import zimbra
 
 
@@ -87,3 +96,886 @@ def test_zimbra_to_sieve_converter():
     assert len(dummy_result) == len(dummy_sieve)
     for i in xrange(0, len(dummy_sieve)):
         assert dummy_result[i] == dummy_sieve[i]
+
+
+def test_read_manifest():
+    '''Accounts, optional sieve file and server URL'''
+    jobs = zimbra.read_manifest([
+        u'# comment', u'', u'alice', u'bob bob.sieve',
+        u'carol - https://example.com/service/soap/'])
+    assert jobs == [
+        (u'alice', None, zimbra.DEFAULT_URL),
+        (u'bob', u'bob.sieve', zimbra.DEFAULT_URL),
+        (u'carol', None, u'https://example.com/service/soap/')]
+
+
+def test_fleet_download(monkeypatch, tmpdir):
+    '''Filters of every account are saved as sieve files'''
+    monkeypatch.setattr(zimbra, 'stream_rules',
+                        lambda comm, token: iter([dummy_rule]))
+    monkeypatch.setattr(zimbra, 'get_token', lambda url, login: u'token')
+    jobs = [(u'alice', None, zimbra.DEFAULT_URL),
+            (u'bob', None, zimbra.DEFAULT_URL)]
+    results = sorted(zimbra.run_fleet(jobs, 2, 1, outdir=unicode(tmpdir)))
+    assert [r[:2] for r in results] == [(u'alice', True), (u'bob', True)]
+    assert tmpdir.join(u'bob.sieve').read() == dummy_sieve
+
+
+def test_fleet_prompts(monkeypatch, tmpdir):
+    '''Passwords are asked before taking a slot, and only by the parent
+    of worker processes, interrupted downloads leave no temporary file'''
+    monkeypatch.setenv('ZBT_TOKEN_CACHE', str(tmpdir.join(u'tokens.json')))
+    monkeypatch.setattr(zimbra, '_no_prompt', [])
+    monkeypatch.setattr(zimbra, 'authenticate',
+                        lambda url, login, passwd: (u'fresh', 3600))
+    prompts = []
+    monkeypatch.setattr(zimbra.getpass, 'getpass', prompts.append)
+    jobs = [(u'alice', None, u'url'), (u'bob', None, u'url'),
+            (u'alice', u'alice.sieve', u'url')]
+    zimbra.fleet_tokens(jobs)
+    zimbra.fleet_tokens(jobs)
+    assert prompts == [u'Password for alice: ', u'Password for bob: ']
+
+    def broken(comm, token):
+        yield dummy_rule
+        raise IOError(u'connection reset')
+    monkeypatch.setattr(zimbra, 'stream_rules', broken)
+    results = list(zimbra.run_fleet(jobs[:1], outdir=unicode(tmpdir)))
+    assert results == [(u'alice', False, u'connection reset')]
+    assert tmpdir.listdir(lambda path: u'.sieve' in path.basename) == []
+
+    zimbra.init_fleet_worker({}, {})
+    assert zimbra.get_token(u'url', u'carol') is None
+    assert len(prompts) == 2
+
+
+def test_token_cache(monkeypatch, tmpdir):
+    '''Valid tokens are reused without prompting, expired ones are not'''
+    path = tmpdir.join(u'zbt', u'tokens.json')
+    monkeypatch.setenv('ZBT_TOKEN_CACHE', str(path))
+    monkeypatch.setattr(zimbra, 'authenticate',
+                        lambda url, login, passwd: (u'fresh', 3600))
+    monkeypatch.setattr(zimbra.getpass, 'getpass', lambda prompt: u'secret')
+    zimbra.store_token(zimbra.AuthToken(u'url', u'alice', u'cached',
+                                        zimbra.time.time() + 3600))
+    zimbra.store_token(zimbra.AuthToken(u'url', u'bob', u'old',
+                                        zimbra.time.time() + 10))
+    assert path.stat().mode & 0o777 == 0o600
+    assert zimbra.get_token(u'url', u'alice').value == u'cached'
+    assert zimbra.get_token(u'url', u'bob').value == u'fresh'
+    assert zimbra.cached_token(u'url', u'bob').value == u'fresh'
+
+
+def test_diff_rules():
+    '''Rules are compared whatever the form of their categories'''
+    same = dict(dummy_rule)
+    same[u'filterTests'] = dict(dummy_rule[u'filterTests'])
+    same[u'filterTests'][u'bodyTest'] = [{u'index': 6, u'value': u'baz'}]
+    other = dict(dummy_rule, name=u'other')
+    changed = dict(dummy_rule, active=u'1')
+    assert zimbra.diff_rules([dummy_rule], [same]) == []
+    assert zimbra.diff_rules([dummy_rule, other], [other, same]) == \
+        [(u'moved', u'other'), (u'moved', u'dummy')]
+    assert zimbra.diff_rules([dummy_rule, other], [changed]) == \
+        [(u'changed', u'dummy'), (u'removed', u'other')]
+    assert zimbra.diff_rules([], [other]) == [(u'added', u'other')]
+
+
+def test_display_rules_to_stream():
+    '''Rules are written to the given stream, one write per rule'''
+    writes = []
+
+    class Recorder(object):
+        def write(self, chunk):
+            writes.append(chunk)
+
+    zimbra.display_rules(iter([dummy_rule, dummy_rule]), Recorder())
+    assert len(writes) == 3
+    assert u''.join(writes[:2]) == dummy_sieve
+    assert u''.join(zimbra.show_rules([dummy_rule])) == dummy_sieve
+
+
+def test_address_round_trip():
+    '''Address tests, now registered, are converted both ways'''
+    sieve = u'''if anyof (
+   address :is :domain ["from"] ["example.com"]
+) {
+   stop;
+}
+'''
+    p = zimbra.init_parser()
+    assert p.parse(u'set "name" "a";\nset "active" "1";\n' + sieve)
+    rule = zimbra.zimbrify(p.result)[0]
+    assert rule[u'filterTests'][u'addressTest'][u'part'] == u'domain'
+    assert zimbra.show_rule(rule).endswith(sieve)
+
+
+def test_register_action():
+    '''New actions only need to be registered'''
+    zimbra.register_action(u'actionNotify', None, None,
+                           lambda action: u'notify "' + action[u'a'] + u'";')
+    try:
+        assert zimbra.show_actions(zimbra.items_from_dict(zimbra.Action, {
+            u'actionNotify': {u'index': u'1', u'a': u'me@example.com'},
+            u'actionStop': {u'index': u'2'}})) == \
+            u'   notify "me@example.com";\n   stop;\n'
+    finally:
+        del zimbra.action_renderers[u'actionNotify']
+
+
+def test_simulate_maildir(tmpdir):
+    '''Rules are run over a Maildir, stopping after a stop action'''
+    for sub in [u'cur', u'new', u'tmp']:
+        tmpdir.mkdir(sub)
+    tmpdir.join(u'new', u'1').write(
+        b'From: Foo <foo@example.com>\nSubject: Cheap PILLS\n'
+        b'Date: Tue, 1 Apr 2014 10:00:00 +0000\n\nbuy now\n')
+    tmpdir.join(u'new', u'2').write(
+        b'From: bar@example.org\nSubject: lunch?\n\nfizz\n')
+    rules = [
+        {u'name': u'spam', u'active': u'1',
+         u'filterTests': {u'condition': u'allof',
+                          u'headerTest': {u'index': u'0',
+                                          u'header': u'subject',
+                                          u'stringComparison': u'matches',
+                                          u'value': u'*pill?'},
+                          u'dateTest': {u'index': u'1', u'd': u'1388534400',
+                                        u'dateComparison': u'after'}},
+         u'filterActions': {u'actionFileInto': {u'index': u'0',
+                                                u'folderPath': u'Junk'},
+                            u'actionStop': {u'index': u'1'}}},
+        {u'name': u'example', u'active': u'1',
+         u'filterTests': {u'condition': u'anyof',
+                          u'addressTest': {u'index': u'0', u'header': u'from',
+                                           u'part': u'domain',
+                                           u'stringComparison': u'is',
+                                           u'value': u'EXAMPLE.org'},
+                          u'bodyTest': {u'index': u'1', u'value': u'fizz',
+                                        u'negative': u'1'}},
+         u'filterActions': {u'actionFlag': {u'index': u'0',
+                                            u'flagName': u'flagged'}}}]
+    for jobs in [1, 2]:
+        results = sorted(zimbra.simulate_rules(rules, unicode(tmpdir), jobs))
+        assert results == [
+            (u'new/1', [u'spam'], [u'fileinto "Junk";']),
+            (u'new/2', [u'example'], [u'addflag "\\\\Flagged";'])]
+
+
+def test_simulate_command(monkeypatch, tmpdir):
+    '''Hits are counted per rule, even for rules of the same name, and
+    names are written in UTF-8'''
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir))
+    tmpdir.join(u'mbox').write(b'From alice Tue Apr  1 10:00:00 2014\n'
+                               b'Subject: fizz\n\nbody\n')
+    rules = [dict(dummy_rule, name=u'\xe9t\xe9', active=u'1',
+                  filterTests={u'condition': u'anyof',
+                               u'bodyTest': {u'index': u'0',
+                                             u'value': u'body'}}),
+             dict(dummy_rule, name=u'\xe9t\xe9', active=u'1',
+                  filterTests={u'condition': u'anyof',
+                               u'bodyTest': {u'index': u'0',
+                                             u'value': u'nothing'}})]
+    tmpdir.join(u'rules.sieve').write_text(
+        u''.join(zimbra.show_rules(rules)), u'utf-8')
+    # like a pipe, the output has no encoding
+    monkeypatch.setattr(sys, 'stdout', BytesIO())
+    assert zimbra.simulate([str(tmpdir.join(u'rules.sieve')),
+                            str(tmpdir.join(u'mbox')), u'-j', u'1']) == 0
+    output = sys.stdout.getvalue().decode('utf-8')
+    assert output.splitlines()[-2:] == [u'  1\t\xe9t\xe9', u'  0\t\xe9t\xe9']
+
+
+def test_convert_cache(monkeypatch, tmpdir):
+    '''Unchanged sources are not parsed again, old entries are evicted'''
+    monkeypatch.setenv('ZBT_PARSE_CACHE', str(tmpdir))
+    assert zimbra.convert(dummy_sieve) == [dummy_rule]
+    monkeypatch.setattr(zimbra, 'init_parser', None)
+    assert zimbra.convert(dummy_sieve) == [dummy_rule]
+    assert len(tmpdir.listdir()) == 1
+    monkeypatch.setattr(zimbra, 'PARSE_CACHE_SIZE', 0)
+    zimbra.store_rules(u'other', [])
+    assert tmpdir.listdir() == []
+
+
+def test_fast_path(monkeypatch):
+    '''The fast path gives the same rules as sievelib, whatever the chunks'''
+    monkeypatch.setattr(zimbra, 'FAST_CHUNK_SIZE', 7)
+    assert list(zimbra.fast_rules(StringIO(dummy_sieve * 2))) == \
+        [dummy_rule, dummy_rule]
+
+
+def test_fast_path_corpus():
+    '''The fast path and sievelib convert a generated corpus identically,
+    also when the fast path gives up in the middle of it'''
+    import bench_zimbra
+    sieve = bench_zimbra.generate_sieve(300).encode('utf-8')
+    expected = zimbra.sievelib_rules(sieve)
+    assert len(expected) == 300
+    assert list(zimbra.fast_rules(BytesIO(sieve))) == expected
+    zimbra.stats.reset()
+    assert list(zimbra.sieve_rules(BytesIO(sieve))) == expected
+    assert u'fast_path_fallbacks' not in zimbra.stats.snapshot()[u'counters']
+    sieve += b'if allof (true) { keep; }\n'
+    expected = zimbra.sievelib_rules(sieve)
+    assert list(zimbra.sieve_rules(BytesIO(sieve))) == expected
+    assert zimbra.stats.snapshot()[u'counters'][u'fast_path_fallbacks'] == 1
+    assert list(zimbra.sieve_rules(BytesIO(b'if allof (true) {')))[-1] is None
+
+
+def test_fast_path_fallback():
+    '''Sieve outside of the fast path subset is parsed by sievelib'''
+    sieve = u'''require "fileinto";
+if allof (header :is ["a"] ["b"]) { fileinto "x"; }
+if allof (true) { keep; }
+'''
+    try:
+        list(zimbra.fast_rules(StringIO(sieve)))
+        assert False
+    except zimbra.FastPathUnsupported:
+        pass
+    rules = zimbra.convert_stream(StringIO(sieve))
+    assert len(rules) == 2
+    assert rules[1][u'filterTests'] == {u'condition': u'allof'}
+
+
+def test_stats(monkeypatch):
+    '''Phases and processed items are counted, and reported to hooks'''
+    events = []
+    monkeypatch.setattr(zimbra, 'stats', zimbra.Stats())
+    zimbra.stats.hooks.append(lambda *event: events.append(event))
+    zimbra.convert(dummy_sieve, cache=False)
+    zimbra.display_rules([dummy_rule], StringIO())
+    snapshot = zimbra.stats.snapshot()
+    assert snapshot[u'counters'][u'rules_converted'] == 1
+    assert snapshot[u'counters'][u'rules_rendered'] == 1
+    assert snapshot[u'spans'][u'render'][u'calls'] == 1
+    assert (u'counter', u'rules_converted', 1) in events
+    other = zimbra.Stats()
+    other.merge(snapshot)
+    other.merge(snapshot)
+    assert other.snapshot()[u'counters'][u'rules_rendered'] == 2
+
+
+def test_offline_conversion(monkeypatch, tmpdir):
+    '''Saved filters are converted to sieve and back without a server'''
+    monkeypatch.setenv('ZBT_PARSE_CACHE', str(tmpdir.join(u'cache')))
+    saved = tmpdir.join(u'rules.json')
+    saved.write(json.dumps({u'GetFilterRulesResponse': {
+        u'filterRules': {u'filterRule': dummy_rule}}}))
+    sieve = tmpdir.join(u'rules.sieve')
+    ndjson = tmpdir.join(u'rules.ndjson')
+    assert zimbra.to_sieve([str(saved), u'-o', str(sieve)]) == 0
+    assert sieve.read() == dummy_sieve
+    assert zimbra.to_zimbra([str(sieve), u'--ndjson', u'-o', str(ndjson)]) \
+        == 0
+    assert [json.loads(line) for line in ndjson.readlines()] == [dummy_rule]
+    assert zimbra.to_sieve([str(ndjson), u'--ndjson', u'-o', str(sieve)]) \
+        == 0
+    assert sieve.read() == dummy_sieve
+
+
+def test_to_zimbra_streaming(monkeypatch, tmpdir):
+    '''NDJSON rules are written as the sieve rules are read'''
+    class Interrupted(object):
+        def __init__(self):
+            self.chunks = [(dummy_sieve + u'set "name" "next";\n').encode(
+                'utf-8')]
+
+        def read(self, size=-1):
+            if not self.chunks:
+                raise IOError(u'interrupted')
+            return self.chunks.pop()
+    monkeypatch.setattr(zimbra.sys, 'stdin', Interrupted())
+    ndjson = tmpdir.join(u'rules.ndjson')
+    try:
+        zimbra.to_zimbra([u'--ndjson', u'-o', str(ndjson)])
+        assert False
+    except IOError:
+        pass
+    assert [json.loads(line) for line in ndjson.readlines()] == [dummy_rule]
+
+
+def test_mock_server(monkeypatch, tmpdir):
+    '''Fleet synchronizations against a local mock server, with a fault
+    forcing a new authentication'''
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir))
+    monkeypatch.setattr(zimbra.getpass, 'getpass', lambda prompt: u'secret')
+    mock = mock_zimbra.MockZimbra({u'alice': u'secret', u'bob': u'secret'},
+                                  latency=0.01)
+    mock.filters[u'alice'] = [dummy_rule]
+    mock.folders[u'bob'] = [u'.pipe']
+    mock.tags[u'bob'] = [u'Old']
+    server = mock_zimbra.serve(mock)
+    try:
+        tmpdir.join(u'bob.sieve').write(dummy_sieve)
+        jobs = zimbra.read_manifest([u'alice', u'bob ' + str(tmpdir.join(
+            u'bob.sieve'))], server.url)
+        results = sorted(zimbra.run_fleet(jobs, 4, 1, outdir=str(tmpdir)))
+        assert [r[:2] for r in results] == [(u'alice', True), (u'bob', True)]
+        assert tmpdir.join(u'alice.sieve').read() == dummy_sieve
+        assert mock.max_active == 1
+
+        mock.filters[u'alice'] = []
+        jobs = [(u'alice', str(tmpdir.join(u'bob.sieve')), server.url)]
+        results = list(zimbra.run_fleet(jobs, outdir=str(tmpdir)))
+        assert results[0][1:] == (
+            False, u'unknown folder .pipe in rule dummy, '
+            u'unknown tag Old in rule dummy')
+        assert mock.requests[u'ModifyFilterRulesRequest'] == 1
+        # the cached folders and tags are checked again before refusing
+        list(zimbra.run_fleet(jobs, outdir=str(tmpdir)))
+        assert mock.requests[u'GetFolderRequest'] == 3
+        mock.folders[u'alice'] = [u'.pipe']
+        mock.tags[u'alice'] = [u'Old']
+        results = list(zimbra.run_fleet(jobs, outdir=str(tmpdir)))
+        assert results[0][1] is True
+        assert mock.requests[u'GetFolderRequest'] == 4
+
+        mock.fail(u'GetFilterRulesRequest', u'service.AUTH_EXPIRED')
+        results = list(zimbra.run_fleet([(u'bob', None, server.url)],
+                                        outdir=str(tmpdir)))
+        assert results[0][:2] == (u'bob', True)
+        assert tmpdir.join(u'bob.sieve').read() == dummy_sieve
+        assert mock.requests[u'AuthRequest'] == 3
+        assert mock.requests[u'GetFolderRequest'] == 4
+    finally:
+        server.shutdown()
+
+
+def test_fetch_account(monkeypatch, tmpdir):
+    '''Filters, folders and tags are fetched in a single batch, renewing
+    the token if needed, mounted shared folders included'''
+    monkeypatch.setenv('ZBT_TOKEN_CACHE', str(tmpdir.join(u'tokens.json')))
+    monkeypatch.setenv('ZBT_SNAPSHOTS', str(tmpdir.join(u'snapshots')))
+    monkeypatch.setattr(zimbra.getpass, 'getpass', lambda prompt: u'')
+    mock = mock_zimbra.MockZimbra()
+    mock.filters[u'alice'] = [dummy_rule]
+    mock.folders[u'alice'] = [u'Inbox', u'Lists/dev', u'Team/dev']
+    mock.links[u'alice'] = [u'Team']
+    mock.tags[u'alice'] = [u'Work']
+    server = mock_zimbra.serve(mock)
+    try:
+        token = zimbra.get_token(server.url, u'alice')
+        mock.fail(u'GetTagRequest', u'service.AUTH_EXPIRED')
+        account = zimbra.fetch_account(zimbra.get_connection(server.url),
+                                       token)
+    finally:
+        server.shutdown()
+    assert mock.requests[u'BatchRequest'] == 2
+    assert mock.requests[u'AuthRequest'] == 2
+    assert zimbra.filter_rules(account[u'GetFilterRulesRequest']) == \
+        [dummy_rule]
+    assert zimbra.filter_rules(account[u'GetOutgoingFilterRulesRequest']) \
+        == []
+    folders = zimbra.folder_paths(account[u'GetFolderRequest'])
+    assert folders == set([u'Inbox', u'Lists', u'Lists/dev', u'Team',
+                           u'Team/dev'])
+    assert zimbra.folder_paths({u'folder': {
+        u'absFolderPath': u'/', u'search': {u'absFolderPath': u'/Unread'}}}) \
+        == set([u'Unread'])
+    tags = zimbra.tag_names(account[u'GetTagRequest'])
+    assert tags == set([u'Work'])
+    index = zimbra.TargetIndex(folders, tags)
+    assert index.missing_folder(u'/lists/DEV') is None
+    assert index.missing_folder(u'Lists/dve') == u'Lists'
+    assert index.missing_folder(u'Team/dev') is None
+    assert index.problems([dummy_rule]) == [
+        u'unknown folder .pipe in rule dummy',
+        u'unknown tag Old in rule dummy']
+
+
+def test_empty_targets(monkeypatch, tmpdir):
+    '''An account without folders nor tags is not fetched again'''
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir))
+    account = {u'GetFolderRequest': {}, u'GetTagRequest': {}}
+    index = zimbra.account_targets(None, None, u'url', u'alice', account)
+    assert index.problems([dummy_rule]) == [
+        u'unknown folder .pipe in rule dummy',
+        u'unknown tag Old in rule dummy']
+
+
+def test_watch(monkeypatch, tmpdir):
+    '''Watched sieve files are parsed again when they change, and only
+    uploaded when their rules differ from the last uploaded ones'''
+    monkeypatch.setenv('ZBT_PARSE_CACHE', str(tmpdir.join(u'parsed')))
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir))
+    monkeypatch.setattr(zimbra.getpass, 'getpass', lambda prompt: u'')
+    sieve = tmpdir.join(u'rules.sieve')
+    sieve.write(dummy_sieve)
+    writes = []
+
+    def sleep(seconds):
+        '''edit the file once while debouncing'''
+        if not writes:
+            writes.append(seconds)
+            sieve.write(dummy_sieve.replace(u'"dummy"', u'"other"'))
+
+    rules = zimbra.watch_rules([str(sieve)], sleep=sleep)
+    assert [r[u'name'] for r in next(rules)] == [u'other']
+    sieve.write(dummy_sieve + u'\n')
+    assert next(rules) == [dummy_rule]
+
+    mock = mock_zimbra.MockZimbra()
+    mock.folders[u'alice'] = [u'.pipe']
+    mock.tags[u'alice'] = [u'Old']
+    server = mock_zimbra.serve(mock)
+    try:
+        token = zimbra.get_token(server.url, u'alice')
+        comm = zimbra.get_connection(server.url)
+        assert zimbra.push_rules(comm, token, [], [dummy_rule])
+        assert not zimbra.push_rules(comm, token, [dummy_rule], [dummy_rule])
+    finally:
+        server.shutdown()
+    assert mock.filters[u'alice'] == [dummy_rule]
+    assert mock.requests[u'ModifyFilterRulesRequest'] == 1
+
+
+def test_blocklist(monkeypatch, tmpdir):
+    '''Blocked senders are sharded over stable rules, and queued changes
+    are uploaded at once'''
+    blocklist = zimbra.Blocklist(u'spam', shard_size=2)
+    for value in [u'a@x.org', u'B@x.org', u'c@x.org', u'y.org']:
+        assert blocklist.add(value)
+    assert not blocklist.add(u'b@X.org')
+    assert blocklist.remove(u'a@x.org') and not blocklist.remove(u'a@x.org')
+    assert blocklist.add(u'd@x.org')
+    assert [sorted(s) for s in blocklist.shards] == \
+        [[u'b@x.org', u'd@x.org'], [u'c@x.org', u'y.org']]
+    actions = zimbra.block_actions(u'Junk')
+    rules = blocklist.rules(actions)
+    assert [r[u'name'] for r in rules] == [u'spam 1', u'spam 2']
+    assert rules[1][u'filterTests'][u'addressTest'][1][u'part'] == u'domain'
+    assert zimbra.Blocklist.from_rules(u'spam', rules, 2).shards == \
+        blocklist.shards
+
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir))
+    monkeypatch.setenv('ZBT_PARSE_CACHE', str(tmpdir.join(u'parsed')))
+    monkeypatch.setenv('USER', 'alice')
+    monkeypatch.setattr(zimbra.getpass, 'getpass', lambda prompt: u'')
+    mock = mock_zimbra.MockZimbra()
+    mock.filters[u'alice'] = [dummy_rule]
+    server = mock_zimbra.serve(mock)
+    monkeypatch.setenv('ZBT_URL', str(server.url))
+    try:
+        assert zimbra.block([u'--defer', u'a@x.org', u'b@x.org']) == 0
+        assert zimbra.block([u'--defer', u'-r', u'a@x.org']) == 0
+        assert u'ModifyFilterRulesRequest' not in mock.requests
+        assert zimbra.block([u'c@x.org']) == 0
+        assert mock.requests[u'ModifyFilterRulesRequest'] == 1
+        assert [r[u'name'] for r in mock.filters[u'alice']] == \
+            [u'blocklist 1', u'dummy']
+        assert zimbra.block([u'b@x.org']) == 0
+        assert mock.requests[u'ModifyFilterRulesRequest'] == 1
+    finally:
+        server.shutdown()
+    (local, pending) = zimbra.load_blocklist(server.url, u'alice',
+                                             u'blocklist')
+    assert sorted(local.index) == [u'b@x.org', u'c@x.org'] and not pending
+
+
+def test_parse_files(monkeypatch, tmpdir):
+    '''Files and directories are merged in order, parsed in parallel and
+    taken from the cache once parsed'''
+    monkeypatch.setenv('ZBT_PARSE_CACHE', str(tmpdir.join(u'parsed')))
+    topics = tmpdir.mkdir(u'topics')
+    for name in [u'b', u'a', u'c/d']:
+        topics.join(name + u'.sieve').write(
+            dummy_sieve.replace(u'"dummy"', u'"' + name + u'"'),
+            ensure=True)
+    topics.join(u'README').write(u'not sieve')
+    tmpdir.join(u'first.sieve').write(dummy_sieve)
+    paths = [str(tmpdir.join(u'first.sieve')), str(topics)]
+    zimbra.stats.reset()
+    rules = zimbra.parse_files(paths, jobs=2)
+    assert [r[u'name'] for r in rules] == [u'dummy', u'a', u'b', u'c/d']
+    assert rules[0] == dummy_rule
+    assert zimbra.stats.snapshot()[u'counters'][u'rules_converted'] == 4
+    assert zimbra.parse_files(paths) == rules
+    assert zimbra.stats.snapshot()[u'counters'][u'parse_cache_hits'] == 4
+    topics.join(u'a.sieve').write(u'if foo;')
+    assert zimbra.parse_files(paths, jobs=1) is None
+
+
+def test_stream_rules(monkeypatch, tmpdir):
+    '''Rules are parsed one at a time as they are received, like the
+    responses of pythonzimbra'''
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir))
+    monkeypatch.setattr(zimbra.getpass, 'getpass', lambda prompt: u'')
+    other = dict(dummy_rule, name=u'caf\xe9 \u2603')
+    mock = mock_zimbra.MockZimbra()
+    mock.filters[u'alice'] = [dummy_rule, other] * 50
+    server = mock_zimbra.serve(mock)
+    try:
+        token = zimbra.get_token(server.url, u'alice')
+        comm = zimbra.get_connection(server.url)
+        mock.fail(u'GetFilterRulesRequest', u'service.AUTH_EXPIRED')
+        rules = zimbra.stream_rules(comm, token)
+        assert mock.requests[u'AuthRequest'] == 2
+        assert next(rules) == dummy_rule
+        assert list(rules) == zimbra.filter_rules(
+            zimbra.fetch_rules(comm, token))[1:]
+        # the soap phase covers the whole response, not the consumer
+        zimbra.stats.reset()
+        slept = 0.0
+        start = zimbra.time.time()
+        for rule in zimbra.stream_rules(comm, token):
+            before = zimbra.time.time()
+            zimbra.time.sleep(0.002)
+            slept += zimbra.time.time() - before
+        elapsed = zimbra.time.time() - start
+        soap = zimbra.stats.snapshot()[u'spans'][u'soap']
+        assert soap[u'calls'] == 1
+        assert 0 < soap[u'seconds'] <= elapsed - slept
+        mock.fail(u'GetFilterRulesRequest', u'service.FAILURE')
+        assert zimbra.stream_rules(comm, token) is None
+        assert list(zimbra.stream_rules(comm, token, outgoing=True)) == []
+    finally:
+        server.shutdown()
+
+
+def test_minted_tokens(monkeypatch, tmpdir):
+    '''Tokens are minted with a preauth key or by an admin, without
+    prompting for the passwords of the accounts'''
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir))
+    monkeypatch.setattr(zimbra, '_minted_tokens', {})
+    prompts = []
+    monkeypatch.setattr(zimbra.getpass, 'getpass',
+                        lambda prompt: prompts.append(prompt) or u'secret')
+    mock = mock_zimbra.MockZimbra({u'admin': u'secret'},
+                                  preauth_key=u'0123abcd', admins=[u'admin'])
+    server = mock_zimbra.serve(mock)
+    jobs = [(login, None, server.url) for login in u'abcdefgh']
+    try:
+        tmpdir.join(u'key').write(u'0123abcd\n')
+        monkeypatch.setenv('ZBT_PREAUTH_KEY_FILE', str(tmpdir.join(u'key')))
+        results = list(zimbra.run_fleet(jobs, 4, 4, outdir=str(tmpdir)))
+        assert all(ok for (_, ok, _) in results)
+        assert mock.requests[u'AuthRequest'] == 8
+        token = zimbra.get_token(server.url, u'a')
+        assert token.minted and mock.requests[u'AuthRequest'] == 8
+        assert zimbra.cached_token(server.url, u'a') is None
+
+        monkeypatch.setenv('ZBT_PREAUTH_KEY', 'wrong')
+        monkeypatch.delenv('ZBT_PREAUTH_KEY_FILE')
+        assert zimbra.get_token(server.url, u'a', cache=False) is None
+
+        monkeypatch.delenv('ZBT_PREAUTH_KEY')
+        monkeypatch.setenv('ZBT_ADMIN', 'admin')
+        monkeypatch.setenv('ZBT_ADMIN_URL', str(server.url))
+        monkeypatch.setattr(zimbra, '_minted_tokens', {})
+        results = list(zimbra.run_fleet(jobs, 4, 4, outdir=str(tmpdir)))
+        assert all(ok for (_, ok, _) in results)
+        assert mock.requests[u'DelegateAuthRequest'] == 8
+        assert prompts == [u'Password for admin: ']
+        assert zimbra.read_token_cache() == {}
+
+        # an unknown account is not a reason to renew the admin token
+        mock.fail(u'DelegateAuthRequest', u'account.NO_SUCH_ACCOUNT')
+        results = list(zimbra.run_fleet([(u'nobody', None, server.url)], 4, 4,
+                                        outdir=str(tmpdir)))
+        assert results == [(u'nobody', False, u'authentication failed')]
+        assert len(prompts) == 1
+
+        # an expired admin token is renewed once for all the workers
+        mock.expire_tokens()
+        for login in u'abcdefgh':
+            del zimbra._minted_tokens[(server.url, login)]
+        results = list(zimbra.run_fleet(jobs, 4, 4, outdir=str(tmpdir)))
+        assert all(ok for (_, ok, _) in results)
+        assert len(prompts) == 2
+
+        # a refused admin password is only asked once
+        monkeypatch.setattr(zimbra, '_minted_tokens', {})
+        monkeypatch.setattr(zimbra.getpass, 'getpass',
+                            lambda prompt: prompts.append(prompt) or u'wrong')
+        results = list(zimbra.run_fleet(jobs, 4, 4, outdir=str(tmpdir)))
+        assert not any(ok for (_, ok, _) in results)
+        assert len(prompts) == 3
+    finally:
+        server.shutdown()
+    from pythonzimbra.tools.preauth import create_preauth
+    assert zimbra.preauth_value(u'john.doe@domain.com', u'0123abcd',
+                                1135280708088) == \
+        create_preauth(u'john.doe@domain.com', u'0123abcd',
+                       timestamp=1135280708088)
+    monkeypatch.delenv('ZBT_ADMIN_URL')
+    assert zimbra.admin_url(u'https://mail.example.com/service/soap/') == \
+        u'https://mail.example.com:7071/service/admin/soap/'
+
+
+def test_apply_rules(monkeypatch, tmpdir, capsys):
+    '''Rules are applied by chunks of days, halved when too large, or of
+    message ids, and an interrupted run is resumed'''
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir))
+    monkeypatch.setenv('USER', 'alice')
+    monkeypatch.setattr(zimbra.getpass, 'getpass', lambda prompt: u'')
+    mock = mock_zimbra.MockZimbra()
+    mock.filters[u'alice'] = [dummy_rule]
+    # every 13 hours from 2014-01-01 at 5:00 UTC
+    mock.messages[u'alice'] = [(i, 1388552400 + i * 46800)
+                               for i in range(100)]
+    mock.apply_limit = 10
+    ids = sorted(unicode(i) for i in range(100))
+    server = mock_zimbra.serve(mock)
+    monkeypatch.setenv('ZBT_URL', str(server.url))
+    try:
+        assert zimbra.apply_rules([u'--until', u'2014-03-01', u'--days',
+                                   u'14', u'dummy']) == 0
+        assert sorted(mock.applied[u'alice']) == ids
+        assert mock.requests[u'ApplyFilterRulesRequest'] > 5
+
+        mock.applied[u'alice'] = []
+        mock.apply_limit = 30
+        mock.fail(u'ApplyFilterRulesRequest', u'service.FAILURE')
+        assert zimbra.apply_rules([u'--batch', u'30', u'dummy']) == 1
+        assert len(mock.applied[u'alice']) in (70, 90)
+        assert zimbra.apply_rules([u'--batch', u'30', u'dummy']) == 0
+        assert sorted(mock.applied[u'alice']) == ids
+        assert zimbra.apply_rules([u'other']) == 1
+
+        # a later --until is another run, its last chunk is longer
+        mock.applied[u'alice'] = []
+        assert zimbra.apply_rules([u'--until', u'2014-02-01', u'dummy']) == 0
+        assert zimbra.apply_rules([u'--until', u'2014-03-01', u'dummy']) == 0
+        assert sorted(set(mock.applied[u'alice'])) == ids
+
+        # the first message, 2014-01-01 at 5:00 UTC, is on 2013-12-31 for
+        # an account 10 hours west of UTC
+        mock.timezone = -36000
+        mock.applied[u'alice'] = []
+        assert zimbra.apply_rules([u'--restart', u'dummy']) == 0
+        assert sorted(mock.applied[u'alice']) == ids
+
+        # the rules move messages out of the query, the chunks of a resumed
+        # run are those of the first one
+        mock.fileinto = True
+        mock.applied[u'alice'] = []
+        mock.fail(u'ApplyFilterRulesRequest', u'service.FAILURE')
+        assert zimbra.apply_rules([u'--batch', u'30', u'dummy']) == 1
+        searches = mock.requests[u'SearchRequest']
+        capsys.readouterr()
+        assert zimbra.apply_rules([u'--batch', u'30', u'dummy']) == 0
+        assert u'4 chunks, 3 already done' in capsys.readouterr()[1]
+        assert mock.requests[u'SearchRequest'] == searches
+        assert sorted(mock.applied[u'alice']) == ids
+        assert mock.messages[u'alice'] == []
+    finally:
+        server.shutdown()
+    assert not tmpdir.join(u'zbt', u'apply').listdir()
+
+
+def test_rule_model():
+    '''the slotted model converts losslessly to and from the SOAP form'''
+    rule = zimbra.Rule.from_dict(dummy_rule)
+    assert rule.to_dict() == dummy_rule
+    assert zimbra.Rule.from_dict(rule.to_dict(lists=True)) == rule
+    assert [test.index for test in rule.tests] == range(8)
+    assert [action.category for action in rule.actions][:2] == \
+        [u'actionKeep', u'actionTag']
+    assert not hasattr(rule.tests[0], '__dict__')
+    extra = dict(dummy_rule, filterVariables={u'index': u'0'})
+    assert zimbra.Rule.from_dict(extra).to_dict() == extra
+
+
+def test_optimize_rules():
+    '''redundant tests, shadowed and mergeable rules are optimized'''
+    def rule(name, condition, tests, actions):
+        return zimbra.Rule(
+            name, u'1', condition,
+            zimbra.reindexed(zimbra.Test, [zimbra.Test(c, None, t)
+                                           for (c, t) in tests]),
+            zimbra.reindexed(zimbra.Action, [zimbra.Action(c, None, {})
+                                             for c in actions])).to_dict()
+
+    def header(value, comparison=u'contains', name=u'List-Id'):
+        return (u'headerTest', {u'header': name, u'value': value,
+                                u'stringComparison': comparison})
+
+    rules = [
+        rule(u'lists', u'anyof', [header(u'dev'), header(u'dev'),
+                                  header(u'Dev.example')],
+             [u'actionDiscard', u'actionStop']),
+        rule(u'dev', u'allof', [header(u'<dev.example.com>', u'is'),
+                                header(u'x', name=u'Subject')],
+             [u'actionKeep']),
+        rule(u'alice', u'anyof', [header(u'alice', name=u'From')],
+             [u'actionKeep', u'actionKeep']),
+        rule(u'bob', u'anyof', [header(u'bob', name=u'From')],
+             [u'actionKeep']),
+    ]
+    (optimized, report) = zimbra.optimize_rules(rules)
+    assert report == [
+        u'removed 2 redundant tests and 0 duplicate actions from rule lists',
+        u'removed rule dev, never reached after rule lists',
+        u'removed 0 redundant tests and 1 duplicate actions from rule alice',
+        u'merged rule bob into rule alice']
+    assert [r[u'name'] for r in optimized] == [u'lists', u'alice']
+    assert optimized[0][u'filterTests'][u'headerTest'][u'value'] == u'dev'
+    assert [t[u'value'] for t in
+            optimized[1][u'filterTests'][u'headerTest']] == [u'alice', u'bob']
+    assert zimbra.optimize_rules(optimized) == (optimized, [])
+    assert zimbra.optimize_rules([dummy_rule]) == ([dummy_rule], [])
+
+
+def test_snapshots(monkeypatch, tmpdir, capsys):
+    '''fetched and uploaded filters are stored once per rule, shown offline
+    and rolled back, even after changes the snapshots do not know about'''
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir))
+    monkeypatch.setenv('USER', 'alice')
+    monkeypatch.setattr(zimbra.getpass, 'getpass', lambda prompt: u'')
+    mock = mock_zimbra.MockZimbra()
+    mock.filters[u'alice'] = [dummy_rule]
+    mock.folders[u'alice'] = [u'.pipe']
+    mock.tags[u'alice'] = [u'Old']
+    other = dict(dummy_rule, name=u'other')
+    server = mock_zimbra.serve(mock)
+    monkeypatch.setenv('ZBT_URL', str(server.url))
+    try:
+        token = zimbra.get_token(server.url, u'alice')
+        comm = zimbra.get_connection(server.url)
+        assert list(zimbra.stream_rules(comm, token)) == [dummy_rule]
+        assert zimbra.upload_rules(
+            comm, token,
+            {u'filterRules': {u'filterRule': [dummy_rule, other]}},
+            {u'filterRules': {u'filterRule': [dummy_rule]}})
+        zimbra.fetch_account(comm, token, zimbra.FILTER_REQUESTS)
+        entries = zimbra.read_snapshots(server.url, u'alice')
+        assert [(e[u'kind'], e[u'rules']) for e in entries] == \
+            [(u'fetched', 1), (u'uploaded', 2), (u'fetched', 0)]
+        assert entries[2][u'outgoing']
+        # two rules and three lists of rules, the empty one included
+        assert len(list(tmpdir.join(u'zbt', u'snapshots', u'objects').visit(
+            u'*.json'))) == 5
+
+        assert zimbra.snapshots([u'rollback', entries[0][u'id'][:8]]) == 0
+        assert not zimbra.diff_rules([dummy_rule], mock.filters[u'alice'])
+        assert zimbra.latest_snapshot(server.url, u'alice')[u'id'] == \
+            entries[0][u'id']
+
+        # the filters are changed on the server, e.g. in the web interface
+        mock.filters[u'alice'] = [other]
+        assert zimbra.snapshots([u'rollback', entries[0][u'id'][:8]]) == 0
+        assert not zimbra.diff_rules([dummy_rule], mock.filters[u'alice'])
+
+        # without the current filters, the latest snapshot is compared
+        requests = dict(mock.requests)
+        mock.filters[u'alice'] = [other]
+        mock.fail(u'GetFilterRulesRequest', u'service.FAILURE')
+        assert zimbra.snapshots([u'rollback', entries[0][u'id'][:8]]) == 0
+        assert mock.requests.get(u'ModifyFilterRulesRequest') == \
+            requests.get(u'ModifyFilterRulesRequest')
+        assert mock.filters[u'alice'] == [other]
+    finally:
+        server.shutdown()
+    output = tmpdir.join(u'uploaded.sieve')
+    assert zimbra.snapshots([u'show', entries[1][u'id'][:8],
+                             u'-o', str(output)]) == 0
+    assert zimbra.convert(output.read_text(u'utf-8'), cache=False) == \
+        [dummy_rule, other]
+    capsys.readouterr()
+    assert zimbra.snapshots([]) == 0
+    # the changed filters were recorded when fetched by the rollback
+    assert len(capsys.readouterr()[0].splitlines()) == 6
+    assert zimbra.snapshots([u'show', u'none']) == 1
+
+
+def test_drift(monkeypatch, tmpdir):
+    '''accounts are compared with their template rule by rule, whatever the
+    form of the rules'''
+    spam = dict(dummy_rule, name=u'spam')
+    lists = dict(dummy_rule, name=u'lists', active=u'1')
+    template = zimbra.RuleTemplate([spam, lists])
+    assert template.drift(zimbra.canonical_rule(r) for r in [lists, spam]) \
+        == ([], [], [])
+    mine = dict(dummy_rule, name=u'mine')
+    assert template.drift([dict(spam, active=u'1'), mine]) == \
+        ([u'lists'], [u'mine'], [u'spam'])
+    assert template.drift([spam, spam, lists]) == ([], [u'spam'], [])
+
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir))
+    monkeypatch.setattr(zimbra.getpass, 'getpass', lambda prompt: u'')
+    mock = mock_zimbra.MockZimbra()
+    mock.filters[u'alice'] = [spam, lists]
+    mock.filters[u'bob'] = [lists, mine]
+    mock.filters[u'dave'] = [spam, dict(dummy_rule, name=u'caf\xe9')]
+    server = mock_zimbra.serve(mock)
+    monkeypatch.setenv('ZBT_URL', str(server.url))
+    sieve = tmpdir.join(u'template.sieve')
+    sieve.write_text(u''.join(zimbra.show_rules([spam, lists])), u'utf-8')
+    manifest = tmpdir.join(u'manifest')
+    manifest.write(u'alice\nbob\ncarol ' + str(sieve) + u'\n')
+    try:
+        # like a pipe, the output has no encoding
+        monkeypatch.setattr(sys, 'stdout', BytesIO())
+        assert zimbra.drift([u'-t', str(sieve), u'--ndjson',
+                             str(manifest)]) == 0
+        report = sorted(json.loads(line)
+                        for line in sys.stdout.getvalue().splitlines())
+        manifest.write(u'dave\n')
+        monkeypatch.setattr(sys, 'stdout', BytesIO())
+        assert zimbra.drift([u'-t', str(sieve), str(manifest)]) == 0
+        assert sys.stdout.getvalue().decode('utf-8') == (
+            u'dave\tdrifted\tmissing "lists"; extra "caf\xe9"\n')
+    finally:
+        server.shutdown()
+    assert report == [
+        {u'account': u'alice', u'missing': [], u'extra': [],
+         u'modified': []},
+        {u'account': u'bob', u'missing': [u'spam'], u'extra': [u'mine'],
+         u'modified': []},
+        {u'account': u'carol', u'missing': [u'spam', u'lists'], u'extra': [],
+         u'modified': []}]
+    assert zimbra.drift([str(manifest)]) == 1
+
+
+def test_main_url(monkeypatch, capsys):
+    '''The server URL is given with --url URL or --url=URL, anywhere in the
+    command line, and is required after --url'''
+    monkeypatch.setenv('ZBT_URL', 'http://default/')
+    seen = []
+    monkeypatch.setitem(zimbra.commands, u'snapshots',
+                        lambda args: seen.append((args, zimbra.server_url()))
+                        or 0)
+    for args in ([u'--url', u'http://a/', u'snapshots', u'list'],
+                 [u'snapshots', u'list', u'--url=http://a/']):
+        monkeypatch.setattr(sys, 'argv', [u'zbt'] + args)
+        with pytest.raises(SystemExit) as e:
+            zimbra.main()
+        assert e.value.code == 0
+    assert seen == [([u'list'], u'http://a/')] * 2
+    for args in ([u'snapshots', u'--url'], [u'--url=', u'snapshots']):
+        monkeypatch.setattr(sys, 'argv', [u'zbt'] + args)
+        with pytest.raises(SystemExit) as e:
+            zimbra.main()
+        assert e.value.code == 1
+        assert u'Usage:' in capsys.readouterr()[0]
+    assert len(seen) == 2
+
+
+def test_import_budget():
+    '''Usage, rendering and fast path conversions do not import the SOAP
+    stack nor sievelib, and importing zimbra stays quick
+
+    the budget is a generous second, as the time depends on the load of the
+    machine, $ZBT_IMPORT_BUDGET can set a tighter one'''
+    child = subprocess.Popen([sys.executable, '-B', '-c', '''
+import json, sys, time
+start = time.time()
+import zimbra
+elapsed = time.time() - start
+zimbra.display_rules(zimbra.convert(sys.stdin.read(), cache=False),
+                     zimbra.io.StringIO())
+try:
+    zimbra.usage()
+except SystemExit:
+    pass
+heavy = [m for m in sys.modules if m.split('.')[0] in
+         ('pythonzimbra', 'sievelib', 'email', 'multiprocessing', 'xml')]
+print(json.dumps([elapsed, sorted(heavy)]))
+'''], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             cwd=os.path.dirname(zimbra.__file__) or '.')
+    output = child.communicate(dummy_sieve.encode('utf-8'))[0]
+    assert b'Usage:' in output
+    (elapsed, heavy) = json.loads(output.splitlines()[-1])
+    assert heavy == []
+    assert elapsed < float(os.getenv('ZBT_IMPORT_BUDGET') or 1.0)
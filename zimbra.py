@@ -1,72 +1,257 @@
 # python 2.7
 from __future__ import print_function
 
+import atexit
+import codecs
 import getpass
+import hashlib
+import hmac
+import io
+import json
+import operator
+import re
 import sys
 import os
-from datetime import date, datetime
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
 from os.path import basename
 
-from pythonzimbra.tools import auth
-from pythonzimbra.request_xml import RequestXml
-from pythonzimbra.response_xml import ResponseXml
-from pythonzimbra.communication import Communication
+# pythonzimbra, sievelib, argparse, email and multiprocessing are only
+# imported by the functions needing them, so that short runs start quickly
+
+DEFAULT_URL = u'https://zimbra.inria.fr/service/soap/'
+
+
+class Stats(object):
+    '''Counters and phase timings of a run
+
+    hooks are called with ('counter', name, increment) or ('span', name,
+    seconds) for each event, so that they can be scraped by monitoring'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hooks = []
+        self.reset()
+
+    def reset(self):
+        '''forget everything counted so far'''
+        with self.lock:
+            self.counters = {}
+            self.spans = {}
+
+    def count(self, name, increment=1):
+        '''add to a counter'''
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + increment
+        for hook in self.hooks:
+            hook(u'counter', name, increment)
+
+    @contextmanager
+    def span(self, name):
+        '''time a phase, spans of the same phase are added together'''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_span(name, time.time() - start)
+
+    def add_span(self, name, elapsed):
+        '''add the time of a phase measured by the caller'''
+        with self.lock:
+            (calls, total) = self.spans.get(name, (0, 0.0))
+            self.spans[name] = (calls + 1, total + elapsed)
+        for hook in self.hooks:
+            hook(u'span', name, elapsed)
+
+    def snapshot(self):
+        '''return the counters and spans as a JSON-serializable dict'''
+        with self.lock:
+            return {
+                u'counters': dict(self.counters),
+                u'spans': dict((name, {u'calls': calls, u'seconds': total})
+                               for (name, (calls, total)) in
+                               self.spans.items())
+            }
+
+    def merge(self, snapshot):
+        '''add the snapshot of another process, e.g. a worker'''
+        for (name, increment) in snapshot[u'counters'].items():
+            self.count(name, increment)
+        with self.lock:
+            for (name, span) in snapshot[u'spans'].items():
+                (calls, total) = self.spans.get(name, (0, 0.0))
+                self.spans[name] = (calls + span[u'calls'],
+                                    total + span[u'seconds'])
+
+
+# statistics of the current process, worker processes have their own
+stats = Stats()
+
+
+class RuleItem(object):
+    '''A test or an action of a rule
+
+    attributes is the dict of the SOAP form, shared rather than copied and
+    never modified, index is its index as an integer (None if missing)'''
+    __slots__ = ('category', 'index', 'attributes')
+
+    def __init__(self, category, index, attributes):
+        self.category = category
+        self.index = index
+        self.attributes = attributes
+
+    @classmethod
+    def from_dict(cls, category, item):
+        '''Return the item of a category from its SOAP form'''
+        index = item.get(u'index')
+        return cls(category, None if index is None else int(index), item)
+
+    def to_dict(self):
+        '''Return the SOAP form of the item'''
+        return dict(self.attributes)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and \
+            (self.category, self.index, self.attributes) == \
+            (other.category, other.index, other.attributes)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return u'{0}({1!r}, {2!r}, {3!r})'.format(
+            type(self).__name__, self.category, self.index, self.attributes)
+
+
+class Test(RuleItem):
+    '''A Zimbra test, e.g. of category headerTest'''
+    __slots__ = ()
+
+
+class Action(RuleItem):
+    '''A Zimbra action, e.g. of category actionFileInto'''
+    __slots__ = ()
+
+
+by_index = operator.attrgetter('index')
+
+
+def items_from_dict(cls, group, ignored=()):
+    '''Return the items of a group of categories, sorted by index'''
+    items = [cls.from_dict(category, item)
+             for (category, value) in group.items() if category not in ignored
+             for item in as_list(value)]
+    items.sort(key=by_index)
+    return tuple(items)
+
+
+def items_to_dict(items, group, lists=False):
+    '''Add items to a group of categories, as a single value when alone
+    like Zimbra does unless lists is True'''
+    for item in items:
+        if lists:
+            group.setdefault(item.category, []).append(item.to_dict())
+        else:
+            add_to_category(group, item.category, item.to_dict())
+    return group
+
+
+class Rule(object):
+    '''A Zimbra filter rule, with its tests and actions sorted by index
 
-from sievelib.parser import Parser
-from sievelib.commands import ActionCommand, TestCommand, RequireCommand, \
-    IfCommand, HeaderCommand, AddressCommand, SizeCommand, NotCommand, \
-    ExistsCommand, KeepCommand, DiscardCommand, StopCommand, FileintoCommand, \
-    RedirectCommand, \
-    add_commands, comparator, match_type
+    other keys of the SOAP form are kept in extra'''
+    __slots__ = ('name', 'active', 'condition', 'tests', 'actions', 'extra')
 
+    def __init__(self, name, active, condition, tests, actions, extra=None):
+        self.name = name
+        self.active = active
+        self.condition = condition
+        self.tests = tests
+        self.actions = actions
+        self.extra = extra
 
-def display_rule(rule):
-    '''print out one single Zimbra filter
+    @classmethod
+    def from_dict(cls, rule):
+        '''Return the rule of a SOAP filterRule'''
+        extra = dict((key, value) for (key, value) in rule.items()
+                     if key not in RULE_KEYS)
+        tests = rule[u'filterTests']
+        return cls(rule[u'name'], rule[u'active'], tests[u'condition'],
+                   items_from_dict(Test, tests, (u'condition',)),
+                   items_from_dict(Action, rule[u'filterActions']),
+                   extra or None)
+
+    def to_dict(self, lists=False):
+        '''Return the SOAP filterRule of the rule, with lists for all
+        categories if lists is True'''
+        rule = dict(self.extra or ())
+        rule[u'name'] = self.name
+        rule[u'active'] = self.active
+        rule[u'filterTests'] = items_to_dict(
+            self.tests, {u'condition': self.condition}, lists)
+        rule[u'filterActions'] = items_to_dict(self.actions, {}, lists)
+        return rule
+
+    def __eq__(self, other):
+        return isinstance(other, Rule) and all(
+            getattr(self, slot) == getattr(other, slot)
+            for slot in self.__slots__)
+
+    def __ne__(self, other):
+        return not self == other
+
+
+RULE_KEYS = [u'name', u'active', u'filterTests', u'filterActions']
+
+
+def as_rule(rule):
+    '''Return a Rule, from its SOAP form if needed'''
+    if isinstance(rule, Rule):
+        return rule
+    return Rule.from_dict(rule)
+
+
+def show_rule(rule):
+    '''return the Sieve string for one single Zimbra filter
 
     use two varibles to store name and active flag, then one test with
     possibly many actions'''
-    print(u'set "name" "' + rule[u'name'] + u'";')
-    print(u'set "active" "' + rule[u'active'] + u'";')
-    print(u'if ', end=u'')
-    display_test(rule[u'filterTests'])
-    print(u'{')
-    display_actions(rule[u'filterActions'])
-    print(u'}')
+    rule = as_rule(rule)
+    return u''.join([
+        u'set "name" "', rule.name, u'";\n',
+        u'set "active" "', rule.active, u'";\n',
+        u'if ', show_condition(rule), u'{\n',
+        show_actions(rule.actions),
+        u'}\n'
+    ])
 
 
-def display_test(test):
+def show_condition(rule):
     '''any Zimbra filter is anyof/allof and then possibly many tests'''
-    print(test[u'condition'] + u' (')
-    print(u',\n'.join(transform_tests(test)))
-    print(u') ', end=u'')
+    tests = transform_tests(rule.tests)
+    stats.count(u'tests_rendered', len(tests))
+    return rule.condition + u' (\n' + u',\n'.join(tests) + u'\n) '
 
 
 def transform_tests(tests):
-    '''for each subtest category, convert the tests to a single list and print
-
-    tests are grouped by category in Zimbra but not in Sieve. The index is
-    used for ordering'''
-    new_tests = []
-    known_tests = [u'headerTest', u'sizeTest', u'dateTest', u'bodyTest',
-                   u'headerExistsTest']
-    for key in known_tests:
-        if key in tests:
-            t = tests[key]
-            # single element is not in a list...
-            if not isinstance(t, list):
-                t = [t]
-            for tt in t:
-                tt[u'test'] = key[:-4]
-            new_tests.extend(t)
-    known_tests.append(u'condition')
-    for key in tests.keys():
-        if key not in known_tests:
-            print(u'Warning: unknown test category ' + key + u' - ' +
-                  unicode(tests[key]), file=sys.stderr)
-            print(u'/* unknown test category ' + key + u' - ' +
-                  unicode(tests[key]) + u' */ true')
-    new_tests.sort(key=lambda x: int(x.get(u'index')))
-    return map(show_test, new_tests)
+    '''convert the tests, already sorted by index, to a list of strings
+
+    tests of unknown categories come first, as comments'''
+    unknown = []
+    known = []
+    for test in tests:
+        if test.category in test_renderers:
+            known.append(show_test(test))
+        else:
+            stats.count(u'unknown_test_categories')
+            value = unicode(test.to_dict())
+            print(u'Warning: unknown test category ' + test.category +
+                  u' - ' + value, file=sys.stderr)
+            unknown.append(u'   /* unknown test category ' + test.category +
+                           u' - ' + value + u' */ true')
+    return unknown + known
 
 
 def translate(category, key):
@@ -79,202 +264,590 @@ def translate(category, key):
 
 
 def show_test(test):
-    '''return a Sieve string for a single test'''
+    '''return a Sieve string for a single Test'''
     show = u'   '
-    if test.get(u'negative') == u'1':
+    if test.attributes.get(u'negative') == u'1':
         show += u'not '
-    if test[u'test'] == u'headerExists':
-        show += u'exists ["' + test[u'header'] + u'"]'
-        return show
-    if test[u'test'] == u'size':
-        s = test[u's']
-        unit = s[-1]
-        s = int(s[:-1])
-        if unit in [u'K', u'M', u'G']:
-            s = s * 1024
-        if unit in [u'M', u'G']:
-            s = s * 1024
-        if unit == u'G':
-            s = s * 1024
-        show += u'size :' + test[u'numberComparison'] + u' ' + unicode(s)
-        return show
-    if test[u'test'] == u'date':
-        show += u'date :value "' + \
-            translate(u'date', test[u'dateComparison']) + \
-            u'" "date" "' + \
-            date.fromtimestamp(int(test[u'd'])).isoformat() + u'"'
-        return show
-    if test[u'test'] == u'body':
-        show += u'body :contains'
-    if test[u'test'] == u'header':
-        show += u'header :' + test[u'stringComparison']
-    if test[u'test'] == u'address':
-        show += u'address :' + test[u'stringComparison'] + u' :' + \
-            test[u'part']
+    render = test_renderers.get(test.category)
+    if render is None:
+        stats.count(u'unknown_tests')
+        print(u'Warning: unknown test: ' + unicode(test.to_dict()),
+              file=sys.stderr)
+        return u'/* unknown test: ' + unicode(test.to_dict()) + u' */ true'
+    return show + render(test.attributes)
+
+
+def show_comparator(test):
+    '''return the comparator of a Sieve string test, if any'''
     if test.get(u'caseSensitive') == u'1':
-        show += u' :comparator "i;ascii-casemap"'
-    if test[u'test'] in [u'header', u'address']:
-        show += u' ["' + u'", "'.join(test[u'header'].split(u',')) + \
-            u'"] ["' + test[u'value'] + u'"]'
-        return show
-    if test[u'test'] == u'body':
-        show += u' "' + test[u'value'] + u'"'
-        return show
-    print(u'Warning: unknown test: ' + unicode(test), file=sys.stderr)
-    return u'/* unknown test: ' + unicode(test) + u' */ true'
-
-
-def display_actions(actions):
-    '''display a list of actions in the order specified by their index'''
-    a = actions.items()
-    a.sort(key=lambda (_, x): int(x.get(u'index')))
-    for action in a:
-        print(u'   ', end=u'')
-        display_action(action)
-
-
-def display_action(action):
-    '''print the Sieve string for a single action'''
-    if action[0] == u'actionFileInto':
-        print(u'fileinto "' + action[1][u'folderPath'] + u'";')
-        return
-    if action[0] == u'actionStop':
-        print(u'stop;')
-        return
-    if action[0] == u'actionRedirect':
-        print(u'redirect "' + action[1][u'a'] + u'";')
-        return
-    if action[0] == u'actionKeep':
-        print(u'keep;')
-        return
-    if action[0] == u'actionDiscard':
-        print(u'discard;')
-        return
-    # Zimbra specific
-    if action[0] == u'actionFlag':
-        print(u'addflag "' + translate(u'flag', action[1][u'flagName']) +
-              u'";')
-        return
-    if action[0] == u'actionTag':
-        print(u'tag "' + action[1][u'tagName'] + u'";')
-        return
-    # reply and notify not taken into account
-    print(u'Warning: unknown action: ' + unicode(action), file=sys.stderr)
-    print(u'/* unknown action: ' + unicode(action) + u' */ keep;')
+        return u' :comparator "i;ascii-casemap"'
+    return u''
+
+
+def show_header_list(test):
+    '''return the header list and the key of a header or address test'''
+    return u' ["' + u'", "'.join(test[u'header'].split(u',')) + \
+        u'"] ["' + test[u'value'] + u'"]'
+
+
+def show_header(test):
+    '''return the Sieve string for a Zimbra headerTest'''
+    return u'header :' + test[u'stringComparison'] + show_comparator(test) + \
+        show_header_list(test)
+
+
+def show_address(test):
+    '''return the Sieve string for a Zimbra addressTest'''
+    return u'address :' + test[u'stringComparison'] + u' :' + \
+        test.get(u'part', u'all') + show_comparator(test) + \
+        show_header_list(test)
+
+
+def size_in_bytes(size):
+    '''Convert a Zimbra size such as 10M to a number of bytes'''
+    unit = size[-1]
+    s = int(size[:-1])
+    if unit in [u'K', u'M', u'G']:
+        s = s * 1024
+    if unit in [u'M', u'G']:
+        s = s * 1024
+    if unit == u'G':
+        s = s * 1024
+    return s
 
 
-def get_token(url):
-    '''Get authentication token from Zimbra SOAP API'''
-    login = os.getenv('LOGNAME') or os.getenv('USER') or os.getlogin()
+def show_size(test):
+    '''return the Sieve string for a Zimbra sizeTest, in bytes'''
+    return u'size :' + test[u'numberComparison'] + u' ' + \
+        unicode(size_in_bytes(test[u's']))
+
+
+def show_date(test):
+    '''return the Sieve string for a Zimbra dateTest'''
+    return u'date :value "' + translate(u'date', test[u'dateComparison']) + \
+        u'" "date" "' + date.fromtimestamp(int(test[u'd'])).isoformat() + u'"'
+
+
+def show_body(test):
+    '''return the Sieve string for a Zimbra bodyTest'''
+    return u'body :contains' + show_comparator(test) + \
+        u' "' + test[u'value'] + u'"'
+
+
+def show_exists(test):
+    '''return the Sieve string for a Zimbra headerExistsTest'''
+    return u'exists ["' + test[u'header'] + u'"]'
+
+
+def show_actions(actions):
+    '''return the Sieve lines of actions, already sorted by index'''
+    stats.count(u'actions_rendered', len(actions))
+    return u''.join(u'   ' + show_action(action) + u'\n'
+                    for action in actions)
+
+
+def show_action(action):
+    '''return the Sieve string for a single Action'''
+    render = action_renderers.get(action.category)
+    if render is None:
+        # reply and notify not taken into account
+        stats.count(u'unknown_actions')
+        unknown = unicode((action.category, action.to_dict()))
+        print(u'Warning: unknown action: ' + unknown, file=sys.stderr)
+        return u'/* unknown action: ' + unknown + u' */ keep;'
+    return render(action.attributes)
+
+
+class AuthToken(object):
+    '''A Zimbra authentication token with its expiry date
+
+    admin tokens are for the admin SOAP API, minted ones were obtained
+    without a password and are only kept in memory'''
+    def __init__(self, url, login, value, expires, admin=False, minted=False):
+        self.url = url
+        self.login = login
+        self.value = value
+        self.expires = expires
+        self.admin = admin
+        self.minted = minted
+
+    def __unicode__(self):
+        return self.value
+
+    def expired(self):
+        '''keep a margin so that the token does not expire while in use'''
+        return time.time() > self.expires - TOKEN_MARGIN
+
+    def renew(self):
+        '''authenticate again, after the server rejected the token'''
+        token = get_token(self.url, self.login, cache=False, admin=self.admin)
+        if token is None:
+            return False
+        self.value = token.value
+        self.expires = token.expires
+        if not (token.minted or token.admin):
+            store_token(self)
+        return True
+
+
+# tokens are considered expired a bit before the server does
+TOKEN_MARGIN = 60
+_token_lock = threading.Lock()
+# only one password prompt at a time
+_prompt_lock = threading.Lock()
+# set in fleet worker processes, which cannot share the terminal
+_no_prompt = []
+# minted and admin tokens by (url, login), None for a refused admin
+_minted_tokens = {}
+# only one admin authentication at a time
+_admin_lock = threading.Lock()
+
+
+def server_url():
+    '''URL of the Zimbra SOAP API, $ZBT_URL if set'''
+    return os.getenv('ZBT_URL') or DEFAULT_URL
+
+
+def cache_dir():
+    '''Directory where zbt keeps its cached data'''
+    base = os.getenv('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser(u'~'), u'.cache')
+    return os.path.join(base, u'zbt')
+
+
+def store_text(path, text):
+    '''Atomically replace a text file, creating its directory if needed
+
+    the temporary file is unique to the thread, several of them may store
+    the same file'''
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory, 0o700)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+    tmp = u'{0}.{1}.{2}.tmp'.format(path, os.getpid(),
+                                    threading.current_thread().ident)
+    with io.open(tmp, u'w', encoding=u'utf-8') as f:
+        f.write(text)
+    os.rename(tmp, path)
+
+
+def store_json(path, data):
+    '''Atomically replace a JSON file, creating its directory if needed'''
+    store_text(path, unicode(json.dumps(data, ensure_ascii=False)))
+
+
+def token_cache_path():
+    '''File storing authentication tokens, $ZBT_TOKEN_CACHE if set'''
+    path = os.getenv('ZBT_TOKEN_CACHE')
+    if path:
+        return path
+    return os.path.join(cache_dir(), u'tokens.json')
+
+
+def read_token_cache():
+    '''Return the token cache as {url: {login: [token, expires]}}'''
+    try:
+        with io.open(token_cache_path(), encoding=u'utf-8') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def write_token_cache(cache):
+    '''Atomically replace the token cache, only readable by its owner'''
+    path = token_cache_path()
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    tmp = path + u'.' + unicode(os.getpid()) + u'.tmp'
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(cache, f)
+    os.rename(tmp, path)
+
+
+def cached_token(url, login):
+    '''Return a still valid token from the cache, or None'''
+    with _token_lock:
+        entry = read_token_cache().get(url, {}).get(login)
+    if entry is None:
+        return None
+    token = AuthToken(url, login, entry[0], entry[1])
+    if token.expired():
+        return None
+    return token
+
+
+def store_token(token):
+    '''Save a token in the cache, dropping expired ones'''
+    with _token_lock:
+        cache = read_token_cache()
+        now = time.time()
+        for logins in cache.values():
+            for (login, entry) in list(logins.items()):
+                if entry[1] < now:
+                    del logins[login]
+        cache.setdefault(token.url, {})[token.login] = \
+            [token.value, token.expires]
+        try:
+            write_token_cache(cache)
+        except (IOError, OSError) as e:
+            print(u'Warning: could not save token: ' + unicode(e),
+                  file=sys.stderr)
+
+
+# (request, response, communication) classes, once pythonzimbra is imported
+_soap_classes = []
+
+
+def soap_classes():
+    '''Import pythonzimbra, only for server operations
+
+    return the classes of requests and responses, counting the bytes they
+    carry, and of communications'''
+    if _soap_classes:
+        return _soap_classes[0]
+    from pythonzimbra.request_xml import RequestXml
+    from pythonzimbra.response_xml import ResponseXml
+    from pythonzimbra.communication import Communication
+
+    class CountingRequestXml(RequestXml):
+        '''A request counting the bytes sent'''
+        def get_request(self):
+            text = RequestXml.get_request(self)
+            stats.count(u'bytes_sent', len(text.encode('utf-8')))
+            return text
+
+    class CountingResponseXml(ResponseXml):
+        '''A response counting the bytes received'''
+        def set_response(self, response_text):
+            if isinstance(response_text, unicode):
+                stats.count(u'bytes_received',
+                            len(response_text.encode('utf-8')))
+            else:
+                stats.count(u'bytes_received', len(response_text))
+            ResponseXml.set_response(self, response_text)
+
+    _soap_classes.append((CountingRequestXml, CountingResponseXml,
+                          Communication))
+    return _soap_classes[0]
+
+
+def auth_response(url, request_type, request_args,
+                  namespace=u'urn:zimbraAccount', token=None):
+    '''Send an authentication request and return its response'''
+    (Request, Response, Communication) = soap_classes()
+    request = Request()
+    if token is not None:
+        request.set_auth_token(unicode(token))
+    request.add_request(request_type, request_args, namespace)
+
+    response = Response()
+    with stats.span(u'auth'):
+        Communication(url).send_request(request, response)
+    return response
+
+
+def auth_result(response, request_type):
+    '''Return the token and its lifetime in seconds of the response of an
+    authentication request, or None'''
+    if response.is_fault():
+        return None
+    auth = response.get_response()[request_type[:-len(u'Request')] +
+                                   u'Response']
+    return (auth[u'authToken'], int(auth[u'lifetime']) / 1000)
+
+
+def auth_request(url, request_type, request_args,
+                 namespace=u'urn:zimbraAccount', token=None):
+    '''Send an authentication request, return the token and its lifetime in
+    seconds, or None'''
+    return auth_result(auth_response(url, request_type, request_args,
+                                     namespace, token), request_type)
+
+
+def authenticate(url, login, passwd):
+    '''Send an AuthRequest, return the token and its lifetime in seconds'''
+    return auth_request(url, u'AuthRequest', {
+        u'account': {u'by': u'name', u'_content': login},
+        u'password': {u'_content': passwd}
+    })
+
+
+def admin_authenticate(url, login, passwd):
+    '''Send an AuthRequest to the admin SOAP API, like authenticate()'''
+    return auth_request(url, u'AuthRequest', {
+        u'account': {u'by': u'name', u'_content': login},
+        u'password': {u'_content': passwd}
+    }, u'urn:zimbraAdmin')
+
+
+def preauth_value(login, key, timestamp, expires=0):
+    '''Return the HMAC of a preauth request, computed with the preauth key
+    of the domain of the account'''
+    message = u'|'.join([login, u'name', unicode(expires), unicode(timestamp)])
+    return hmac.new(key.encode('utf-8'), message.encode('utf-8'),
+                    hashlib.sha1).hexdigest()
+
+
+def preauthenticate(url, login, key):
+    '''Send a preauth AuthRequest, like authenticate() but with the preauth
+    key of the domain instead of the password of the account'''
+    timestamp = int(time.time() * 1000)
+    return auth_request(url, u'AuthRequest', {
+        u'account': {u'by': u'name', u'_content': login},
+        u'preauth': {u'timestamp': unicode(timestamp), u'expires': u'0',
+                     u'_content': preauth_value(login, key, timestamp)}
+    })
+
+
+def delegate_authenticate(admin, login):
+    '''Send a DelegateAuthRequest for an account with an admin token, like
+    authenticate()
+
+    the admin token is only renewed when the server rejected it, not when
+    the account is unknown for instance'''
+    args = {u'account': {u'by': u'name', u'_content': login}}
+    response = auth_response(admin.url, u'DelegateAuthRequest', args,
+                             u'urn:zimbraAdmin', admin)
+    if response.is_fault() and response.get_fault_code() in AUTH_FAULTS:
+        admin = admin_token(admin.url, admin.value)
+        if admin is None:
+            return None
+        response = auth_response(admin.url, u'DelegateAuthRequest', args,
+                                 u'urn:zimbraAdmin', admin)
+    return auth_result(response, u'DelegateAuthRequest')
+
+
+def preauth_key():
+    '''Domain preauth key read from $ZBT_PREAUTH_KEY_FILE, or
+    $ZBT_PREAUTH_KEY, or None'''
+    path = os.getenv('ZBT_PREAUTH_KEY_FILE')
+    if path:
+        with io.open(path, encoding=u'utf-8') as f:
+            return f.read().strip()
+    return os.getenv('ZBT_PREAUTH_KEY') or None
+
+
+def admin_url(url):
+    '''URL of the admin SOAP API, $ZBT_ADMIN_URL or the default one of the
+    server of url'''
+    if os.getenv('ZBT_ADMIN_URL'):
+        return os.getenv('ZBT_ADMIN_URL')
+    (scheme, _, rest) = url.partition(u'://')
+    host = rest.split(u'/')[0].split(u':')[0]
+    return scheme + u'://' + host + u':7071/service/admin/soap/'
+
+
+def mint_token(url, login):
+    '''Return a token obtained without the password of the account, with
+    preauth if a preauth key is set, or with DelegateAuthRequest if an admin
+    account is set in $ZBT_ADMIN, or None'''
+    key = preauth_key()
+    if key is not None:
+        result = preauthenticate(url, login, key)
+    else:
+        admin = admin_token(url)
+        if admin is None:
+            return None
+        result = delegate_authenticate(admin, login)
+    if result is None:
+        print(u'Warning: could not get a token for ' + login,
+              file=sys.stderr)
+        return None
+    return AuthToken(url, login, result[0], time.time() + result[1],
+                     minted=True)
+
+
+def admin_token(url, rejected=None):
+    '''Return a token of the admin account of $ZBT_ADMIN for the server of
+    url, or None
+
+    as it can act for any account, it is only kept in memory. Its password
+    is asked once, and not asked again once refused. rejected is the value
+    of a token the server refused, which is renewed unless another thread
+    already did.'''
+    key = (admin_url(url), unicode(os.getenv('ZBT_ADMIN')))
+    with _admin_lock:
+        token = _minted_tokens.get(key, False)
+        if token is None or token and not token.expired() and \
+                token.value != rejected:
+            return token
+        token = get_token(key[0], key[1], cache=False, admin=True)
+        if token is None:
+            print(u'Warning: admin authentication failed, not asking again',
+                  file=sys.stderr)
+        _minted_tokens[key] = token
+        return token
+
+
+def can_mint():
+    '''True if tokens are obtained without passwords'''
+    return bool(os.getenv('ZBT_PREAUTH_KEY_FILE') or
+                os.getenv('ZBT_PREAUTH_KEY') or os.getenv('ZBT_ADMIN'))
+
+
+def default_login():
+    '''Login of the current user'''
+    return os.getenv('LOGNAME') or os.getenv('USER') or os.getlogin()
+
+
+def get_token(url, login=None, cache=True, admin=False):
+    '''Get authentication token from the cache or from Zimbra SOAP API
+
+    tokens are minted when can_mint(), kept in memory until they are about
+    to expire, else obtained with a password and kept in the token cache.
+    With admin, an admin token is obtained with a password.'''
+    if login is None:
+        login = default_login()
+        prompt = u'Password: '
+    else:
+        prompt = u'Password for ' + login + u': '
     login = unicode(login)
-    passwd = getpass.getpass()
-
-    return auth.authenticate(
-        url,
-        login,
-        passwd,
-        use_password=True
-    )
-
-
-class AddflagCommand(ActionCommand):
-    '''Sieve command to handle Zimbra flags'''
-    # extension_map is hardcoded in sievelib, so we cannot use this
-    # is_extension = True
-    args_definition = [
-        {
-            "name": "flag",
-            "type": "string",
-            "required": True
-        }
-    ]
-
-
-class SetCommand(ActionCommand):
-    '''Sieve command to handle variables used to store Zimbra rule name'''
-    is_extension = True
-    args_definition = [
-        {
-            "name": "name",
-            "type": "string",
-            "required": True
-        },
-        {
-            "name": "value",
-            "type": "string",
-            "required": True
-        }
-    ]
-
-
-class TagCommand(ActionCommand):
-    '''Sieve command to handle Zimbra tags'''
-    # extension_map is hardcoded in sievelib, so we cannot use this
-    # is_extension = True
-    args_definition = [
-        {
-            "name": "tag",
-            "type": "string",
-            "required": True
-        }
-    ]
-
-
-class DateCommand(TestCommand):
-    '''Sieve test for Zimbra date comparisons'''
-    # extension_map is hardcoded in sievelib, so we cannot use this
-    # is_extension = True
-    args_definition = [
-        {
-            "name": "zone",
-            "type": ["tag"],
-            "write_tag": True,
-            "values": [":zone"],
-            "extra_arg": {"type": "string"},
-            "required": False
-        },
-        {
-            "name": "match-value",
-            "type": ["tag"],
-            "required": True
-        },
-        {
-            "name": "comparison",
-            "type": ["string"],
-            "required": True
-        },
-        {
-            "name": "match-against",
-            "type": ["string"],
-            "required": True
-        },
-        {
-            "name": "match-against-field",
-            "type": ["string"],
-            "required": True
-        }
-    ]
-
-
-class BodyCommand(TestCommand):
-    '''Sieve test for Zimbra body matches'''
-    is_extension = True
-    args_definition = [
-        comparator,
-        match_type,
-        {"name": "key-list",
-         "type": ["string", "stringlist"],
-         "required": True}
-    ]
-
-
-def zimbrify_header(htest):
+    mint = not admin and can_mint()
+
+    if cache:
+        token = _minted_tokens.get((url, login)) if mint else None
+        if token is None or token.expired():
+            token = cached_token(url, login)
+        if token is not None:
+            token.admin = admin
+            return token
+
+    if mint:
+        token = mint_token(url, login)
+        if token is not None:
+            _minted_tokens[(url, login)] = token
+        return token
+    if _no_prompt:
+        print(u'Warning: no password prompt in worker processes, for ' +
+              login, file=sys.stderr)
+        return None
+    with _prompt_lock:
+        passwd = getpass.getpass(prompt)
+    result = (admin_authenticate if admin else authenticate)(url, login,
+                                                             passwd)
+    if result is None:
+        return None
+    token = AuthToken(url, login, result[0], time.time() + result[1], admin)
+    if cache:
+        store_token(token)
+    return token
+
+
+# our sievelib command classes, once sievelib is imported
+_sieve_commands = []
+
+
+def sieve_commands():
+    '''Import sievelib, only for parsing, and return our supplementary
+    command classes'''
+    if _sieve_commands:
+        return _sieve_commands
+    from sievelib.commands import ActionCommand, TestCommand, comparator, \
+        match_type
+
+    class AddflagCommand(ActionCommand):
+        '''Sieve command to handle Zimbra flags'''
+        # extension_map is hardcoded in sievelib, so we cannot use this
+        # is_extension = True
+        args_definition = [
+            {
+                "name": "flag",
+                "type": "string",
+                "required": True
+            }
+        ]
+
+    class SetCommand(ActionCommand):
+        '''Sieve command to handle variables used to store Zimbra rule name'''
+        is_extension = True
+        args_definition = [
+            {
+                "name": "name",
+                "type": "string",
+                "required": True
+            },
+            {
+                "name": "value",
+                "type": "string",
+                "required": True
+            }
+        ]
+
+    class TagCommand(ActionCommand):
+        '''Sieve command to handle Zimbra tags'''
+        # extension_map is hardcoded in sievelib, so we cannot use this
+        # is_extension = True
+        args_definition = [
+            {
+                "name": "tag",
+                "type": "string",
+                "required": True
+            }
+        ]
+
+    class DateCommand(TestCommand):
+        '''Sieve test for Zimbra date comparisons'''
+        # extension_map is hardcoded in sievelib, so we cannot use this
+        # is_extension = True
+        args_definition = [
+            {
+                "name": "zone",
+                "type": ["tag"],
+                "write_tag": True,
+                "values": [":zone"],
+                "extra_arg": {"type": "string"},
+                "required": False
+            },
+            {
+                "name": "match-value",
+                "type": ["tag"],
+                "required": True
+            },
+            {
+                "name": "comparison",
+                "type": ["string"],
+                "required": True
+            },
+            {
+                "name": "match-against",
+                "type": ["string"],
+                "required": True
+            },
+            {
+                "name": "match-against-field",
+                "type": ["string"],
+                "required": True
+            }
+        ]
+
+    class BodyCommand(TestCommand):
+        '''Sieve test for Zimbra body matches'''
+        is_extension = True
+        args_definition = [
+            comparator,
+            match_type,
+            {"name": "key-list",
+             "type": ["string", "stringlist"],
+             "required": True}
+        ]
+
+    _sieve_commands.extend([AddflagCommand, SetCommand, TagCommand,
+                            DateCommand, BodyCommand])
+    return _sieve_commands
+
+
+def zimbrify_header(htest, headers=u'header-names'):
     '''Return a Zimbra headerTest for the corresponding Sieve test'''
     h = {
         u'stringComparison': unicode(htest[u'match-type'][1:]),
         u'value': unicode(htest[u'key-list'][0][1:-1]),
         u'header': unicode(
-            u','.join(map(lambda h: h[1:-1], htest[u'header-names'])))
+            u','.join(map(lambda h: h[1:-1], htest[headers])))
     }
     if u'comparator' in htest.arguments:
         if htest[u'comparator'][u'extra_arg'] == u'"i;ascii-casemap"':
@@ -284,9 +857,9 @@ def zimbrify_header(htest):
 
 def zimbrify_address(htest):
     '''Return a Zimbra addressTest for the corresponding Sieve test'''
-    h = zimbrify_header(htest)
-    if u'address_part' in htest.arguments:
-        h[u'part'] = unicode(htest[u'address_part'][1:])
+    h = zimbrify_header(htest, u'header-list')
+    if u'address-part' in htest.arguments:
+        h[u'part'] = unicode(htest[u'address-part'][1:])
     return h
 
 
@@ -337,46 +910,114 @@ def zimbrify_date(htest):
     }
 
 
+def zimbrify_flag(action):
+    '''Return a Zimbra actionFlag for the corresponding Sieve action'''
+    if action[u'flag'] == u'"\\\\Seen"':
+        flag = u'read'
+    else:
+        flag = u'flagged'
+    return {u'flagName': flag}
+
+
+def zimbrify_tag(action):
+    '''Return a Zimbra actionTag for the corresponding Sieve action'''
+    return {u'tagName': unicode(action[u'tag'][1:-1])}
+
+
+def zimbrify_fileinto(action):
+    '''Return a Zimbra actionFileInto for the corresponding Sieve action'''
+    return {u'folderPath': unicode(action[u'mailbox'][1:-1])}
+
+
+def zimbrify_redirect(action):
+    '''Return a Zimbra actionRedirect for the corresponding Sieve action'''
+    return {u'a': unicode(action[u'address'][1:-1])}
+
+
+def zimbrify_no_arg(action):
+    '''Return a Zimbra action without arguments (keep, discard, stop)'''
+    return {}
+
+
+# Zimbra test category -> function returning the Sieve string of a test
+test_renderers = {}
+# Zimbra action category -> function returning the Sieve string of an action
+action_renderers = {}
+# Sieve command name -> (Zimbra category, function returning its dict)
+test_converters = {}
+action_converters = {}
+
+
+def register_test(category, command, zimbrify_fn, show_fn):
+    '''Declare how a Sieve test converts to and from a Zimbra test category
+
+    either command or zimbrify_fn (resp. show_fn) may be None for tests
+    that are only converted in one direction'''
+    if command is not None:
+        test_converters[command] = (category, zimbrify_fn)
+    if show_fn is not None:
+        test_renderers[category] = show_fn
+
+
+def register_action(category, command, zimbrify_fn, show_fn):
+    '''Declare how a Sieve action converts to and from a Zimbra action
+
+    see register_test()'''
+    if command is not None:
+        action_converters[command] = (category, zimbrify_fn)
+    if show_fn is not None:
+        action_renderers[category] = show_fn
+
+
+register_test(u'headerTest', u'header', zimbrify_header, show_header)
+register_test(u'addressTest', u'address', zimbrify_address, show_address)
+register_test(u'sizeTest', u'size', zimbrify_size, show_size)
+register_test(u'headerExistsTest', u'exists', zimbrify_exist, show_exists)
+register_test(u'bodyTest', u'body', zimbrify_body, show_body)
+register_test(u'dateTest', u'date', zimbrify_date, show_date)
+
+register_action(u'actionKeep', u'keep', zimbrify_no_arg,
+                lambda action: u'keep;')
+register_action(u'actionDiscard', u'discard', zimbrify_no_arg,
+                lambda action: u'discard;')
+register_action(u'actionStop', u'stop', zimbrify_no_arg,
+                lambda action: u'stop;')
+register_action(u'actionFileInto', u'fileinto', zimbrify_fileinto,
+                lambda action: u'fileinto "' + action[u'folderPath'] + u'";')
+register_action(u'actionRedirect', u'redirect', zimbrify_redirect,
+                lambda action: u'redirect "' + action[u'a'] + u'";')
+# Zimbra specific
+register_action(u'actionFlag', u'addflag', zimbrify_flag,
+                lambda action: u'addflag "' +
+                translate(u'flag', action[u'flagName']) + u'";')
+register_action(u'actionTag', u'tag', zimbrify_tag,
+                lambda action: u'tag "' + action[u'tagName'] + u'";')
+
+
+def find_converter(converters, command):
+    '''Return the (category, function) of a parsed Sieve command, or None'''
+    return converters.get(command.name)
+
+
+def add_to_category(group, category, item):
+    '''Zimbra uses a single value for a category, then a list'''
+    if category not in group:
+        group[category] = item
+    elif not isinstance(group[category], list):
+        group[category] = [group[category], item]
+    else:
+        group[category].append(item)
+
+
 def zimbrify_actions(actions):
     '''Return a dict of Zimbra actions for the corresponding Sieve actions'''
     acts = {}
     for (index, a) in enumerate(actions):
-        cat = None
-        if isinstance(a, KeepCommand):
-            aa = {}
-            cat = u'actionKeep'
-        if isinstance(a, DiscardCommand):
-            aa = {}
-            cat = u'actionDiscard'
-        if isinstance(a, StopCommand):
-            aa = {}
-            cat = u'actionStop'
-        if isinstance(a, AddflagCommand):
-            if a[u'flag'] == u'"\\\\Seen"':
-                flag = u'read'
-            else:
-                flag = u'flagged'
-            aa = {u'flagName': flag}
-            cat = u'actionFlag'
-        if isinstance(a, TagCommand):
-            aa = {u'tagName': unicode(a[u'tag'][1:-1])}
-            cat = u'actionTag'
-        if isinstance(a, FileintoCommand):
-            aa = {u'folderPath': unicode(a[u'mailbox'][1:-1])}
-            cat = u'actionFileInto'
-        if isinstance(a, RedirectCommand):
-            aa = {u'a': unicode(a[u'address'][1:-1])}
-            cat = u'actionRedirect'
-
-        if cat is not None:
+        converter = find_converter(action_converters, a)
+        if converter is not None:
+            aa = converter[1](a)
             aa[u'index'] = unicode(index)
-            # use a single value, then a list
-            if cat not in acts:
-                acts[cat] = aa
-            elif not isinstance(acts[cat], list):
-                acts[cat] = [acts[cat], aa]
-            else:
-                acts[cat].append(aa)
+            add_to_category(acts, converter[0], aa)
     return acts
 
 
@@ -386,42 +1027,18 @@ def zimbrify_test(test):
         u'condition': unicode(test.name)
     }
     for (index, t) in enumerate(test[u'tests']):
-        cat = None
-        if isinstance(t, NotCommand):
+        if t.name == u'not':
             t = t[u'test']
             negative = True
         else:
             negative = False
-        if isinstance(t, HeaderCommand):
-            tt = zimbrify_header(t)
-            cat = u'headerTest'
-        if isinstance(t, AddressCommand):
-            tt = zimbrify_address(t)
-            cat = u'addressTest'
-        if isinstance(t, SizeCommand):
-            tt = zimbrify_size(t)
-            cat = u'sizeTest'
-        if isinstance(t, ExistsCommand):
-            tt = zimbrify_exist(t)
-            cat = u'headerExistsTest'
-        if isinstance(t, BodyCommand):
-            tt = zimbrify_body(t)
-            cat = u'bodyTest'
-        if isinstance(t, DateCommand):
-            tt = zimbrify_date(t)
-            cat = u'dateTest'
-
-        if cat is not None:
+        converter = find_converter(test_converters, t)
+        if converter is not None:
+            tt = converter[1](t)
             if negative:
                 tt[u'negative'] = u'1'
             tt[u'index'] = unicode(index)
-            # use a single value, then a list
-            if cat not in tests:
-                tests[cat] = tt
-            elif not isinstance(tests[cat], list):
-                tests[cat] = [tests[cat], tt]
-            else:
-                tests[cat].append(tt)
+            add_to_category(tests, converter[0], tt)
     return tests
 
 
@@ -431,9 +1048,9 @@ def zimbrify(command_list):
     active = u'1'
     commands = []
     for command in command_list:
-        if isinstance(command, RequireCommand):
+        if command.name == u'require':
             pass
-        elif isinstance(command, SetCommand):
+        elif command.name == u'set':
             if command[u'name'] == u'"name"':
                 name = command[u'value'][1:-1]
             elif command[u'name'] == u'"active"':
@@ -441,118 +1058,2878 @@ def zimbrify(command_list):
             else:
                 print(u'unknown variable: ' + command[u'name'],
                       file=sys.stderr)
-        elif isinstance(command, IfCommand):
-            tests = zimbrify_test(command[u'test'])
-            actions = zimbrify_actions(command.children)
-            cmd = {
-                u'name': unicode(name), u'active': unicode(active),
-                u'filterTests': tests, u'filterActions': actions
-            }
-            commands.append(cmd)
+        elif command.name == u'if':
+            commands.append(zimbrify_rule(name, active, command))
         else:
-            print(u'unknown command: ' + command, file=sys.stderr)
+            print(u'unknown command: ' + command.name, file=sys.stderr)
     return commands
 
 
+def zimbrify_rule(name, active, command):
+    '''Return the Zimbra rule for a Sieve if command'''
+    stats.count(u'rules_converted')
+    stats.count(u'tests_converted', len(command[u'test'][u'tests']))
+    stats.count(u'actions_converted', len(command.children))
+    return {
+        u'name': unicode(name), u'active': unicode(active),
+        u'filterTests': zimbrify_test(command[u'test']),
+        u'filterActions': zimbrify_actions(command.children)
+    }
+
+
+# our commands are added to sievelib only once
+_parser_ready = []
+
+
 def init_parser():
     '''initialize a Sieve parser with our supplementary commands'''
-    add_commands([AddflagCommand, SetCommand, TagCommand, DateCommand,
-                  BodyCommand])
+    from sievelib.commands import add_commands
+    from sievelib.parser import Parser
+    if not _parser_ready:
+        add_commands(sieve_commands())
+        _parser_ready.append(True)
     return Parser()
 
 
-def parse():
-    '''parse either a file or stdin and convert the result to Zimbra format'''
-    if sys.argv[1] == u'-':
-        inputfile = sys.stdin
+# change it whenever zimbrify() output changes, to invalidate the cache
+PARSE_CACHE_VERSION = b'1'
+# bytes of converted rules kept in the cache
+PARSE_CACHE_SIZE = 32 * 1024 * 1024
+
+
+def parse_cache_dir():
+    '''Directory of converted sieve files, $ZBT_PARSE_CACHE if set'''
+    return os.getenv('ZBT_PARSE_CACHE') or os.path.join(cache_dir(),
+                                                        u'parsed')
+
+
+def cached_rules(key):
+    '''Return the rules converted from a source of the given hash, or None'''
+    path = os.path.join(parse_cache_dir(), key)
+    try:
+        with open(path, 'rb') as f:
+            rules = json.loads(zlib.decompress(f.read()))
+        # most recently used entries are evicted last
+        os.utime(path, None)
+        return rules
+    except (IOError, OSError, ValueError, zlib.error):
+        return None
+
+
+def store_rules(key, rules):
+    '''Save converted rules in the cache, evicting the least recently used
+    entries beyond PARSE_CACHE_SIZE'''
+    directory = parse_cache_dir()
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        path = os.path.join(directory, key)
+        tmp = path + u'.' + unicode(os.getpid()) + u'.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(zlib.compress(json.dumps(rules, separators=(',', ':'))))
+        os.rename(tmp, path)
+
+        entries = []
+        for name in os.listdir(directory):
+            stat = os.stat(os.path.join(directory, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, name) in sorted(entries):
+            if total <= PARSE_CACHE_SIZE:
+                break
+            os.remove(os.path.join(directory, name))
+            total -= size
+    except (IOError, OSError) as e:
+        print(u'Warning: could not cache converted rules: ' + unicode(e),
+              file=sys.stderr)
+
+
+def source_key(source):
+    '''Return the parse cache key of a Sieve source, as bytes'''
+    return hashlib.sha1(PARSE_CACHE_VERSION + b'\0' + source).hexdigest()
+
+
+def convert(source, cache=True):
+    '''parse a Sieve source and convert it to Zimbra format
+
+    the result is cached on disk by hash of the source, so that an unchanged
+    source is not parsed again. Return None if the source cannot be parsed'''
+    if isinstance(source, unicode):
+        source = source.encode('utf-8')
+    key = source_key(source)
+    rules = cached_rules(key) if cache else None
+    if rules is not None:
+        stats.count(u'parse_cache_hits')
     else:
-        inputfile = sys.argv[1]
-    print(u'parsing ' + inputfile, file=sys.stderr)
+        rules = convert_stream(io.BytesIO(source))
+        if rules is not None and cache:
+            store_rules(key, rules)
+    return rules
+
+
+class FastPathUnsupported(Exception):
+    '''Raised when a Sieve source is not in the subset of the fast path'''
+
+
+class FastCommand(object):
+    '''A Sieve command read by the fast path
+
+    it is converted the same way as the sievelib command of the same name,
+    arguments keep the syntax used by sievelib'''
+    __slots__ = ('name', 'arguments', 'children')
+
+    def __init__(self, name, arguments, children=()):
+        self.name = name
+        self.arguments = arguments
+        self.children = children
+
+    def __getitem__(self, name):
+        return self.arguments[name]
+
+
+# regular expressions of the Sieve subset of the fast path, each of them
+# matches a whole command with its arguments
+SIEVE_SPACE = r'(?:\s+|\#[^\n]*\n|/\*.*?\*/)*'
+SIEVE_STRING = r'"(?:[^"\\]|\\.)*"'
+SIEVE_ARG = (r'(:[a-z_]+)|(' + SIEVE_STRING + r')|\[\s*(' + SIEVE_STRING +
+             r'(?:\s*,\s*' + SIEVE_STRING + r')*)\s*\]|([0-9]+)(?![0-9a-z])')
+SIEVE_ARGS = r'((?:\s*(?:' + SIEVE_ARG + r'))*)'
+FAST_TOP = re.compile(SIEVE_SPACE + r'(?:(\Z)|if\s+(allof|anyof)\s*\(|' +
+                      r'(require|set)' + SIEVE_ARGS + r'\s*;)', re.DOTALL)
+FAST_TEST = re.compile(SIEVE_SPACE + r'(not\s+)?([a-z_]+)' + SIEVE_ARGS +
+                       r'\s*([,)])', re.DOTALL)
+FAST_BLOCK = re.compile(SIEVE_SPACE + r'\{', re.DOTALL)
+FAST_ACTION = re.compile(SIEVE_SPACE + r'(?:(\})|([a-z_]+)' + SIEVE_ARGS +
+                         r'\s*;)', re.DOTALL)
+FAST_ARG = re.compile(r'\s*(?:' + SIEVE_ARG + r')', re.DOTALL)
+FAST_STRING = re.compile(SIEVE_STRING, re.DOTALL)
+
+MATCH_TYPES = {u':is': u'match-type', u':contains': u'match-type',
+               u':matches': u'match-type'}
+ADDRESS_TAGS = {u':all': u'address-part', u':localpart': u'address-part',
+                u':domain': u'address-part'}
+ADDRESS_TAGS.update(MATCH_TYPES)
+
+# Sieve command of the fast path -> (its tags and the argument they set,
+# required arguments among those, positional arguments with their kind)
+FAST_TESTS = {
+    u'header': (MATCH_TYPES, [u'match-type'],
+                [(u'header-names', u'list'), (u'key-list', u'list')]),
+    u'address': (ADDRESS_TAGS, [u'match-type'],
+                 [(u'header-list', u'list'), (u'key-list', u'list')]),
+    u'size': ({u':over': u'comparator', u':under': u'comparator'},
+              [u'comparator'], [(u'limit', u'number')]),
+    u'exists': ({}, [], [(u'header-names', u'list')]),
+    u'body': (MATCH_TYPES, [], [(u'key-list', u'string')]),
+    u'date': ({u':value': u'match-value'}, [u'match-value'],
+              [(u'comparison', u'string'), (u'match-against', u'string'),
+               (u'match-against-field', u'string')]),
+}
+FAST_ACTIONS = {
+    u'keep': ({}, [], []),
+    u'discard': ({}, [], []),
+    u'stop': ({}, [], []),
+    u'fileinto': ({}, [], [(u'mailbox', u'string')]),
+    u'redirect': ({}, [], [(u'address', u'string')]),
+    u'addflag': ({}, [], [(u'flag', u'string')]),
+    u'tag': ({}, [], [(u'tag', u'string')]),
+}
+# commands that sievelib only accepts after requiring an extension
+FAST_EXTENSIONS = {u'fileinto': u'fileinto', u'body': u'body',
+                   u'set': u'variables'}
+# size of the chunks read from a stream by the fast path
+FAST_CHUNK_SIZE = 64 * 1024
+
+
+class FastParser(object):
+    '''Single pass parser of the Zimbra-compatible subset of Sieve
+
+    the stream is read by chunks and rules are converted as soon as they are
+    read, anything outside of the subset raises FastPathUnsupported. Chunks
+    are appended to text, for a fallback to sievelib.'''
+    def __init__(self, stream, text):
+        self.stream = stream
+        self.text = text
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buf = u''
+        self.pos = 0
+        self.eof = False
+        self.required = set()
+
+    def read(self):
+        '''append the next chunk of the stream to the buffer'''
+        chunk = self.stream.read(FAST_CHUNK_SIZE)
+        self.text.append(chunk)
+        self.eof = not chunk
+        if isinstance(chunk, bytes):
+            chunk = self.decoder.decode(chunk, self.eof)
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+
+    def match(self, regex):
+        '''match a command at the current position, reading more if needed'''
+        while True:
+            m = regex.match(self.buf, self.pos)
+            # a match at the end of the buffer might not be complete yet
+            if (m is None or m.end() == len(self.buf)) and not self.eof:
+                self.read()
+                continue
+            if m is None:
+                raise FastPathUnsupported(self.buf[self.pos:self.pos + 20])
+            self.pos = m.end()
+            return m
+
+    def arguments(self, name, table, converters, text):
+        '''map the arguments of a command to the names sievelib uses'''
+        if name not in table or name not in converters:
+            raise FastPathUnsupported(name)
+        (tags, required, positional) = table[name]
+        if name in FAST_EXTENSIONS and \
+                FAST_EXTENSIONS[name] not in self.required:
+            raise FastPathUnsupported(name)
+        arguments = {}
+        positional = iter(positional)
+        tagged = True
+        for (tag, string, strings, number) in FAST_ARG.findall(text):
+            if tag:
+                key = tags.get(tag)
+                # tags come first, at most once
+                if key is None or key in arguments or not tagged:
+                    raise FastPathUnsupported(tag)
+                arguments[key] = tag
+                continue
+            tagged = False
+            (key, kind) = next(positional, (None, None))
+            if kind == u'list' and strings:
+                arguments[key] = FAST_STRING.findall(strings)
+            elif kind == u'string' and string:
+                arguments[key] = string
+            elif kind == u'number' and number:
+                arguments[key] = number
+            else:
+                raise FastPathUnsupported(name)
+        if next(positional, None) is not None or \
+                any(key not in arguments for key in required):
+            raise FastPathUnsupported(name)
+        return arguments
+
+    def if_command(self, condition):
+        '''the tests and the actions of a rule'''
+        tests = []
+        while True:
+            (negative, name, text, _, _, _, _, end) = \
+                self.match(FAST_TEST).groups()
+            test = FastCommand(name, self.arguments(name, FAST_TESTS,
+                                                    test_converters, text))
+            if negative:
+                test = FastCommand(u'not', {u'test': test})
+            tests.append(test)
+            if end == u')':
+                break
+        self.match(FAST_BLOCK)
+        actions = []
+        while True:
+            (end, name, text) = self.match(FAST_ACTION).groups()[:3]
+            if end:
+                break
+            actions.append(FastCommand(name, self.arguments(
+                name, FAST_ACTIONS, action_converters, text)))
+        test = FastCommand(condition, {u'tests': tests})
+        return FastCommand(u'if', {u'test': test}, actions)
+
+    def rules(self):
+        '''yield the Zimbra rules, in the same way as zimbrify()'''
+        name = u'undefined'
+        active = u'1'
+        while True:
+            (end, condition, command, text) = \
+                self.match(FAST_TOP).groups()[:4]
+            if end is not None:
+                return
+            if condition:
+                yield zimbrify_rule(name, active,
+                                    self.if_command(condition))
+                continue
+            args = FAST_ARG.findall(text)
+            if command == u'require':
+                if len(args) != 1:
+                    raise FastPathUnsupported(command)
+                (_, string, strings, _) = args[0]
+                self.required.update(s[1:-1] for s in
+                                     FAST_STRING.findall(string or strings))
+                continue
+            if FAST_EXTENSIONS[command] not in self.required or \
+                    len(args) != 2 or not args[0][1] or not args[1][1]:
+                raise FastPathUnsupported(command)
+            (variable, value) = (args[0][1], args[1][1])
+            if variable == u'"name"':
+                name = value[1:-1]
+            elif variable == u'"active"':
+                active = value[1:-1]
+            else:
+                print(u'unknown variable: ' + variable, file=sys.stderr)
+
+
+def fast_rules(stream):
+    '''Yield the Zimbra rules of a Sieve stream as they are read
+
+    only the Zimbra-compatible subset of Sieve is handled, anything else
+    raises FastPathUnsupported'''
+    text = []
+    for rule in FastParser(stream, text).rules():
+        yield rule
+        # chunks are only kept for a fallback to sievelib
+        del text[:]
+
+
+def sievelib_rules(source):
+    '''Parse a Sieve source with sievelib and convert it to Zimbra format,
+    return None if it cannot be parsed'''
     p = init_parser()
-    if p.parse_file(inputfile) is False:
+    with stats.span(u'parse'):
+        parsed = p.parse(source)
+    if parsed is False:
         print(p.error)
-    else:
+        return None
+    with stats.span(u'zimbrify'):
         return zimbrify(p.result)
 
 
-def display_rules(rules):
-    '''print out a Sieve file corresponding to Zimbra filter rules'''
-    print(u'require ["date", "relational", "fileinto",' +
-          u' "imap4flags", "body", "variables"];')
-    print(u'')
+def sieve_rules(stream):
+    '''Yield the Zimbra rules of a Sieve stream as they are read
+
+    the fast path is used as long as the stream is in its subset, then the
+    whole stream is parsed by sievelib and the rules that were not yielded
+    yet follow. None is yielded last if the stream cannot be parsed.'''
+    text = []
+    rules = FastParser(stream, text).rules()
+    count = 0
+    try:
+        while True:
+            with stats.span(u'fast_path'):
+                rule = next(rules, None)
+            if rule is None:
+                return
+            count += 1
+            yield rule
+    except FastPathUnsupported:
+        stats.count(u'fast_path_fallbacks')
+    text.append(stream.read())
+    rules = sievelib_rules(text[0][:0].join(text))
+    if rules is None:
+        yield None
+        return
+    for rule in rules[count:]:
+        yield rule
+
+
+def convert_stream(stream):
+    '''Read a Sieve stream and convert it to Zimbra format
+
+    use the fast path, then sievelib if the stream is not in its subset.
+    Return None if the stream cannot be parsed'''
+    rules = list(sieve_rules(stream))
+    if rules and rules[-1] is None:
+        return None
+    return rules
+
+
+def parse(inputfile=None):
+    '''parse either a file or stdin and convert the result to Zimbra format
+
+    directories are handled by parse_files()'''
+    if inputfile is None:
+        inputfile = sys.argv[1]
+    if inputfile != u'-' and os.path.isdir(inputfile):
+        return parse_files([inputfile])
+    print(u'parsing ' + inputfile, file=sys.stderr)
+    if inputfile == u'-':
+        return convert(sys.stdin.read())
+    with open(inputfile, 'rb') as f:
+        return convert(f.read())
+
+
+def sieve_files(paths):
+    '''Return the files of paths, directories being replaced by the .sieve
+    files they contain, recursively and sorted by name'''
+    files = []
+    for path in paths:
+        if path == u'-' or not os.path.isdir(path):
+            files.append(path)
+            continue
+        for (directory, subdirectories, names) in os.walk(path):
+            subdirectories.sort()
+            files.extend(os.path.join(directory, name)
+                         for name in sorted(names) if name.endswith(u'.sieve'))
+    return files
+
+
+def convert_source(item):
+    '''convert_stream() of a (name, source) pair in a worker process, also
+    return its statistics'''
+    (name, source) = item
+    stats.reset()
+    print(u'parsing ' + name, file=sys.stderr)
+    return (convert_stream(io.BytesIO(source)), stats.snapshot())
+
+
+def parse_files(paths, jobs=None, cache=True):
+    '''parse sieve files and directories, '-' for stdin, and return their
+    rules converted to Zimbra format in order, or None if one of them cannot
+    be parsed
+
+    files already converted are taken from the parse cache, the others are
+    parsed over a pool of jobs processes, all CPUs by default'''
+    files = sieve_files(paths)
+    sources = []
+    for path in files:
+        if path == u'-':
+            sources.append(sys.stdin.read())
+        else:
+            with open(path, 'rb') as f:
+                sources.append(f.read())
+    keys = [source_key(source) for source in sources]
+    results = [cached_rules(key) if cache else None for key in keys]
+    missing = [i for (i, rules) in enumerate(results) if rules is None]
+    stats.count(u'parse_cache_hits', len(files) - len(missing))
+
+    if jobs == 1 or len(missing) < 2:
+        for i in missing:
+            print(u'parsing ' + files[i], file=sys.stderr)
+            results[i] = convert_stream(io.BytesIO(sources[i]))
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(jobs or multiprocessing.cpu_count(),
+                                        len(missing)))
+        try:
+            converted = pool.imap(convert_source,
+                                  [(files[i], sources[i]) for i in missing])
+            for (i, (rules, snapshot)) in zip(missing, converted):
+                stats.merge(snapshot)
+                results[i] = rules
+        finally:
+            pool.close()
+            pool.join()
+
+    if any(rules is None for rules in results):
+        return None
+    if cache:
+        for i in missing:
+            store_rules(keys[i], results[i])
+    return [rule for rules in results for rule in rules]
+
+
+SIEVE_HEADER = u'require ["date", "relational", "fileinto",' + \
+    u' "imap4flags", "body", "variables"];\n\n'
+
+
+def show_rules(rules):
+    '''yield a Sieve file corresponding to Zimbra filter rules, rule by rule
+
+    rules can be any iterable, only one rule is rendered at a time'''
+    yield SIEVE_HEADER
     for rule in rules:
-        display_rule(rule)
-        print(u'')
+        stats.count(u'rules_rendered')
+        yield show_rule(rule) + u'\n'
+
 
+def display_rules(rules, out=None):
+    '''write out a Sieve file corresponding to Zimbra filter rules
 
-def update_rules(comm, token, rules):
+    to standard output by default, with a single write per rule'''
+    out = out or sys.stdout
+    with stats.span(u'render'):
+        for chunk in show_rules(rules):
+            out.write(chunk)
+
+
+def as_list(value):
+    '''Zimbra responses do not use a list when there is a single element'''
+    if value is None:
+        return []
+    if not isinstance(value, list):
+        return [value]
+    return value
+
+
+def filter_rules(rules):
+    '''Return the list of rules of a GetFilterRulesResponse'''
+    return as_list(rules[u'filterRules'].get(u'filterRule'))
+
+
+def fetch_rules(comm, token):
+    '''Get the current filter rules of an account, or None on fault'''
+    response = communicate(comm, token, u'GetFilterRulesRequest', {})
+    if response.is_fault():
+        return None
+    rules = response.get_response()[u'GetFilterRulesResponse']
+    record_snapshot(token, filter_rules(rules), u'fetched')
+    return rules
+
+
+def filter_request(verb, outgoing=False):
+    '''Name of the request getting or modifying incoming or outgoing
+    filters'''
+    return verb + (u'Outgoing' if outgoing else u'') + u'FilterRulesRequest'
+
+
+# what we need to know of an account, fetched in a single batch
+FILTER_REQUESTS = [
+    (u'GetFilterRulesRequest', {}),
+    (u'GetOutgoingFilterRulesRequest', {}),
+]
+TARGET_REQUESTS = [
+    (u'GetFolderRequest', {}),
+    (u'GetTagRequest', {}),
+]
+ACCOUNT_REQUESTS = FILTER_REQUESTS + TARGET_REQUESTS
+
+
+def fetch_account(comm, token, requests=ACCOUNT_REQUESTS):
+    '''Get the incoming and outgoing filter rules, the folders and the tags
+    of an account, or only some of them, in a single round trip
+
+    return a dict mapping their request names to their responses, or to
+    None for the ones that failed'''
+    account = {}
+    responses = communicate_batch(comm, token, requests)
+    for ((request_type, _), response) in zip(requests, responses):
+        if response.is_fault():
+            account[request_type] = None
+        else:
+            account[request_type] = response.get_response()[
+                request_type[:-len(u'Request')] + u'Response']
+    for outgoing in [False, True]:
+        rules = account.get(filter_request(u'Get', outgoing))
+        if rules is not None:
+            record_snapshot(token, filter_rules(rules), u'fetched', outgoing)
+    return account
+
+
+# elements of the folder tree of a GetFolderResponse: folders, mountpoints
+# of shared folders and search folders
+FOLDER_ELEMENTS = [u'folder', u'link', u'search']
+
+
+def folder_paths(folders):
+    '''Return the set of paths of a GetFolderResponse, without leading /'''
+    paths = set()
+    pending = [folders]
+    while pending:
+        folder = pending.pop()
+        paths.add(folder.get(u'absFolderPath', u'').lstrip(u'/'))
+        for element in FOLDER_ELEMENTS:
+            pending.extend(as_list(folder.get(element)))
+    paths.discard(u'')
+    return paths
+
+
+def tag_names(tags):
+    '''Return the set of names of a GetTagResponse'''
+    return set(tag[u'name'] for tag in as_list(tags.get(u'tag')))
+
+
+class TargetIndex(object):
+    '''The folders and tags of an account, to check the targets of fileinto
+    and tag actions
+
+    folders are kept in a trie of their lowercase names, like Zimbra names
+    they are case insensitive'''
+    def __init__(self, folders, tags, cached=False):
+        self.folders = sorted(folders)
+        self.tags = sorted(tags)
+        self.cached = cached
+        self.trie = {}
+        for path in self.folders:
+            node = self.trie
+            for name in path.lower().split(u'/'):
+                node = node.setdefault(name, {})
+        self.tag_set = set(tag.lower() for tag in self.tags)
+
+    def missing_folder(self, path):
+        '''Return None if the folder exists, else its longest existing
+        parent, u'' for the root'''
+        node = self.trie
+        found = []
+        for name in path.strip(u'/').split(u'/'):
+            node = node.get(name.lower())
+            if node is None:
+                return u'/'.join(found)
+            found.append(name)
+        return None
+
+    def problems(self, rules):
+        '''Return the list of unknown folders and tags used by rules'''
+        problems = []
+        for rule in rules:
+            actions = rule[u'filterActions']
+            for action in as_list(actions.get(u'actionFileInto')):
+                parent = self.missing_folder(action[u'folderPath'])
+                if parent is not None:
+                    problems.append(
+                        u'unknown folder ' + action[u'folderPath'] +
+                        u' in rule ' + rule[u'name'] +
+                        (u' (' + parent + u' exists)' if parent else u''))
+            for action in as_list(actions.get(u'actionTag')):
+                if action[u'tagName'].lower() not in self.tag_set:
+                    problems.append(u'unknown tag ' + action[u'tagName'] +
+                                    u' in rule ' + rule[u'name'])
+        return problems
+
+
+# seconds during which the folders and tags of an account are reused
+TARGETS_TTL = 3600
+
+
+def targets_cache_path(url, login):
+    '''File caching the folders and tags of an account'''
+    key = hashlib.sha1((url + u'\0' + login).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir(), u'targets', key + u'.json')
+
+
+def cached_targets(url, login):
+    '''Return the TargetIndex of an account if it was cached less than
+    TARGETS_TTL seconds ago, or None'''
+    path = targets_cache_path(url, login)
+    try:
+        if time.time() - os.path.getmtime(path) > TARGETS_TTL:
+            return None
+        with io.open(path, encoding=u'utf-8') as f:
+            (folders, tags) = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    return TargetIndex(folders, tags, cached=True)
+
+
+def store_targets(url, login, index):
+    '''Save the folders and tags of an account in the cache'''
+    try:
+        store_json(targets_cache_path(url, login),
+                   [index.folders, index.tags])
+    except (IOError, OSError) as e:
+        print(u'Warning: could not cache folders and tags: ' + unicode(e),
+              file=sys.stderr)
+
+
+def account_targets(comm, token, url, login, account=None, cache=True):
+    '''Return the TargetIndex of an account
+
+    from account, a result of fetch_account(), if it has folders and tags,
+    else from the cache unless cache is False, else from the server. None
+    if they could not be fetched'''
+    if account is None or account.get(u'GetFolderRequest') is None or \
+            account.get(u'GetTagRequest') is None:
+        index = cached_targets(url, login) if cache else None
+        if index is not None:
+            return index
+        account = fetch_account(comm, token, TARGET_REQUESTS)
+    folders = account[u'GetFolderRequest']
+    tags = account[u'GetTagRequest']
+    if folders is None or tags is None:
+        return None
+    index = TargetIndex(folder_paths(folders), tag_names(tags))
+    store_targets(url, login, index)
+    return index
+
+
+def target_problems(comm, token, rules, account=None):
+    '''Return the unknown folders and tags used by rules, or None if they
+    could not be checked
+
+    folders and tags from the cache are fetched again before reporting a
+    problem, they may have been created since'''
+    index = account_targets(comm, token, token.url, token.login, account)
+    if index is not None and index.cached and index.problems(rules):
+        index = account_targets(comm, token, token.url, token.login,
+                                cache=False)
+    if index is None:
+        return None
+    return index.problems(rules)
+
+
+def canonical_rule(rule):
+    '''Normalize a Zimbra rule, either from zimbrify() or from the server
+
+    all values are strings and all categories are lists sorted by index'''
+    rule = as_rule(rule).to_dict(lists=True)
+    for group in [rule[u'filterTests'], rule[u'filterActions']]:
+        for items in group.values():
+            if isinstance(items, list):
+                items[:] = [dict((unicode(k), unicode(v))
+                                 for (k, v) in item.items())
+                            for item in items]
+    return {
+        u'name': unicode(rule[u'name']), u'active': unicode(rule[u'active']),
+        u'filterTests': rule[u'filterTests'],
+        u'filterActions': rule[u'filterActions']
+    }
+
+
+def rule_key(rule):
+    '''A string identifying the content of a rule, keys are sorted'''
+    return json.dumps(canonical_rule(rule), sort_keys=True)
+
+
+def diff_rules(old, new):
+    '''Compare two lists of rules, rule by rule
+
+    return a list of (change, name) where change is added, removed, changed
+    or moved, the latter when only the order of the rules changed. No change
+    means that there is nothing to upload.'''
+    def keyed(rules):
+        '''identify rules by name, and by occurrence for duplicate names'''
+        seen = {}
+        result = []
+        for rule in rules:
+            name = unicode(rule[u'name'])
+            seen[name] = seen.get(name, 0) + 1
+            result.append(((name, seen[name]), rule_key(rule)))
+        return result
+
+    old_keyed = keyed(old)
+    new_keyed = keyed(new)
+    old_rules = dict(old_keyed)
+    new_rules = dict(new_keyed)
+    changes = []
+    for (ident, key) in new_keyed:
+        if ident not in old_rules:
+            changes.append((u'added', ident[0]))
+        elif old_rules[ident] != key:
+            changes.append((u'changed', ident[0]))
+    for (ident, key) in old_keyed:
+        if ident not in new_rules:
+            changes.append((u'removed', ident[0]))
+    if not changes and \
+            [i for (i, _) in old_keyed] != [i for (i, _) in new_keyed]:
+        changes = [(u'moved', j[0]) for ((i, _), (j, _)) in
+                   zip(old_keyed, new_keyed) if i != j]
+    return changes
+
+
+def display_diff(changes):
+    '''print out a summary of the changes between two lists of rules'''
+    if not changes:
+        print(u'Filters are unchanged', file=sys.stderr)
+    for (change, name) in changes:
+        print(u'  ' + change + u': "' + name + u'"', file=sys.stderr)
+
+
+def upload_rules(comm, token, new_rules, rules, outgoing=False):
+    '''Upload new rules, re-uploading the original ones if it fails
+
+    return True if the new rules were accepted'''
+    request_type = filter_request(u'Modify', outgoing)
+    response = communicate(comm, token, request_type, new_rules)
+
+    if response.is_fault():
+        response = communicate(comm, token, request_type, rules)
+        if response.is_fault():
+            print(u'Uh oh! Updating your filters generated an error',
+                  file=sys.stderr)
+        else:
+            print(u'We could not change your filters, sorry.',
+                  file=sys.stderr)
+        return False
+    record_snapshot(token, filter_rules(new_rules), u'uploaded', outgoing)
+    return True
+
+
+def update_rules(comm, token, account, outgoing=False):
     '''If confirmed try to upload rules corresponding to a parse
 
-    if there is an issue, try to re-upload original rules'''
-    new_rules = {u'filterRules': {u'filterRule': parse()}}
+    account is the result of fetch_account(), nothing is uploaded when rules
+    did not change, if there is an issue, try to re-upload original rules'''
+    rules = account[filter_request(u'Get', outgoing)]
+    parsed = parse_files(sys.argv[1:])
+    if parsed is None:
+        exit(1)
+    changes = diff_rules(filter_rules(rules), parsed)
+    display_diff(changes)
+    if not changes:
+        return
+    if check_targets(comm, token, parsed, account):
+        exit(1)
+    new_rules = {u'filterRules': {u'filterRule': parsed}}
     confirm = raw_input(u'Do you wish to proceed [y/N]? ')
-    if not confirm[0] in [u'y', u'Y']:
+    if not confirm[:1] in [u'y', u'Y']:
         exit(0)
-        print(u'Uploading new filters', file=sys.stderr)
-        response = communicate(comm, token,
-                               u'ModifyFilterRulesRequest', new_rules)
-
-        if response.is_fault():
-            response = communicate(comm, token,
-                                   u'ModifyFilterRulesRequest', rules)
-            if response.is_fault():
-                print(u'Uh oh! Updating your filters generated an error',
+    print(u'Uploading new filters', file=sys.stderr)
+    if upload_rules(comm, token, new_rules, rules, outgoing):
+        print(u'Seems ok', file=sys.stderr)
+
+
+def snapshot_dir():
+    '''Directory of the snapshot store, $ZBT_SNAPSHOTS if set'''
+    return os.getenv('ZBT_SNAPSHOTS') or \
+        os.path.join(cache_dir(), u'snapshots')
+
+
+def object_path(key):
+    '''File of an object of the snapshot store, named after its hash'''
+    return os.path.join(snapshot_dir(), u'objects', key[:2],
+                        key[2:] + u'.json')
+
+
+def store_object(key, text):
+    '''Store the JSON text of an object, unless it is already there'''
+    path = object_path(key)
+    if not os.path.exists(path):
+        store_text(path, text)
+
+
+def load_object(key):
+    '''Return an object of the snapshot store'''
+    with io.open(object_path(key), encoding=u'utf-8') as f:
+        return json.load(f)
+
+
+def rule_hash(rule):
+    '''The hash of the canonical form of a rule'''
+    return hashlib.sha1(rule_key(rule).encode('utf-8')).hexdigest()
+
+
+def store_rule(rule):
+    '''Store the canonical form of a rule, return its hash'''
+    text = unicode(rule_key(rule))
+    key = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    store_object(key, text)
+    return key
+
+
+def snapshot_index_path(url, login):
+    '''File listing the snapshots of an account, one JSON object per line'''
+    key = hashlib.sha1((url + u'\0' + login).encode('utf-8'))
+    return os.path.join(snapshot_dir(), u'index', key.hexdigest() + u'.ndjson')
+
+
+def read_snapshots(url, login):
+    '''Return the snapshots of an account, oldest first, as dicts of their
+    id, time, kind, direction and number of rules'''
+    entries = []
+    try:
+        with io.open(snapshot_index_path(url, login), encoding=u'utf-8') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # an interrupted write
+                    pass
+    except (IOError, OSError):
+        pass
+    return entries
+
+
+def latest_snapshot(url, login, outgoing=False):
+    '''Return the latest snapshot of the incoming or outgoing filters of an
+    account, or None'''
+    for entry in reversed(read_snapshots(url, login)):
+        if entry[u'outgoing'] == outgoing:
+            return entry
+    return None
+
+
+def store_snapshot(url, login, keys, kind, outgoing=False):
+    '''Store the rule hashes of a snapshot and add it to the index of the
+    account, unless the filters did not change since its latest snapshot
+
+    a snapshot is identified by the hash of its list of rule hashes'''
+    text = unicode(json.dumps(keys))
+    snapshot = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    store_object(snapshot, text)
+    latest = latest_snapshot(url, login, outgoing)
+    if latest is not None and latest[u'id'] == snapshot:
+        return snapshot
+    entry = {u'id': snapshot, u'time': int(time.time()), u'kind': kind,
+             u'outgoing': outgoing, u'rules': len(keys)}
+    path = snapshot_index_path(url, login)
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    with io.open(path, u'a', encoding=u'utf-8') as f:
+        f.write(unicode(json.dumps(entry, sort_keys=True)) + u'\n')
+    return snapshot
+
+
+def recorded(rules, token, kind, outgoing=False):
+    '''Yield rules while storing them, then store their snapshot
+
+    nothing is stored for tokens not bound to an account, and a store that
+    cannot be written only gives a warning'''
+    keys = [] if isinstance(token, AuthToken) else None
+    for rule in rules:
+        if keys is not None:
+            try:
+                keys.append(store_rule(rule))
+            except (IOError, OSError) as e:
+                print(u'could not store snapshot: ' + unicode(e),
                       file=sys.stderr)
+                keys = None
+        yield rule
+    if keys is not None:
+        try:
+            store_snapshot(token.url, token.login, keys, kind, outgoing)
+        except (IOError, OSError) as e:
+            print(u'could not store snapshot: ' + unicode(e), file=sys.stderr)
+
+
+def record_snapshot(token, rules, kind, outgoing=False):
+    '''Store a snapshot of the rules of the account of a token'''
+    for _ in recorded(rules, token, kind, outgoing):
+        pass
+
+
+def find_snapshot(url, login, prefix):
+    '''Return the latest snapshot of an account whose id starts with prefix,
+    None if there is none or if the prefix is ambiguous'''
+    entries = [entry for entry in read_snapshots(url, login)
+               if entry[u'id'].startswith(prefix)]
+    if not entries:
+        print(u'no snapshot ' + prefix, file=sys.stderr)
+        return None
+    if len(set(entry[u'id'] for entry in entries)) > 1:
+        print(u'ambiguous snapshot ' + prefix, file=sys.stderr)
+        return None
+    return entries[-1]
+
+
+def load_snapshot(snapshot):
+    '''Return the rules of a stored snapshot'''
+    return [load_object(key) for key in load_object(snapshot)]
+
+
+def current_rules(comm, token, outgoing=False):
+    '''Return the rules of an account fetched from the server, or those of
+    its latest snapshot if they cannot be fetched'''
+    try:
+        rules = stream_rules(comm, token, outgoing)
+        if rules is not None:
+            return list(rules)
+    except IOError as e:
+        print(unicode(e), file=sys.stderr)
+    print(u'Warning: could not get the filters, comparing with the latest '
+          u'snapshot', file=sys.stderr)
+    return load_snapshot(latest_snapshot(token.url, token.login,
+                                         outgoing)[u'id'])
+
+
+def rollback(url, login, snapshot):
+    '''Upload the rules of a stored snapshot, unless they are those of the
+    server: the current rules are re-uploaded if it fails
+
+    return True if the rules were accepted or unchanged'''
+    outgoing = snapshot[u'outgoing']
+    rules = load_snapshot(snapshot[u'id'])
+    token = get_token(url, login)
+    if token is None:
+        return False
+    comm = get_connection(url)
+    current = current_rules(comm, token, outgoing)
+    changes = diff_rules(current, rules)
+    display_diff(changes)
+    if not changes:
+        return True
+    if check_targets(comm, token, rules):
+        return False
+    print(u'Uploading snapshot ' + snapshot[u'id'][:12], file=sys.stderr)
+    return upload_rules(comm, token,
+                        {u'filterRules': {u'filterRule': rules}},
+                        {u'filterRules': {u'filterRule': current}},
+                        outgoing)
+
+
+def snapshots(args):
+    '''Command line entry point of the snapshot store'''
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog=basename(sys.argv[0]) + u' snapshots',
+        description=u'list, show or roll back to stored filters')
+    parser.add_argument(u'action', nargs=u'?', default=u'list',
+                        choices=[u'list', u'show', u'rollback'])
+    parser.add_argument(u'snapshot', nargs=u'?',
+                        help=u'id of the snapshot, or its beginning')
+    parser.add_argument(u'-o', u'--output', default=u'-',
+                        help=u'sieve file written by show')
+    parser.add_argument(u'--login', help=u'account of the snapshots')
+    options = parser.parse_args(args)
+
+    url = server_url()
+    login = unicode(options.login or default_login())
+    if options.action == u'list':
+        for entry in read_snapshots(url, login):
+            print(u'{0} {1} {2:<8} {3:<8} {4} rules'.format(
+                entry[u'id'][:12],
+                datetime.fromtimestamp(entry[u'time']).strftime(
+                    '%Y-%m-%d %H:%M:%S'),
+                entry[u'kind'],
+                u'outgoing' if entry[u'outgoing'] else u'incoming',
+                entry[u'rules']))
+        return 0
+    if options.snapshot is None:
+        parser.error(u'which snapshot?')
+    snapshot = find_snapshot(url, login, options.snapshot)
+    if snapshot is None:
+        return 1
+    if options.action == u'show':
+        with open_output(options.output) as out:
+            display_rules(load_snapshot(snapshot[u'id']), out)
+        return 0
+    if not rollback(url, login, snapshot):
+        return 1
+    print(u'Seems ok', file=sys.stderr)
+    return 0
+
+
+# faults after which we authenticate again
+AUTH_FAULTS = [u'service.AUTH_EXPIRED', u'service.AUTH_REQUIRED']
+
+
+def communicate(comm, token, request_type, request_args, renew=True):
+    '''Send a request to Zimbra SOAP API and return response
+
+    if the token was rejected, renew it and send the request once again'''
+    (Request, Response, _) = soap_classes()
+    request = Request()
+    request.set_auth_token(unicode(token))
+    request.add_request(request_type, request_args, u'urn:zimbraMail')
+
+    response = Response()
+    stats.count(u'requests')
+    with stats.span(u'soap'):
+        comm.send_request(request, response)
+    if renew and isinstance(token, AuthToken) and response.is_fault() and \
+            response.get_fault_code() in AUTH_FAULTS and token.renew():
+        return communicate(comm, token, request_type, request_args, False)
+    return response
+
+
+class BatchedResponse(object):
+    '''The response to one of the requests of a batch, used like the
+    response of a single request'''
+    def __init__(self, response):
+        self.response = response
+
+    def is_fault(self):
+        return u'Fault' in self.response
+
+    def get_response(self):
+        return self.response
+
+    def get_fault_code(self):
+        return self.response[u'Fault'][u'Detail'][u'Error'][u'Code']
+
+
+def communicate_batch(comm, token, requests, renew=True):
+    '''Send several requests to Zimbra SOAP API in a single BatchRequest
+
+    requests is a list of (request_type, request_args), return the list of
+    their responses in the same order. If the token was rejected, renew it
+    and send the requests once again'''
+    (Request, Response, _) = soap_classes()
+    request = Request()
+    request.set_auth_token(unicode(token))
+    request.enable_batch()
+    ids = [request.add_request(request_type, request_args, u'urn:zimbraMail')
+           for (request_type, request_args) in requests]
+
+    response = Response()
+    stats.count(u'requests', len(requests))
+    stats.count(u'batches')
+    with stats.span(u'soap'):
+        comm.send_request(request, response)
+    if response.is_batch():
+        responses = [BatchedResponse(response.get_response(request_id))
+                     for request_id in ids]
+    else:
+        # the whole batch was rejected
+        responses = [BatchedResponse(response.get_response())] * len(ids)
+    if renew and isinstance(token, AuthToken) and \
+            any(r.is_fault() and r.get_fault_code() in AUTH_FAULTS
+                for r in responses) and token.renew():
+        return communicate_batch(comm, token, requests, False)
+    return responses
+
+
+class CountingReader(object):
+    '''A file counting the bytes read from it, and the time spent reading'''
+    def __init__(self, stream):
+        self.stream = stream
+        self.seconds = 0.0
+
+    def read(self, size=-1):
+        start = time.time()
+        data = self.stream.read(size)
+        self.seconds += time.time() - start
+        stats.count(u'bytes_received', len(data))
+        return data
+
+
+def element_dict(element):
+    '''Return the dict of an ElementTree element, in the format of the dicts
+    of pythonzimbra responses'''
+    result = dict((unicode(key), unicode(value))
+                  for (key, value) in element.attrib.items())
+    for child in element:
+        add_to_category(result, unicode(child.tag.rpartition(u'}')[2]),
+                        element_dict(child))
+    if element.text is not None and \
+            (len(element) == 0 or element.text.strip()):
+        result[u'_content'] = unicode(element.text)
+    return result
+
+
+def iter_rules(stream, waited=0.0):
+    '''Yield the rules of a GetFilterRulesResponse stream one at a time, as
+    they are parsed, each one being dropped once yielded
+
+    the soap phase is the time spent reading the stream, plus the seconds
+    waited for the response, not the time taken by the consumer'''
+    from xml.etree.cElementTree import iterparse
+    reader = CountingReader(stream)
+    rules = None
+    try:
+        for (event, element) in iterparse(reader, ('start', 'end')):
+            tag = element.tag.rpartition(u'}')[2]
+            if event == 'start':
+                if tag == u'filterRules':
+                    rules = element
+            elif tag == u'filterRule' and rules is not None:
+                yield element_dict(element)
+                rules.remove(element)
+    finally:
+        stats.add_span(u'soap', waited + reader.seconds)
+        stream.close()
+
+
+def stream_rules(comm, token, outgoing=False, renew=True):
+    '''Get the filter rules of an account as they are received
+
+    return an iterator over the rules, so that memory does not grow with
+    their number, or None on fault. If the token was rejected, renew it and
+    send the request once again'''
+    import urllib2
+    (Request, Response, _) = soap_classes()
+    request = Request()
+    request.set_auth_token(unicode(token))
+    request.add_request(filter_request(u'Get', outgoing), {},
+                        u'urn:zimbraMail')
+    stats.count(u'requests')
+    # as Communication.send_request(), which reads the whole response first
+    start = time.time()
+    try:
+        stream = urllib2.urlopen(
+            comm.url, request.get_request().encode('utf-8'),
+            comm.timeout, context=comm.context)
+    except urllib2.HTTPError as e:
+        stats.add_span(u'soap', time.time() - start)
+        if e.code != 500:
+            raise
+        response = Response()
+        response.set_response(e.fp.read())
+        if renew and isinstance(token, AuthToken) and \
+                response.get_fault_code() in AUTH_FAULTS and token.renew():
+            return stream_rules(comm, token, outgoing, False)
+        return None
+    return recorded(iter_rules(stream, time.time() - start), token,
+                    u'fetched', outgoing)
+
+
+# per server semaphores and connections of a fleet worker
+_server_slots = {}
+_connections = {}
+
+
+def read_manifest(manifest, url=None):
+    '''Read a fleet manifest
+
+    one account per line, optionally followed by a sieve file to upload and
+    by the URL of its server. Empty lines and lines starting with # are
+    ignored, '-' for the sieve file means download only. The default URL is
+    the one of server_url().'''
+    url = url or server_url()
+    jobs = []
+    for line in manifest:
+        fields = line.split()
+        if not fields or fields[0].startswith(u'#'):
+            continue
+        sieve = None
+        if len(fields) > 1 and fields[1] != u'-':
+            sieve = fields[1]
+        server = fields[2] if len(fields) > 2 else url
+        jobs.append((unicode(fields[0]), sieve, unicode(server)))
+    return jobs
+
+
+def init_fleet_worker(slots, tokens=None):
+    '''Store the per server semaphores in a (thread or process) worker
+
+    tokens are given to worker processes, which never prompt for passwords'''
+    _server_slots.update(slots)
+    if tokens is not None:
+        _minted_tokens.update(tokens)
+        _no_prompt.append(True)
+
+
+def fleet_tokens(jobs):
+    '''Get in this process the tokens of the accounts of fleet jobs that
+    would need a password prompt
+
+    return the tokens kept in memory, to hand them to worker processes, the
+    others are in the token cache'''
+    if not can_mint():
+        for (url, account) in sorted(set((job[2], job[0]) for job in jobs)):
+            if cached_token(url, account) is None:
+                get_token(url, account)
+    elif preauth_key() is None:
+        for url in sorted(set(job[2] for job in jobs)):
+            admin_token(url)
+    return dict(_minted_tokens)
+
+
+def get_connection(url):
+    '''Reuse a single Communication per server in each worker'''
+    if url not in _connections:
+        _connections[url] = soap_classes()[2](url)
+    return _connections[url]
+
+
+def sync_account(job):
+    '''Fetch, convert and possibly upload the filters of a fleet account
+
+    return a tuple (account, ok, message)'''
+    (account, sieve, url, outdir) = job
+    try:
+        # a password prompt does not hold a slot of the server
+        token = get_token(url, account)
+        if token is None:
+            return (account, False, u'authentication failed')
+        with _server_slots[url]:
+            comm = get_connection(url)
+            if sieve is None:
+                rules = stream_rules(comm, token)
+                if rules is None:
+                    return (account, False, u'could not get filters')
+                filename = os.path.join(outdir, account + u'.sieve')
+                tmp = filename + u'.' + unicode(os.getpid()) + u'.tmp'
+                try:
+                    with io.open(tmp, u'w', encoding=u'utf-8') as out:
+                        display_rules(rules, out)
+                    os.rename(tmp, filename)
+                finally:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+                return (account, True, u'saved to ' + filename)
+            rules = fetch_rules(comm, token)
+            if rules is None:
+                return (account, False, u'could not get filters')
+            new_rules = parse(sieve)
+            if new_rules is None:
+                return (account, False, u'could not parse ' + sieve)
+            changes = diff_rules(filter_rules(rules), new_rules)
+            if not changes:
+                return (account, True, u'unchanged')
+            problems = target_problems(comm, token, new_rules)
+            if problems:
+                return (account, False, u', '.join(problems))
+            if not upload_rules(comm, token,
+                                {u'filterRules': {u'filterRule': new_rules}},
+                                rules):
+                return (account, False, u'upload failed')
+            message = u'uploaded ' + sieve + u', ' + unicode(len(changes)) + \
+                u' rule(s) changed'
+            if problems is None:
+                message += u', could not check folders and tags'
+            return (account, True, message)
+    except Exception as e:
+        return (account, False, unicode(e))
+
+
+def process_task(job):
+    '''Run a (task, job) in a worker process, also return its statistics'''
+    stats.reset()
+    (task, job) = job
+    return (task(job), stats.snapshot())
+
+
+def run_fleet(jobs, workers=8, per_server=4, processes=False, outdir=u'.',
+              task=sync_account):
+    '''Synchronize many accounts, or run another task on them, over a
+    bounded pool of workers
+
+    at most per_server accounts of the same server are handled at once.
+    Yield the result of the task, (account, ok, message) for
+    sync_account(), as each account is done.'''
+    import multiprocessing
+    from multiprocessing.pool import ThreadPool
+    if processes:
+        semaphore = multiprocessing.BoundedSemaphore
+    else:
+        semaphore = threading.BoundedSemaphore
+    slots = dict((url, semaphore(per_server))
+                 for url in set(job[2] for job in jobs))
+    # passwords are asked here, workers do not wait for a prompt, worker
+    # processes do not prompt at all
+    tokens = fleet_tokens(jobs)
+    if processes:
+        pool = multiprocessing.Pool(workers, init_fleet_worker,
+                                    (slots, tokens))
+    else:
+        pool = ThreadPool(workers, init_fleet_worker, (slots,))
+    jobs = [job + (outdir,) for job in jobs]
+    try:
+        if processes:
+            for (result, snapshot) in pool.imap_unordered(
+                    process_task, [(task, job) for job in jobs]):
+                stats.merge(snapshot)
+                yield result
+        else:
+            for result in pool.imap_unordered(task, jobs):
+                yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def fleet(args):
+    '''Command line entry point of the fleet mode'''
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog=basename(sys.argv[0]) + u' fleet',
+        description=u'synchronize the filters of many accounts')
+    parser.add_argument(u'manifest',
+                        help=u"list of accounts, '-' for standard input")
+    parser.add_argument(u'-j', u'--jobs', type=int, default=8,
+                        help=u'number of concurrent workers')
+    parser.add_argument(u'--per-server', type=int, default=4,
+                        help=u'maximum concurrent accounts per server')
+    parser.add_argument(u'--processes', action=u'store_true',
+                        help=u'use a process pool instead of threads')
+    parser.add_argument(u'-o', u'--output-dir', default=u'.',
+                        help=u'where downloaded sieve files are saved')
+    options = parser.parse_args(args)
+
+    # accounts without a server use the one of --url, see main()
+    if options.manifest == u'-':
+        jobs = read_manifest(sys.stdin)
+    else:
+        with io.open(options.manifest, encoding=u'utf-8') as manifest:
+            jobs = read_manifest(manifest)
+
+    failed = 0
+    for (account, ok, message) in run_fleet(
+            jobs, options.jobs, options.per_server, options.processes,
+            options.output_dir):
+        if not ok:
+            failed += 1
+        print(u'\t'.join([account, u'ok' if ok else u'FAILED', message]))
+    print(unicode(len(jobs) - failed) + u'/' + unicode(len(jobs)) +
+          u' accounts synchronized', file=sys.stderr)
+    return 1 if failed else 0
+
+
+class RuleTemplate(object):
+    '''The rules of a template rule set, indexed by the hash of their
+    canonical form, so that comparing an account with it only hashes the
+    rules of the account'''
+    def __init__(self, rules):
+        self.rules = [(rule_hash(rule), rule[u'name']) for rule in rules]
+        self.counts = {}
+        for (key, _) in self.rules:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def drift(self, rules):
+        '''Compare the rules of an account with the template
+
+        return the names of the missing template rules, of the extra rules,
+        and of the modified ones: template rules whose name is still used
+        by a rule that differs'''
+        found = {}
+        others = []
+        for rule in rules:
+            key = rule_hash(rule)
+            if found.get(key, 0) < self.counts.get(key, 0):
+                found[key] = found.get(key, 0) + 1
             else:
-                print(u'We could not change your filters, sorry.',
-                      file=sys.stderr)
+                others.append(rule[u'name'])
+        unmatched = {}
+        for name in others:
+            unmatched[name] = unmatched.get(name, 0) + 1
+        missing = []
+        modified = []
+        for (key, name) in self.rules:
+            if found.get(key):
+                found[key] -= 1
+                continue
+            if unmatched.get(name):
+                unmatched[name] -= 1
+                modified.append(name)
+            else:
+                missing.append(name)
+        extra = []
+        for name in reversed(others):
+            if unmatched[name]:
+                unmatched[name] -= 1
+                extra.append(name)
+        return (missing, extra[::-1], modified)
+
+
+def drift_account(job):
+    '''Fetch the filters of a fleet account and compare them with its
+    template
+
+    return a tuple (account, drift, message) where drift is the result of
+    RuleTemplate.drift(), or None if the filters could not be fetched'''
+    (account, template, url, _) = job
+    try:
+        token = get_token(url, account)
+        if token is None:
+            return (account, None, u'authentication failed')
+        with _server_slots[url]:
+            comm = get_connection(url)
+            rules = stream_rules(comm, token)
+            if rules is None:
+                return (account, None, u'could not get filters')
+            return (account, template.drift(rules), None)
+    except Exception as e:
+        return (account, None, unicode(e))
+
+
+def drift_message(result):
+    '''Describe the missing, extra and modified rules of an account'''
+    parts = []
+    for (label, names) in zip([u'missing', u'extra', u'modified'], result):
+        if names:
+            parts.append(label + u' ' + u', '.join(u'"' + name + u'"'
+                                                   for name in names))
+    return u'; '.join(parts) or u'matches its template'
+
+
+def drift(args):
+    '''Command line entry point of the drift report'''
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog=basename(sys.argv[0]) + u' drift',
+        description=u'compare the filters of many accounts with templates')
+    parser.add_argument(u'manifest',
+                        help=u"list of accounts, '-' for standard input")
+    parser.add_argument(u'-t', u'--template', action=u'append', default=[],
+                        help=u'sieve template of the accounts without one, '
+                        u'several ones are concatenated')
+    parser.add_argument(u'-j', u'--jobs', type=int, default=8,
+                        help=u'number of concurrent workers')
+    parser.add_argument(u'--per-server', type=int, default=4,
+                        help=u'maximum concurrent accounts per server')
+    parser.add_argument(u'--processes', action=u'store_true',
+                        help=u'use a process pool instead of threads')
+    parser.add_argument(u'--ndjson', action=u'store_true',
+                        help=u'write one JSON object per account')
+    options = parser.parse_args(args)
+
+    # accounts without a server use the one of --url, see main()
+    if options.manifest == u'-':
+        jobs = read_manifest(sys.stdin)
+    else:
+        with io.open(options.manifest, encoding=u'utf-8') as manifest:
+            jobs = read_manifest(manifest)
+
+    # each template is parsed and indexed once
+    templates = {}
+    for paths in set((sieve,) if sieve else tuple(options.template)
+                     for (_, sieve, _) in jobs):
+        if not paths:
+            print(u'no template for some accounts', file=sys.stderr)
+            return 1
+        rules = parse_files(list(paths))
+        if rules is None:
+            return 1
+        templates[paths] = RuleTemplate(rules)
+    jobs = [(account,
+             templates[(sieve,) if sieve else tuple(options.template)], url)
+            for (account, sieve, url) in jobs]
+
+    failed = 0
+    drifted = 0
+    with open_output(u'-') as out:
+        for (account, result, message) in run_fleet(
+                jobs, options.jobs, options.per_server, options.processes,
+                task=drift_account):
+            if result is None:
+                failed += 1
+            elif any(result):
+                drifted += 1
+            if options.ndjson:
+                if result is None:
+                    entry = {u'account': account, u'error': message}
+                else:
+                    entry = dict(zip([u'missing', u'extra', u'modified'],
+                                     result), account=account)
+                write_ndjson([entry], out)
+            elif result is None:
+                out.write(u'\t'.join([account, u'FAILED', message]) + u'\n')
+            else:
+                out.write(u'\t'.join([
+                    account, u'drifted' if any(result) else u'ok',
+                    drift_message(result)]) + u'\n')
+    print(u'{0}/{1} accounts drifted, {2} failed'.format(
+        drifted, len(jobs), failed), file=sys.stderr)
+    return 1 if failed else 0
+
+
+def file_signature(path):
+    '''Return what changes when a file is written, None if it is missing'''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+
+def watch_rules(paths, interval=1.0, debounce=0.5, sleep=time.sleep):
+    '''Yield the rules of sieve files, first then each time they change
+
+    files are polled every interval seconds, and once a change is seen its
+    files have to stay unchanged for debounce seconds. Only changed files
+    are parsed again, nothing is yielded while one of them is invalid.'''
+    signatures = {}
+    rules = {}
+    while True:
+        changed = [p for p in paths if file_signature(p) != signatures.get(p)]
+        if not changed:
+            sleep(interval)
+            continue
+        while True:
+            seen = dict((p, file_signature(p)) for p in changed)
+            sleep(debounce)
+            if all(file_signature(p) == seen[p] for p in changed):
+                break
+        for path in changed:
+            signatures[path] = seen[path]
+            if seen[path] is None:
+                print(u'Warning: ' + path + u' is missing', file=sys.stderr)
+                rules[path] = None
+            else:
+                rules[path] = parse(path)
+        if all(rules[p] is not None for p in paths):
+            yield [rule for p in paths for rule in rules[p]]
+
+
+def check_targets(comm, token, rules, account=None):
+    '''Print and return the unknown folders and tags used by rules'''
+    problems = target_problems(comm, token, rules, account)
+    if problems is None:
+        print(u'Warning: could not check folders and tags', file=sys.stderr)
+        return []
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    return problems
+
+
+def push_rules(comm, token, uploaded, rules, outgoing=False):
+    '''Upload rules without confirmation if they differ from the uploaded
+    ones, return True if they were uploaded'''
+    changes = diff_rules(uploaded, rules)
+    display_diff(changes)
+    if not changes or check_targets(comm, token, rules):
+        return False
+    print(u'Uploading new filters', file=sys.stderr)
+    return upload_rules(comm, token,
+                        {u'filterRules': {u'filterRule': rules}},
+                        {u'filterRules': {u'filterRule': uploaded}},
+                        outgoing)
+
+
+def watch(args):
+    '''Command line entry point of the watch mode'''
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog=basename(sys.argv[0]) + u' watch',
+        description=u'upload sieve files each time they change')
+    parser.add_argument(u'sieve', nargs=u'+',
+                        help=u'sieve files, their rules are concatenated')
+    parser.add_argument(u'--interval', type=float, default=1.0,
+                        help=u'seconds between checks of the files')
+    parser.add_argument(u'--debounce', type=float, default=0.5,
+                        help=u'seconds without change before an upload')
+    parser.add_argument(u'--outgoing', action=u'store_true',
+                        help=u'watch the filters of outgoing mail')
+    options = parser.parse_args(args)
+
+    url = server_url()
+    token = get_token(url)
+    if token is None:
+        return 1
+    comm = get_connection(url)
+    request_type = filter_request(u'Get', options.outgoing)
+    account = fetch_account(comm, token, FILTER_REQUESTS)
+    if account[request_type] is None:
+        print(u'could not get filters', file=sys.stderr)
+        return 1
+    uploaded = filter_rules(account[request_type])
+    try:
+        for rules in watch_rules(options.sieve, options.interval,
+                                 options.debounce):
+            if push_rules(comm, token, uploaded, rules, options.outgoing):
+                print(u'Seems ok', file=sys.stderr)
+                uploaded = rules
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+# values of a blocklist in each of its rules
+BLOCK_SHARD_SIZE = 100
+
+
+class Blocklist(object):
+    '''Sender addresses, or domains, spread over rules named "name 1",
+    "name 2"... of at most shard_size tests each
+
+    values are case insensitive. A value keeps its rule when others are
+    added or removed, so that a change only modifies the rule holding it.'''
+    def __init__(self, name, shards=(), shard_size=BLOCK_SHARD_SIZE):
+        self.name = name
+        self.shard_size = shard_size
+        self.shards = [set(values) for values in shards]
+        self.index = dict((value, number)
+                          for (number, values) in enumerate(self.shards)
+                          for value in values)
+        # shards with room left, some of them may have been filled since
+        self.free = [number for (number, values) in enumerate(self.shards)
+                     if len(values) < shard_size][::-1]
+
+    def __contains__(self, value):
+        return value.lower() in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def add(self, value):
+        '''Add a value, return False if it was already there'''
+        value = value.lower()
+        if value in self.index:
+            return False
+        while self.free and \
+                len(self.shards[self.free[-1]]) >= self.shard_size:
+            self.free.pop()
+        if not self.free:
+            self.shards.append(set())
+            self.free.append(len(self.shards) - 1)
+        number = self.free[-1]
+        self.shards[number].add(value)
+        self.index[value] = number
+        return True
+
+    def remove(self, value):
+        '''Remove a value, return False if it was not there'''
+        number = self.index.pop(value.lower(), None)
+        if number is None:
+            return False
+        self.shards[number].discard(value.lower())
+        if len(self.shards[number]) == self.shard_size - 1:
+            self.free.append(number)
+        return True
+
+    def shard_number(self, name):
+        '''Return the number of the shard of a rule name, or None'''
+        (prefix, _, number) = name.rpartition(u' ')
+        if prefix != self.name or not number.isdigit() or number == u'0':
+            return None
+        return int(number) - 1
+
+    @classmethod
+    def from_rules(cls, name, rules, shard_size=BLOCK_SHARD_SIZE):
+        '''Return the blocklist of the rules of a name among Zimbra rules'''
+        blocklist = cls(name, (), shard_size)
+        shards = {}
+        for rule in rules:
+            number = blocklist.shard_number(rule[u'name'])
+            if number is not None:
+                shards[number] = [test.attributes[u'value']
+                                  for test in as_rule(rule).tests]
+        return cls(name, [[value.lower() for value in shards.get(n, ())]
+                          for n in range(max(shards) + 1 if shards else 0)],
+                   shard_size)
+
+    def rules(self, actions):
+        '''Return the Zimbra rules of the non empty shards, doing actions'''
+        rules = []
+        for (number, values) in enumerate(self.shards):
+            if not values:
+                continue
+            tests = [Test(u'addressTest', index, {
+                u'header': u'from', u'stringComparison': u'is',
+                u'part': u'all' if u'@' in value else u'domain',
+                u'value': value, u'index': unicode(index)})
+                for (index, value) in enumerate(sorted(values))]
+            rules.append(Rule(self.name + u' ' + unicode(number + 1), u'1',
+                              u'anyof', tuple(tests), actions).to_dict())
+        return rules
+
+    def merged(self, rules, actions):
+        '''Return Zimbra rules with the blocklist rules replaced by the
+        current ones, in place of the first of them or else first'''
+        others = [rule for rule in rules
+                  if self.shard_number(rule[u'name']) is None]
+        position = next((i for (i, rule) in enumerate(rules)
+                         if self.shard_number(rule[u'name']) is not None), 0)
+        return others[:position] + self.rules(actions) + others[position:]
+
+
+def block_actions(folder=None):
+    '''Actions of blocklist rules, filing into a folder or discarding'''
+    if folder is None:
+        first = Action(u'actionDiscard', 0, {u'index': u'0'})
+    else:
+        first = Action(u'actionFileInto', 0,
+                       {u'folderPath': folder, u'index': u'0'})
+    return (first, Action(u'actionStop', 1, {u'index': u'1'}))
+
+
+def blocklist_path(url, login, name):
+    '''File keeping the local copy of a blocklist of an account'''
+    key = hashlib.sha1((url + u'\0' + login + u'\0' + name).encode('utf-8'))
+    return os.path.join(cache_dir(), u'blocklists', key.hexdigest() + u'.json')
+
+
+def load_blocklist(url, login, name, shard_size=BLOCK_SHARD_SIZE):
+    '''Return the local copy of a blocklist, None if there is none, and its
+    list of pending [operation, value] changes'''
+    try:
+        with io.open(blocklist_path(url, login, name),
+                     encoding=u'utf-8') as f:
+            data = json.load(f)
+    except (IOError, OSError, ValueError):
+        return (None, [])
+    blocklist = None
+    if data[u'shards'] is not None:
+        blocklist = Blocklist(name, data[u'shards'], shard_size)
+    return (blocklist, data[u'pending'])
+
+
+def store_blocklist(url, login, name, blocklist, pending):
+    '''Save the local copy of a blocklist and its pending changes'''
+    shards = None
+    if blocklist is not None:
+        shards = [sorted(values) for values in blocklist.shards]
+    store_json(blocklist_path(url, login, name),
+               {u'shards': shards, u'pending': pending})
+
+
+def push_blocklist(comm, token, name, pending, actions,
+                   shard_size=BLOCK_SHARD_SIZE, outgoing=False):
+    '''Apply pending changes to a blocklist as it is on the server, with a
+    single upload, return the Blocklist or None if it failed'''
+    rules = fetch_account(comm, token, FILTER_REQUESTS)[
+        filter_request(u'Get', outgoing)]
+    if rules is None:
+        print(u'could not get filters', file=sys.stderr)
+        return None
+    current = filter_rules(rules)
+    blocklist = Blocklist.from_rules(name, current, shard_size)
+    for (operation, value) in pending:
+        if operation == u'add':
+            blocklist.add(value)
         else:
-            print(u'Seems ok', file=sys.stderr)
+            blocklist.remove(value)
+    new_rules = blocklist.merged(current, actions)
+    changes = diff_rules(current, new_rules)
+    display_diff(changes)
+    if not changes:
+        return blocklist
+    if check_targets(comm, token, blocklist.rules(actions)) or \
+            not upload_rules(comm, token,
+                             {u'filterRules': {u'filterRule': new_rules}},
+                             rules, outgoing):
+        return None
+    return blocklist
+
+
+def block(args):
+    '''Command line entry point of the blocklist mode'''
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog=basename(sys.argv[0]) + u' block',
+        description=u'add or remove senders of a blocklist')
+    parser.add_argument(u'values', nargs=u'*', metavar=u'sender',
+                        help=u'address, or domain, of a sender')
+    parser.add_argument(u'-r', u'--remove', action=u'store_true',
+                        help=u'remove the senders instead')
+    parser.add_argument(u'--defer', action=u'store_true',
+                        help=u'only queue the changes for the next upload')
+    parser.add_argument(u'-l', u'--list', action=u'store_true',
+                        help=u'print the blocked senders')
+    parser.add_argument(u'--name', default=u'blocklist',
+                        help=u'name of the blocklist rules')
+    parser.add_argument(u'--folder', default=u'Junk',
+                        help=u"folder of blocked messages, '-' to discard")
+    parser.add_argument(u'--shard-size', type=int, default=BLOCK_SHARD_SIZE,
+                        help=u'maximum number of senders in each rule')
+    parser.add_argument(u'--outgoing', action=u'store_true',
+                        help=u'use the filters of outgoing mail')
+    options = parser.parse_args(args)
+
+    url = server_url()
+    login = unicode(default_login())
+    name = options.name
+    (blocklist, pending) = load_blocklist(url, login, name,
+                                          options.shard_size)
+    operation = u'remove' if options.remove else u'add'
+    for value in options.values:
+        pending.append([operation, value])
+        if blocklist is not None:
+            getattr(blocklist, operation)(value)
+
+    if not options.defer:
+        token = get_token(url, login)
+        if token is None:
+            return 1
+        actions = block_actions(
+            None if options.folder == u'-' else options.folder)
+        pushed = push_blocklist(get_connection(url), token, name, pending,
+                                actions, options.shard_size, options.outgoing)
+        if pushed is None:
+            store_blocklist(url, login, name, blocklist, pending)
+            return 1
+        (blocklist, pending) = (pushed, [])
+    store_blocklist(url, login, name, blocklist, pending)
+    if blocklist is None:
+        print(name + u': ' + unicode(len(pending)) + u' pending changes',
+              file=sys.stderr)
+        return 0
+    if options.list:
+        for value in sorted(blocklist.index):
+            print(value)
+    print(u'{0}: {1} senders in {2} rules, {3} pending changes'.format(
+        name, len(blocklist), sum(1 for values in blocklist.shards if values),
+        len(pending)), file=sys.stderr)
+    return 0
+
+
+# days of mail in each chunk of zbt apply
+APPLY_DAYS = 7
+# messages in each page of search results
+SEARCH_PAGE = 1000
+
+
+def zimbra_date(day):
+    '''Return a date in the format of Zimbra search queries'''
+    return unicode(day.strftime('%m/%d/%Y'))
+
+
+def window_query(query, start, end):
+    '''Restrict a search query to the days from start to end excluded'''
+    return u'({0}) after:{1} before:{2}'.format(
+        query, zimbra_date(start - timedelta(1)), zimbra_date(end))
+
+
+def search_messages(comm, token, query, limit, offset=0, sort=u'dateAsc'):
+    '''Return the (id, timestamp) of a page of the messages matching a
+    query, or None on fault'''
+    response = communicate(comm, token, u'SearchRequest', {
+        u'query': {u'_content': query}, u'types': u'message',
+        u'sortBy': sort, u'limit': unicode(limit), u'offset': unicode(offset)
+    })
+    if response.is_fault():
+        return None
+    messages = as_list(response.get_response()[u'SearchResponse'].get(u'm'))
+    return [(m[u'id'], int(m[u'd']) / 1000) for m in messages]
+
+
+def date_chunks(comm, token, query, since=None, until=None, days=APPLY_DAYS):
+    '''Return (key, start, end) windows of days covering the messages of a
+    query, from the oldest one if since is None, to today by default
+
+    days are those of the timezone of the account, which can be a day
+    before or after the UTC day of the oldest message and our today'''
+    if since is None:
+        oldest = search_messages(comm, token, query, 1)
+        if not oldest:
+            return []
+        since = datetime.utcfromtimestamp(oldest[0][1]).date() - timedelta(1)
+    end = (until or date.today() + timedelta(1)) + timedelta(1)
+    chunks = []
+    while since < end:
+        chunks.append((since.isoformat(), since,
+                       min(since + timedelta(days), end)))
+        since += timedelta(days)
+    return chunks
+
+
+def id_chunks(comm, token, query, size):
+    '''Return (key, ids) batches of at most size messages of a query'''
+    ids = []
+    while True:
+        page = search_messages(comm, token, query, SEARCH_PAGE, len(ids))
+        if page is None:
+            raise IOError(u'could not search ' + query)
+        ids.extend(i for (i, _) in page)
+        if len(page) < SEARCH_PAGE:
+            break
+    chunks = []
+    for n in range(0, len(ids), size):
+        batch = u','.join(ids[n:n + size])
+        chunks.append((hashlib.sha1(batch.encode('utf-8')).hexdigest(), batch))
+    return chunks
+
+
+def apply_request(comm, token, names, query=None, ids=None,
+                  outgoing=False):
+    '''Apply filter rules to the messages of a query or of a list of ids,
+    return the number of messages affected, or None on fault'''
+    request = {u'filterRules': {u'filterRule': [{u'name': name}
+                                                for name in names]}}
+    if ids is not None:
+        request[u'm'] = {u'ids': ids}
+    else:
+        request[u'query'] = {u'_content': query}
+    request_type = filter_request(u'Apply', outgoing)
+    response = communicate(comm, token, request_type, request)
+    if response.is_fault():
+        return None
+    m = response.get_response()[
+        request_type[:-len(u'Request')] + u'Response'].get(u'm')
+    return len(m[u'ids'].split(u',')) if m and m.get(u'ids') else 0
+
+
+def apply_chunk(job):
+    '''Apply filter rules to a chunk, return (key, messages affected)
+
+    the messages affected are None on failure. A window of days that fails,
+    for instance with too many messages, is split in two.'''
+    (comm, token, names, query, chunk, outgoing) = job
+    if len(chunk) == 2:
+        return (chunk[0], apply_request(comm, token, names, ids=chunk[1],
+                                        outgoing=outgoing))
+
+    def apply_window(start, end):
+        '''apply to a window of days, halved until it succeeds'''
+        count = apply_request(comm, token, names,
+                              window_query(query, start, end),
+                              outgoing=outgoing)
+        if count is not None or end - start <= timedelta(1):
+            return count
+        middle = start + (end - start) / 2
+        counts = [apply_window(start, middle), apply_window(middle, end)]
+        return None if None in counts else sum(counts)
+
+    return (chunk[0], apply_window(chunk[1], chunk[2]))
+
+
+def apply_state_path(url, login, key):
+    '''File keeping the chunks of an apply run and those already done'''
+    key = hashlib.sha1((url + u'\0' + login + u'\0' + key).encode('utf-8'))
+    return os.path.join(cache_dir(), u'apply', key.hexdigest() + u'.json')
+
+
+def run_apply(comm, token, names, query, chunks, jobs=2, done=None,
+              outgoing=False):
+    '''Apply filter rules to chunks of messages, at most jobs at a time
+
+    chunks whose key is in done are skipped. Yield (key, messages
+    affected) as each chunk is done, messages being None on failure.'''
+    from multiprocessing.pool import ThreadPool
+    done = done or {}
+    pool = ThreadPool(jobs)
+    try:
+        for result in pool.imap_unordered(apply_chunk, [
+                (comm, token, names, query, chunk, outgoing)
+                for chunk in chunks if chunk[0] not in done]):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def iso_date(text):
+    '''argparse type of YYYY-MM-DD dates'''
+    return datetime.strptime(text, '%Y-%m-%d').date()
+
+
+def read_apply_state(path):
+    '''Return the chunks of an interrupted apply run and the messages
+    affected by the chunks already done, or None'''
+    try:
+        with io.open(path, encoding=u'utf-8') as f:
+            state = json.load(f)
+        chunks = [(c[0], iso_date(c[1]), iso_date(c[2])) if len(c) == 3
+                  else tuple(c) for c in state[u'chunks']]
+        return (chunks, state[u'done'])
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def store_apply_state(path, chunks, done):
+    '''Save the chunks of an apply run and the messages affected by the
+    chunks already done'''
+    store_json(path, {u'chunks': [
+        [c[0], c[1].isoformat(), c[2].isoformat()] if len(c) == 3
+        else list(c) for c in chunks], u'done': done})
+
+
+def apply_rules(args):
+    '''Command line entry point of the apply mode'''
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog=basename(sys.argv[0]) + u' apply',
+        description=u'apply filter rules to existing messages, by chunks')
+    parser.add_argument(u'rules', nargs=u'+', metavar=u'rule',
+                        help=u'name of a filter rule')
+    parser.add_argument(u'-q', u'--query', default=u'in:inbox',
+                        help=u'Zimbra search query, in:inbox by default')
+    parser.add_argument(u'--since', type=iso_date,
+                        help=u'first day, YYYY-MM-DD, of the oldest message '
+                        u'by default')
+    parser.add_argument(u'--until', type=iso_date,
+                        help=u'last day, YYYY-MM-DD, today by default')
+    parser.add_argument(u'--days', type=int, default=APPLY_DAYS,
+                        help=u'days of messages in each chunk')
+    parser.add_argument(u'--batch', type=int,
+                        help=u'chunks of this many message ids instead')
+    parser.add_argument(u'-j', u'--jobs', type=int, default=2,
+                        help=u'chunks applied at the same time')
+    parser.add_argument(u'--restart', action=u'store_true',
+                        help=u'do not resume a previous run')
+    parser.add_argument(u'--outgoing', action=u'store_true',
+                        help=u'apply outgoing filter rules')
+    options = parser.parse_args(args)
+
+    url = server_url()
+    token = get_token(url)
+    if token is None:
+        return 1
+    comm = get_connection(url)
+    rules = fetch_account(comm, token, FILTER_REQUESTS)[
+        filter_request(u'Get', options.outgoing)]
+    if rules is None:
+        print(u'could not get filters', file=sys.stderr)
+        return 1
+    unknown = set(options.rules) - set(r[u'name'] for r in filter_rules(rules))
+    if unknown:
+        print(u'unknown rules: ' + u', '.join(sorted(unknown)),
+              file=sys.stderr)
+        return 1
+
+    key = json.dumps([options.rules, options.query, options.outgoing,
+                      options.batch or options.days] +
+                     [day and day.isoformat()
+                      for day in (options.since, options.until)])
+    path = apply_state_path(url, token.login, key)
+    # the chunks are those of the first run: applied rules can move messages
+    # out of the query, so that searching again would give other chunks
+    state = None if options.restart else read_apply_state(path)
+    if state is not None:
+        (chunks, done) = state
+    else:
+        if options.batch:
+            chunks = id_chunks(comm, token, options.query, options.batch)
+        else:
+            chunks = date_chunks(comm, token, options.query, options.since,
+                                 options.until, options.days)
+        done = {}
+        store_apply_state(path, chunks, done)
+    print(u'{0} chunks, {1} already done'.format(
+        len(chunks), sum(1 for c in chunks if c[0] in done)),
+        file=sys.stderr)
+
+    failed = 0
+    messages = sum(done.get(c[0], 0) for c in chunks)
+    for (chunk, count) in run_apply(comm, token, options.rules,
+                                    options.query, chunks, options.jobs,
+                                    done, options.outgoing):
+        if count is None:
+            failed += 1
+            print(u'chunk ' + chunk + u' FAILED', file=sys.stderr)
+            continue
+        done[chunk] = count
+        messages += count
+        store_apply_state(path, chunks, done)
+        print(u'{0}/{1} chunks, {2} messages affected'.format(
+            sum(1 for c in chunks if c[0] in done), len(chunks), messages),
+            file=sys.stderr)
+    if failed:
+        print(unicode(failed) + u' chunks failed, run again to resume',
+              file=sys.stderr)
+        return 1
+    if os.path.exists(path):
+        os.remove(path)
+    return 0
+
+
+class SimulatedMessage(object):
+    '''A message of the simulation corpus
+
+    headers are parsed once, the body only if a rule needs it'''
+    def __init__(self, raw):
+        from email.parser import HeaderParser
+        self.raw = raw
+        self.size = len(raw)
+        self.headers = HeaderParser().parsestr(raw, headersonly=True)
+        self._values = {}
+        self._body = None
+
+    def header(self, name):
+        '''decoded values of a header, possibly empty'''
+        name = name.lower()
+        if name not in self._values:
+            self._values[name] = [decode_header_value(v) for v in
+                                  self.headers.get_all(name, [])]
+        return self._values[name]
+
+    def body(self):
+        '''decoded text of all the text parts'''
+        if self._body is None:
+            import email
+            parts = []
+            for part in email.message_from_string(self.raw).walk():
+                if part.get_content_maintype() != u'text':
+                    continue
+                payload = part.get_payload(decode=True) or ''
+                charset = part.get_content_charset() or 'us-ascii'
+                try:
+                    parts.append(payload.decode(charset, 'replace'))
+                except LookupError:
+                    parts.append(payload.decode('us-ascii', 'replace'))
+            self._body = u'\n'.join(parts)
+        return self._body
+
+
+def decode_header_value(value):
+    '''decode an RFC 2047 header value to unicode'''
+    from email.header import decode_header
+    chunks = []
+    for (chunk, charset) in decode_header(value):
+        try:
+            chunks.append(chunk.decode(charset or 'us-ascii', 'replace'))
+        except LookupError:
+            chunks.append(chunk.decode('us-ascii', 'replace'))
+    return u' '.join(chunks)
+
+
+def wildcard_regex(pattern, flags=0):
+    '''compile a Sieve :matches pattern, with * and ? wildcards'''
+    regex = []
+    escaped = False
+    for c in pattern:
+        if escaped:
+            regex.append(re.escape(c))
+            escaped = False
+        elif c == u'\\':
+            escaped = True
+        elif c == u'*':
+            regex.append(u'.*')
+        elif c == u'?':
+            regex.append(u'.')
+        else:
+            regex.append(re.escape(c))
+    return re.compile(u''.join(regex) + u'\\Z', flags | re.DOTALL)
+
+
+def compile_string_match(test):
+    '''Return a function matching a string against the value of a test
+
+    Zimbra compares strings ignoring case unless caseSensitive is set'''
+    comparison = test.get(u'stringComparison', u'contains')
+    casemap = test.get(u'caseSensitive') != u'1'
+    value = test[u'value']
+    if comparison == u'matches':
+        return wildcard_regex(value, re.IGNORECASE if casemap else 0).match
+    if casemap:
+        value = value.lower()
+    if comparison == u'is':
+        if casemap:
+            return lambda s: s.lower() == value
+        return lambda s: s == value
+    if casemap:
+        return lambda s: value in s.lower()
+    return lambda s: value in s
+
+
+def compile_header(test):
+    '''Return a matcher for a Zimbra headerTest'''
+    headers = test[u'header'].split(u',')
+    match = compile_string_match(test)
+    return lambda m: any(match(v) for h in headers for v in m.header(h))
+
+
+def compile_address(test):
+    '''Return a matcher for a Zimbra addressTest'''
+    from email.utils import getaddresses
+    headers = test[u'header'].split(u',')
+    part = test.get(u'part', u'all')
+    match = compile_string_match(test)
+
+    def address_part(address):
+        '''the part of the address the test is about'''
+        if part == u'all':
+            return address
+        (local, _, domain) = address.rpartition(u'@')
+        return local if part == u'localpart' else domain
+
+    return lambda m: any(
+        match(address_part(a))
+        for (_, a) in getaddresses([v for h in headers for v in m.header(h)]))
+
+
+def compile_size(test):
+    '''Return a matcher for a Zimbra sizeTest'''
+    limit = size_in_bytes(test[u's'])
+    if test[u'numberComparison'] == u'over':
+        return lambda m: m.size > limit
+    return lambda m: m.size < limit
+
+
+def compile_date(test):
+    '''Return a matcher for a Zimbra dateTest, at the day level'''
+    from email.utils import mktime_tz, parsedate_tz
+    day = datetime.utcfromtimestamp(int(test[u'd'])).date()
+    before = test[u'dateComparison'] == u'before'
+
+    def match(m):
+        '''compare the day of the Date header with the one of the test'''
+        for value in m.header(u'date'):
+            parsed = parsedate_tz(value)
+            if parsed is not None:
+                sent = datetime.utcfromtimestamp(mktime_tz(parsed)).date()
+                return sent <= day if before else sent >= day
+        return False
+    return match
+
+
+def compile_body(test):
+    '''Return a matcher for a Zimbra bodyTest'''
+    match = compile_string_match(test)
+    return lambda m: match(m.body())
+
+
+def compile_exists(test):
+    '''Return a matcher for a Zimbra headerExistsTest'''
+    header = test[u'header']
+    return lambda m: header in m.headers
+
+
+# Zimbra test category -> function compiling a test to a message matcher
+test_matchers = {
+    u'headerTest': compile_header,
+    u'addressTest': compile_address,
+    u'sizeTest': compile_size,
+    u'dateTest': compile_date,
+    u'bodyTest': compile_body,
+    u'headerExistsTest': compile_exists,
+}
+
+
+def compile_test(test):
+    '''Return a matcher for a single Test, with its negation'''
+    compiler = test_matchers.get(test.category)
+    if compiler is None:
+        print(u'Warning: cannot simulate test category ' + test.category,
+              file=sys.stderr)
+        return lambda m: False
+    match = compiler(test.attributes)
+    if test.attributes.get(u'negative') == u'1':
+        return lambda m: not match(m)
+    return match
+
+
+def compile_rule(rule):
+    '''Return (name, matcher, actions, stop) for a Zimbra rule
+
+    actions are their Sieve strings, stop tells if further rules are
+    skipped when the rule matches'''
+    rule = as_rule(rule)
+    matchers = [compile_test(test) for test in rule.tests]
+    combine = all if rule.condition == u'allof' else any
+
+    def match(m):
+        '''evaluate tests in order, stopping as soon as possible'''
+        return combine(f(m) for f in matchers)
+    return (rule.name, match,
+            [show_action(a) for a in rule.actions
+             if a.category != u'actionStop'],
+            any(a.category == u'actionStop' for a in rule.actions))
+
+
+# compiled rules of a simulation worker
+_compiled_rules = []
+
+
+def init_simulation(rules):
+    '''Compile the active rules in a simulation worker, with their index'''
+    _compiled_rules[:] = [(index,) + compile_rule(rule)
+                          for (index, rule) in enumerate(rules)
+                          if rule[u'active'] == u'1']
+
+
+def simulate_message(item):
+    '''Run the rules on a single message
+
+    item is (label, path) or (label, None, raw message), return (label,
+    indexes of the matching rules, resulting actions)'''
+    if item[1] is not None:
+        with open(item[1], 'rb') as f:
+            raw = f.read()
+    else:
+        raw = item[2]
+    message = SimulatedMessage(raw)
+    matched = []
+    actions = []
+    for (index, _, match, rule_actions, stop) in _compiled_rules:
+        if match(message):
+            matched.append(index)
+            actions.extend(rule_actions)
+            if stop:
+                break
+    return (item[0], matched, actions)
+
+
+def corpus_items(corpus):
+    '''Yield the messages of a Maildir (as paths) or of an mbox file'''
+    if os.path.isdir(corpus):
+        for sub in [u'cur', u'new']:
+            directory = os.path.join(corpus, sub)
+            if os.path.isdir(directory):
+                for filename in sorted(os.listdir(directory)):
+                    yield (os.path.join(sub, filename),
+                           os.path.join(directory, filename))
+    else:
+        import mailbox
+        mbox = mailbox.mbox(corpus, create=False)
+        for key in mbox.iterkeys():
+            yield (unicode(key), None, mbox.get_string(key))
 
 
-def communicate(comm, token, request_type, request_args):
-    '''Send a request to Zimbra SOAP API and return response'''
-    request = RequestXml()
-    request.set_auth_token(token)
-    request.add_request(request_type, request_args, u'urn:zimbraMail')
+def simulate_rules(rules, corpus, jobs=None):
+    '''Run the rules over a corpus in parallel
+
+    yield (label, matching rule names, actions) for each message'''
+    for (label, matched, actions) in run_simulation(rules, corpus, jobs):
+        yield (label, [rules[index][u'name'] for index in matched], actions)
 
-    response = ResponseXml()
-    comm.send_request(request, response)
-    return response
+
+def run_simulation(rules, corpus, jobs=None):
+    '''simulate_rules(), matching rules being given by their index'''
+    if jobs == 1:
+        init_simulation(rules)
+        for item in corpus_items(corpus):
+            yield simulate_message(item)
+        return
+    import multiprocessing
+    pool = multiprocessing.Pool(jobs, init_simulation, (rules,))
+    try:
+        for result in pool.imap(simulate_message, corpus_items(corpus), 64):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def simulate(args):
+    '''Command line entry point of the simulation mode'''
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog=basename(sys.argv[0]) + u' simulate',
+        description=u'show which messages sieve rules would match')
+    parser.add_argument(u'sieve', help=u"sieve file, '-' for standard input")
+    parser.add_argument(u'corpus', help=u'Maildir directory or mbox file')
+    parser.add_argument(u'-j', u'--jobs', type=int, default=None,
+                        help=u'number of processes, all CPUs by default')
+    options = parser.parse_args(args)
+
+    rules = parse(options.sieve)
+    if rules is None:
+        return 1
+    hits = [0] * len(rules)
+    messages = 0
+    with open_output(u'-') as out:
+        for (label, matched, actions) in run_simulation(
+                rules, options.corpus, options.jobs):
+            messages += 1
+            for index in matched:
+                hits[index] += 1
+            if matched:
+                names = u', '.join(rules[index][u'name'] for index in matched)
+                out.write(u'\t'.join([label, names, u' '.join(actions)]) +
+                          u'\n')
+        out.write(u'\nRule hits over ' + unicode(messages) + u' messages:\n')
+        for (count, rule) in zip(hits, rules):
+            out.write(u'  ' + unicode(count) + u'\t' + rule[u'name'] + u'\n')
+    return 0
+
+
+def item_key(item):
+    '''identify a test or an action by its category and attributes, whatever
+    its index'''
+    return (item.category, tuple(sorted(
+        (key, unicode(value)) for (key, value) in item.attributes.items()
+        if key != u'index')))
+
+
+def reindexed(cls, items):
+    '''Return a copy of items numbered from 0'''
+    result = []
+    for (index, item) in enumerate(items):
+        attributes = dict(item.attributes)
+        attributes[u'index'] = unicode(index)
+        result.append(cls(item.category, index, attributes))
+    return tuple(result)
+
+
+# string tests for which a broader value can be found
+STRING_TESTS = [u'headerTest', u'addressTest', u'bodyTest']
+
+
+def test_implies(test, other):
+    '''True if test matching means that other matches too
+
+    header :contains "foo" is implied by header :is "a foo" or by the same
+    test on fewer headers, negated tests are only implied by themselves'''
+    if test.category != other.category:
+        return False
+    (a, b) = (test.attributes, other.attributes)
+    if len(a) == len(b) and all(value == b.get(key)
+                                for (key, value) in a.items()
+                                if key != u'index'):
+        return True
+    if test.category not in STRING_TESTS:
+        return False
+    if any(x.get(key) == u'1' for x in (a, b)
+           for key in (u'negative', u'caseSensitive')) or \
+            a.get(u'part') != b.get(u'part'):
+        return False
+    if not set(a.get(u'header', u'').split(u',')) <= \
+            set(b.get(u'header', u'').split(u',')):
+        return False
+    comparison = a.get(u'stringComparison', u'contains')
+    if b.get(u'stringComparison', u'contains') != u'contains' or \
+            comparison not in (u'is', u'contains'):
+        return False
+    return b[u'value'].lower() in a[u'value'].lower()
+
+
+def tests_imply(tests, other):
+    '''True if all tests matching means that the Rule other matches'''
+    check = any if other.condition == u'anyof' else all
+    return check(any(test_implies(t, o) for t in tests) for o in other.tests)
+
+
+def rule_implies(rule, other):
+    '''True if the Rule rule matching means that the Rule other matches'''
+    if rule.condition == u'anyof' and len(rule.tests) > 1:
+        return all(tests_imply((test,), other) for test in rule.tests)
+    return tests_imply(rule.tests, other)
+
+
+def reduce_tests(tests, condition):
+    '''Return tests without those made useless by another one
+
+    with anyof a test implying another one is useless, with allof a test
+    implied by another one is'''
+    def useless(test, by):
+        '''test is useless given the test by'''
+        if condition == u'anyof':
+            return test_implies(test, by)
+        return test_implies(by, test)
+
+    kept = []
+    for test in tests:
+        if not any(useless(test, k) for k in kept):
+            kept = [k for k in kept if not useless(k, test)] + [test]
+    return kept
+
+
+def dedupe_actions(actions):
+    '''Return actions without repeated ones'''
+    seen = set()
+    kept = []
+    for action in actions:
+        key = item_key(action)
+        if key not in seen:
+            seen.add(key)
+            kept.append(action)
+    return kept
+
+
+# actions that give the same result when done twice
+IDEMPOTENT_ACTIONS = [u'actionFileInto', u'actionTag', u'actionFlag',
+                      u'actionKeep', u'actionDiscard', u'actionStop']
+
+
+def stops(rule):
+    '''True if no other rule is evaluated after the Rule matched'''
+    return any(action.category == u'actionStop' for action in rule.actions)
+
+
+def mergeable(rule, other):
+    '''True if two consecutive Rules can become a single anyof rule
+
+    both match on any of their tests and do the same actions, done once
+    when both match, which is fine when they stop or are idempotent'''
+    return rule.active == other.active == u'1' and \
+        all(r.condition == u'anyof' or len(r.tests) == 1
+            for r in (rule, other)) and \
+        [item_key(a) for a in rule.actions] == \
+        [item_key(a) for a in other.actions] and \
+        (stops(rule) or
+         all(a.category in IDEMPOTENT_ACTIONS for a in rule.actions))
+
+
+def test_slots(test):
+    '''the keys under which the stopping rules with a test are indexed, a
+    test can only imply a test sharing one of its keys'''
+    if test.category in STRING_TESTS:
+        return [(test.category, test.attributes.get(u'part'), header)
+                for header in test.attributes.get(u'header', u'').split(u',')]
+    return [item_key(test)]
+
+
+def shadowing_rule(rule, stoppers):
+    '''Return the earlier stopping Rule which always matches when rule does,
+    if any
+
+    stoppers maps test slots to the stopping rules having such a test'''
+    candidates = set(stoppers.get(None, ()))
+    for test in rule.tests:
+        for key in test_slots(test):
+            candidates.update(stoppers.get(key, ()))
+    for (position, stopper) in sorted(candidates):
+        if rule_implies(rule, stopper):
+            return stopper
+    return None
+
+
+def optimize_rules(rules):
+    '''Return (rules, report) where the Zimbra rules evaluate faster
+
+    duplicate tests and actions are removed, active rules that an earlier
+    stopping rule always prevents are removed, and consecutive rules with
+    the same actions are merged. report is a list of messages.'''
+    report = []
+    stoppers = {}
+    optimized = []
+    for (position, rule) in enumerate(as_rule(r) for r in rules):
+        tests = reduce_tests(rule.tests, rule.condition)
+        actions = dedupe_actions(rule.actions)
+        if len(tests) < len(rule.tests) or len(actions) < len(rule.actions):
+            report.append(u'removed {0} redundant tests and {1} duplicate '
+                          u'actions from rule {2}'.format(
+                              len(rule.tests) - len(tests),
+                              len(rule.actions) - len(actions), rule.name))
+            rule = Rule(rule.name, rule.active, rule.condition,
+                        reindexed(Test, tests), reindexed(Action, actions),
+                        rule.extra)
+        if rule.active != u'1':
+            optimized.append(rule)
+            continue
+        shadow = shadowing_rule(rule, stoppers)
+        if shadow is not None:
+            stats.count(u'rules_shadowed')
+            report.append(u'removed rule ' + rule.name +
+                          u', never reached after rule ' + shadow.name)
+            continue
+        previous = optimized[-1] if optimized else None
+        if previous is not None and mergeable(previous, rule):
+            stats.count(u'rules_merged')
+            report.append(u'merged rule ' + rule.name + u' into rule ' +
+                          previous.name)
+            tests = reduce_tests(previous.tests + rule.tests, u'anyof')
+            optimized[-1] = Rule(previous.name, previous.active, u'anyof',
+                                 reindexed(Test, tests), previous.actions,
+                                 previous.extra)
+        else:
+            optimized.append(rule)
+        if stops(rule):
+            for key in set(key for test in rule.tests
+                           for key in test_slots(test)) or [None]:
+                stoppers.setdefault(key, []).append((position, optimized[-1]))
+    return ([r.to_dict() for r in optimized], report)
+
+
+def optimize(args):
+    '''Command line entry point of the rule set optimizer'''
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog=basename(sys.argv[0]) + u' optimize',
+        description=u'merge, dedupe and remove shadowed sieve rules')
+    parser.add_argument(u'sieve', nargs=u'?', default=u'-',
+                        help=u"sieve file, standard input by default")
+    parser.add_argument(u'-o', u'--output', default=u'-',
+                        help=u'output file, standard output by default')
+    parser.add_argument(u'-n', u'--dry-run', action=u'store_true',
+                        help=u'only report what would be optimized')
+    options = parser.parse_args(args)
+
+    rules = parse(options.sieve)
+    if rules is None:
+        return 1
+    (optimized, report) = optimize_rules(rules)
+    for line in report:
+        print(u'  ' + line, file=sys.stderr)
+    print(u'{0} rules with {1} tests, {2} rules with {3} tests once '
+          u'optimized'.format(
+              len(rules), sum(len(as_rule(r).tests) for r in rules),
+              len(optimized), sum(len(as_rule(r).tests) for r in optimized)),
+          file=sys.stderr)
+    if not options.dry_run:
+        with open_output(options.output) as out:
+            display_rules(optimized, out)
+    return 0
+
+
+def json_rules(data):
+    '''Return the list of rules of a saved GetFilterRulesResponse
+
+    the whole SOAP response, its filterRules or a list of rules are
+    accepted'''
+    if isinstance(data, list):
+        return data
+    if u'GetFilterRulesResponse' in data:
+        data = data[u'GetFilterRulesResponse']
+    if u'filterRules' in data:
+        return filter_rules(data)
+    return [data]
+
+
+def read_ndjson(stream):
+    '''Yield the rules of a stream with one JSON rule per line'''
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+
+def write_ndjson(rules, out):
+    '''Write rules with one JSON rule per line'''
+    for rule in rules:
+        out.write(json.dumps(rule, sort_keys=True) + u'\n')
+
+
+@contextmanager
+def open_input(path):
+    '''a binary stream reading a file, or standard input for -'''
+    if path == u'-':
+        yield sys.stdin
+    else:
+        with open(path, 'rb') as stream:
+            yield stream
+
+
+@contextmanager
+def open_output(path):
+    '''a unicode stream writing a UTF-8 file, or standard output for -'''
+    if path == u'-':
+        yield codecs.getwriter('utf-8')(sys.stdout)
+    else:
+        with io.open(path, u'w', encoding=u'utf-8') as out:
+            yield out
+
+
+def conversion_parser(command, description, source):
+    '''Return the command line parser of an offline conversion'''
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog=basename(sys.argv[0]) + u' ' + command, description=description)
+    parser.add_argument(u'input', nargs=u'?', default=u'-',
+                        help=source + u", standard input by default")
+    parser.add_argument(u'-o', u'--output', default=u'-',
+                        help=u'output file, standard output by default')
+    parser.add_argument(u'--ndjson', action=u'store_true',
+                        help=u'JSON rules are one per line')
+    return parser
+
+
+def to_sieve(args):
+    '''Command line entry point of the offline Zimbra to Sieve conversion'''
+    options = conversion_parser(
+        u'to-sieve', u'convert saved Zimbra filters to sieve',
+        u'JSON GetFilterRulesResponse or rules').parse_args(args)
+    try:
+        with open_input(options.input) as stream:
+            if options.ndjson:
+                rules = read_ndjson(stream)
+            else:
+                rules = json_rules(json.load(stream))
+            with open_output(options.output) as out:
+                display_rules(rules, out)
+    except (ValueError, KeyError, TypeError) as e:
+        print(u'invalid rules in ' + options.input + u': ' + unicode(e),
+              file=sys.stderr)
+        return 1
+    return 0
+
+
+def to_zimbra(args):
+    '''Command line entry point of the offline Sieve to Zimbra conversion'''
+    options = conversion_parser(
+        u'to-zimbra', u'convert sieve rules to Zimbra JSON filters',
+        u'sieve file').parse_args(args)
+    with open_input(options.input) as stream:
+        if options.ndjson:
+            # rules are written as they are read, up to an error
+            with open_output(options.output) as out:
+                for rule in sieve_rules(stream):
+                    if rule is None:
+                        return 1
+                    write_ndjson([rule], out)
+            return 0
+        rules = convert(stream.read())
+    if rules is None:
+        return 1
+    with open_output(options.output) as out:
+        out.write(json.dumps({u'filterRules': {u'filterRule': rules}},
+                             indent=1, sort_keys=True) + u'\n')
+    return 0
 
 
 def usage():
     '''Command usage'''
     print(u'''Usage:
-  {0} [file.sieve]
+  {0} [--stats] [--url URL] [--outgoing] [file.sieve|directory...]
+  {0} fleet [-j JOBS] [--per-server N] [--processes] [-o DIR] manifest
+  {0} drift [-t template.sieve...] [-j JOBS] [--per-server N] [--processes]
+        [--ndjson] manifest
+  {0} simulate [-j JOBS] file.sieve corpus
+  {0} optimize [--dry-run] [-o optimized.sieve] [file.sieve]
+  {0} to-sieve [--ndjson] [-o file.sieve] [rules.json]
+  {0} to-zimbra [--ndjson] [-o rules.json] [file.sieve]
+  {0} block [-r] [--defer] [-l] [--name NAME] [--folder FOLDER] [sender...]
+  {0} apply [-q QUERY] [--since DATE] [--until DATE] [--days N] [--batch N]
+        [-j JOBS] [--restart] [--outgoing] rule...
+  {0} watch [--interval SEC] [--debounce SEC] [--outgoing] file.sieve...
+  {0} snapshots [--login LOGIN] [list|show [-o file.sieve]|rollback] [id]
 
   If an argument is given, {0} will parse the file as a list of sieve rules
 and then upload them to the Zimbra server. '-' can be used to use standard
-input.
+input. With several files, or directories of .sieve files, their rules are
+merged in order, files being parsed in parallel.
 
   If no argument is given, {0} will download current mail filters from the
 Zimbra server and convert them to sieve rules, displayed on standard output.
-'''.format(basename(sys.argv[0])))
+With --outgoing, the filters of outgoing mail are used instead.
+
+  The fleet command does the same for all the accounts listed in the
+manifest, one per line, optionally followed by the sieve file to upload and
+the URL of their server. Downloaded filters are saved as account.sieve.
+
+  The drift command fetches the filters of the accounts of a manifest and
+reports, for each account, the rules of its template that are missing or
+modified and its extra rules. The sieve file of an account in the manifest
+is its template, the ones given with -t are used for the other accounts.
+
+  The watch command uploads the rules of sieve files, without asking for
+confirmation, each time they change and differ from the last uploaded ones,
+reusing the same connection and token until interrupted.
+
+  The block command adds senders to, or with -r removes them from, rules
+named after the blocklist, of at most --shard-size senders each, filing
+their messages into --folder. Changes queued with --defer are uploaded
+together with the next ones.
+
+  The apply command applies filter rules to existing messages of a search
+query, by chunks of --days days (or of --batch messages) with at most JOBS
+chunks at a time. Progress is saved, an interrupted run resumes where it
+stopped unless --restart is given.
+
+  Filters fetched from or uploaded to the server are kept in a local store,
+each rule once. The snapshots command lists them, shows one of them as sieve
+rules without any access to the server, or uploads it back with rollback,
+unless the server already has these filters.
+
+  The simulate command shows which messages of a Maildir or mbox corpus the
+rules of a sieve file would match and the resulting actions, without any
+access to the Zimbra server.
+
+  The optimize command removes duplicate tests and actions, rules that can
+never be reached after an earlier rule ending with stop, and merges
+consecutive rules with the same actions. It reports what it changed and
+writes the smaller rule set, or only reports it with --dry-run.
+
+  The to-sieve and to-zimbra commands convert saved Zimbra JSON filters to
+sieve and back, without any access to the Zimbra server. With --ndjson, JSON
+rules are read or written one per line.
+
+  The Zimbra SOAP API used is {1}
+unless another one is given with --url URL or --url=URL, before or after
+the command, or in the ZBT_URL environment variable. It is also the server
+of the accounts of a manifest without one.
+
+  Passwords are not asked when the preauth key of the domain is in the file
+given by ZBT_PREAUTH_KEY_FILE, or in ZBT_PREAUTH_KEY, nor when tokens can be
+delegated by the admin account given by ZBT_ADMIN, whose admin API is at
+ZBT_ADMIN_URL (port 7071 of the server by default).
+
+  With --stats, counters and timings of each phase are printed as JSON on
+standard error at the end of the run.
+'''.format(basename(sys.argv[0]), DEFAULT_URL))
     exit(1)
 
 
+commands = {
+    u'apply': apply_rules,
+    u'block': block,
+    u'drift': drift,
+    u'fleet': fleet,
+    u'optimize': optimize,
+    u'simulate': simulate,
+    u'snapshots': snapshots,
+    u'to-sieve': to_sieve,
+    u'to-zimbra': to_zimbra,
+    u'watch': watch,
+}
+
+
+def print_stats():
+    '''print out statistics of the run as JSON on stderr'''
+    print(json.dumps(stats.snapshot(), sort_keys=True), file=sys.stderr)
+
+
 def main():
     '''Test arguments and either convert Zimbra to Sieve or the opposite'''
-    if len(sys.argv) > 2 or u'-h' in sys.argv or u'--help' in sys.argv:
+    if u'--stats' in sys.argv:
+        sys.argv.remove(u'--stats')
+        atexit.register(print_stats)
+    for (index, arg) in enumerate(sys.argv):
+        if arg == u'--url' or arg.startswith(u'--url='):
+            if arg == u'--url':
+                url = u''.join(sys.argv[index + 1:index + 2])
+                del sys.argv[index:index + 2]
+            else:
+                url = arg[len(u'--url='):]
+                del sys.argv[index]
+            if not url:
+                usage()
+            # also seen by subcommands and their workers
+            os.environ['ZBT_URL'] = url
+            break
+
+    if len(sys.argv) > 1 and sys.argv[1] in commands:
+        exit(commands[sys.argv[1]](sys.argv[2:]))
+
+    outgoing = u'--outgoing' in sys.argv
+    if outgoing:
+        sys.argv.remove(u'--outgoing')
+
+    if u'-h' in sys.argv or u'--help' in sys.argv:
         usage()
 
-    url = u'https://zimbra.inria.fr/service/soap/'
+    url = server_url()
     token = get_token(url)
-    comm = Communication(url)
-
-    response = communicate(comm, token, u'GetFilterRulesRequest', {})
+    comm = soap_classes()[2](url)
+
+    if token is None:
+        exit(1)
+    if len(sys.argv) < 2:
+        rules = stream_rules(comm, token, outgoing)
+        if rules is None:
+            print(u'could not get filters', file=sys.stderr)
+            exit(1)
+        display_rules(rules)
+        return
 
-    if not response.is_fault():
-        rules = response.get_response()[u'GetFilterRulesResponse']
-        if len(sys.argv) < 2:
-            display_rules(rules[u'filterRules'][u'filterRule'])
-        else:
-            update_rules(comm, token, rules)
+    # folders and tags are only needed to check new rules
+    if cached_targets(url, token.login) is not None:
+        account = fetch_account(comm, token, FILTER_REQUESTS)
+    else:
+        account = fetch_account(comm, token)
+    if account[filter_request(u'Get', outgoing)] is not None:
+        update_rules(comm, token, account, outgoing)
 
 
 if __name__ == '__main__':